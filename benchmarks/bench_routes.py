@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Benchmark pe rute pentru MarioCoinAMG, rulat in-process prin Flask test client.
+
+Populează o bază SQLite sau PostgreSQL locală cu N utilizatori și M înregistrări GameHistory,
+apoi măsoară fiecare rută (p50/p95/p99 și numărul de interogări SQL per request).
+
+Exemple:
+    python benchmarks/bench_routes.py --users 10000 --history 100000
+    python benchmarks/bench_routes.py --database-url postgresql://localhost/mario_bench --users 1000000 --history 10000000
+    python benchmarks/bench_routes.py --save-baseline benchmarks/baselines/sqlite-10k.json
+    python benchmarks/bench_routes.py --reseed --compare benchmarks/baselines/sqlite-10k.json --tolerance 0.25
+
+Rutele de scriere consumă cooldown-uri și recompense, deci o a doua rulare pe aceeași bază
+măsoară alte ramuri (ex. 400 la /claim-rewards); pentru comparații folosiți --reseed.
+
+În modul --compare scriptul iese cu cod 1 dacă o rută depășește p95 din baseline cu mai mult
+de --tolerance sau face mai multe interogări per request decât în baseline.
+
+Handler-ele de eroare ale aplicației răspund cu 200 la 404/500 (iar unele rute prind excepțiile și
+întorc un JSON de fallback), deci statusul HTTP nu ajunge: un request care loghează o eroare sau
+întoarce un astfel de payload e numărat ca eșec, iar scriptul iese cu cod 1 dacă o rută are eșecuri.
+Rutele HTML (HTML_ROUTES) au nevoie de template-uri: fără --template-folder și fără directorul
+templates/ al aplicației sunt sărite explicit, cu un mesaj pe stderr, în loc să fie măsurate ca erori.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (nume, metodă, path, body JSON)
+ROUTES = [
+    ('dashboard', 'GET', '/dashboard', None),
+    ('leaderboard', 'GET', '/leaderboard', None),
+    ('mining_status', 'GET', '/api/mining/status', None),
+    ('play_luck', 'POST', '/play/luck', None),
+    ('add_game_rewards', 'POST', '/api/add_game_rewards', {'game': 'memory', 'score': 100, 'rewards': 25}),
+    ('stake', 'POST', '/stake', {'amount': 1}),
+    ('claim_rewards', 'POST', '/claim-rewards', None),
+]
+HTML_ROUTES = {'dashboard', 'leaderboard'}
+GAME_TYPES = ('daily', 'luck', 'mining', 'memory', 'google_form', 'staking_rewards')
+SEED_CHUNK_SIZE = 50000
+# Valorile 'status' din payload-urile de fallback (not_found, server_error, dashboard_error)
+ERROR_STATUSES = ('error', 'not_found')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help='default: SQLite în directorul temporar')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--history', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=200, help='requests măsurate per rută')
+    parser.add_argument('--warmup', type=int, default=20, help='requests nemăsurate per rută')
+    parser.add_argument('--routes', default='', help='subset, ex: dashboard,leaderboard')
+    parser.add_argument('--template-folder', default=None, help='template-urile folosite de rutele HTML')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reseed', action='store_true', help='golește tabelele și repopulează')
+    parser.add_argument('--output', default=None, help='scrie rezultatele JSON aici')
+    parser.add_argument('--save-baseline', default=None, help='scrie rezultatele ca baseline')
+    parser.add_argument('--compare', default=None, help='compară cu un baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='regresie p95 acceptată (0.2 = 20%%)')
+    return parser.parse_args()
+
+
+def load_app(args):
+    """Import flask_app against the benchmark database (the app reads DATABASE_URL at import)"""
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(tempfile.gettempdir(), 'mariocoin-bench.db')}"
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    import flask_app
+    if args.template_folder:
+        flask_app.app.template_folder = os.path.abspath(args.template_folder)
+    return flask_app
+
+
+def seed(fa, users, history, rng, reseed=False):
+    """Bulk-insert `users` WebUser rows and `history` GameHistory rows (skipped when already seeded)"""
+    db, WebUser, GameHistory = fa.db, fa.WebUser, fa.GameHistory
+    if reseed:
+        db.session.execute(db.delete(GameHistory))
+        db.session.execute(db.delete(WebUser))
+        db.session.commit()
+    existing_users = db.session.scalar(db.select(db.func.count(WebUser.id)))
+    existing_history = db.session.scalar(db.select(db.func.count(GameHistory.id)))
+    now = datetime.utcnow()
+    started = time.perf_counter()
+
+    for offset in range(existing_users, users, SEED_CHUNK_SIZE):
+        rows = []
+        for i in range(offset, min(offset + SEED_CHUNK_SIZE, users)):
+            staked = rng.random() < 0.4
+            points = rng.randint(0, 50000)
+            rows.append({
+                'telegram_id': 10_000_000 + i,
+                'username': f'bench{i}',
+                'first_name': 'Bench',
+                'last_name': str(i),
+                'broscute_points': points,
+                'mario_tokens': 0,
+                'total_earned': points,
+                'staked_amount': rng.randint(100, 5000) if staked else 0,
+                'staking_start_date': now - timedelta(days=rng.randint(1, 60)) if staked else None,
+                'staking_rewards': 0,
+                'google_form_completed': False,
+                'distribution_completed': False,
+                'referral_count': 0,
+                'referral_rewards': 0,
+                'created_at': now - timedelta(days=rng.randint(0, 365)),
+                'updated_at': now,
+            })
+        db.session.execute(db.insert(WebUser), rows)
+        db.session.commit()
+
+    max_user_id = db.session.scalar(db.select(db.func.max(WebUser.id)))
+    min_user_id = db.session.scalar(db.select(db.func.min(WebUser.id)))
+    for offset in range(existing_history, history, SEED_CHUNK_SIZE):
+        rows = [{
+            'user_id': rng.randint(min_user_id, max_user_id),
+            'game_type': rng.choice(GAME_TYPES),
+            'broscute_earned': rng.randint(5, 100),
+            'created_at': now - timedelta(seconds=rng.randint(0, 90 * 86400)),
+        } for _ in range(offset, min(offset + SEED_CHUNK_SIZE, history))]
+        db.session.execute(db.insert(GameHistory), rows)
+        db.session.commit()
+
+    if existing_users < users or existing_history < history:
+        print(f"Seeded {users} users / {history} history rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a sorted list"""
+    return samples[max(0, math.ceil(q / 100 * len(samples)) - 1)]
+
+
+class ErrorLog(logging.Handler):
+    """Collect the ERROR records logged while a request runs"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.exc_info and record.exc_info[1] is not None:
+            message += f" ({type(record.exc_info[1]).__name__}: {record.exc_info[1]})"
+        self.messages.append(message)
+
+
+def request_error(response, error_log):
+    """Return why a response counts as failed (logged error, 5xx, error payload) or None"""
+    if error_log.messages:
+        return error_log.messages[0]
+    if response.status_code >= 500:
+        return f"HTTP {response.status_code}"
+    payload = response.get_json(silent=True) if response.is_json else None
+    status = payload.get('status') if isinstance(payload, dict) else None
+    if isinstance(status, str) and (status in ERROR_STATUSES or status.endswith('_error')):
+        return f"{status}: {payload.get('error_details') or payload.get('message')}"
+    return None
+
+
+def bench_route(client, user_ids, method, path, body, requests, warmup, counter, error_log):
+    """Time one route, rotating session users so guarded writes take their success path"""
+    timings, queries, statuses, errors = [], [], {}, []
+    for i in range(warmup + requests):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_ids[i % len(user_ids)]
+        counter[0] = 0
+        error_log.messages.clear()
+        started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        error = request_error(response, error_log)
+        response.close()
+        if i < warmup:
+            continue
+        if error:
+            errors.append(error)
+        timings.append(elapsed * 1000)
+        queries.append(counter[0])
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    timings.sort()
+    return {
+        'requests': requests,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'queries_per_request': round(statistics.fmean(queries), 2),
+        'max_queries': max(queries),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the list of regressions of `results` against `baseline`"""
+    regressions = []
+    for name, current in results['routes'].items():
+        previous = baseline['routes'].get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['queries_per_request'] > previous['queries_per_request']:
+            regressions.append(f"{name}: queries/request {previous['queries_per_request']} -> {current['queries_per_request']}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    fa = load_app(args)
+    rng = random.Random(args.seed)
+    routes = [route for route in ROUTES if not args.routes or route[0] in args.routes.split(',')]
+    if not os.path.isdir(os.path.join(fa.app.root_path, fa.app.template_folder)):
+        skipped = [route[0] for route in routes if route[0] in HTML_ROUTES]
+        if skipped:
+            print(f"Skipping HTML routes without templates (use --template-folder): {', '.join(skipped)}", file=sys.stderr)
+        routes = [route for route in routes if route[0] not in HTML_ROUTES]
+    if not routes:
+        sys.exit('No routes to benchmark')
+
+    counter = [0]
+
+    def count_statement(*_):
+        counter[0] += 1
+
+    with fa.app.app_context():
+        fa.run_migrations()
+        seed(fa, args.users, args.history, rng, reseed=args.reseed)
+        # Utilizatori cu staking, ca /claim-rewards să aibă recompense de revendicat
+        user_ids = fa.db.session.scalars(
+            fa.db.select(fa.WebUser.id).where(fa.WebUser.staked_amount > 0)
+            .order_by(fa.WebUser.id).limit((args.warmup + args.requests) * len(routes))
+        ).all()
+        dialect = fa.db.engine.dialect.name
+        fa.db.session.remove()
+    if not user_ids:
+        sys.exit('No seeded staking users; run with --users > 0')
+
+    fa.warm_up(fa.app)
+    fa.event.listen(fa.Engine, 'after_cursor_execute', count_statement)
+    error_log = ErrorLog()
+    logging.getLogger().addHandler(error_log)
+    client = fa.app.test_client()
+    results = {
+        'meta': {
+            'dialect': dialect,
+            'users': args.users,
+            'history': args.history,
+            'requests': args.requests,
+            'python': platform.python_version(),
+            'created_at': datetime.utcnow().isoformat(),
+        },
+        'routes': {},
+    }
+    for index, (name, method, path, body) in enumerate(routes):
+        # Fiecare rută primește alt set de utilizatori: cooldown-urile și claim-urile nu se suprapun
+        chunk = user_ids[index::len(routes)] or user_ids
+        results['routes'][name] = bench_route(client, chunk, method, path, body, args.requests, args.warmup,
+                                              counter, error_log)
+    fa.event.remove(fa.Engine, 'after_cursor_execute', count_statement)
+    logging.getLogger().removeHandler(error_log)
+
+    print(f"{'route':<18} {'p50':>9} {'p95':>9} {'p99':>9} {'queries':>8} {'errors':>7}  statuses")
+    for name, row in results['routes'].items():
+        print(f"{name:<18} {row['p50_ms']:>7.2f}ms {row['p95_ms']:>7.2f}ms {row['p99_ms']:>7.2f}ms "
+              f"{row['queries_per_request']:>8} {row['errors']:>7}  {row['statuses']}")
+    failed = {name: row for name, row in results['routes'].items() if row['errors']}
+    for name, row in failed.items():
+        print(f"ERROR {name}: {row['errors']} failed requests, first: {row['first_error']}", file=sys.stderr)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against baseline', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
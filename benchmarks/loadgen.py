@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Generator de trafic pentru MarioCoinAMG: pornește gunicorn local și rulează sesiuni de utilizator
+înregistrate cu mulți utilizatori virtuali concurenți.
+
+Raportează throughput, latența p50/p95/p99 pe fiecare pas, saturarea pool-ului de conexiuni
+(din /metrics) și anomaliile de tip lost update. Verificarea se face după oprirea serverului:
+pentru fiecare utilizator din pool, creșterea lui broscute_points + staked_amount și a lui
+total_earned trebuie să fie egală cu suma nouă din game_history. Metricile de pool există doar
+pe PostgreSQL (MeteredQueuePool); pe SQLite apar ca zero.
+
+Exemple:
+    python benchmarks/loadgen.py --vus 50 --duration 60 --workers 2 --threads 4
+    python benchmarks/loadgen.py --database-url postgresql://localhost/mario_load --vus 200 --user-pool 100
+    python benchmarks/loadgen.py --sessions recorded.json --output report.json
+
+Format pentru --sessions: o listă de sesiuni, fiecare o listă de pași
+    {"method": "POST", "path": "/play/luck", "json": null, "think_ms": 500}
+Șirul "{telegram_id}" din body este înlocuit cu ID-ul utilizatorului virtual.
+
+Scriptul iese cu cod 1 dacă găsește lost updates.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from sqlalchemy import bindparam, create_engine, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TELEGRAM_ID_BASE = 20_000_000
+
+# Sesiunea tipică: login din WebApp, câteva poll-uri de mining, jocuri, staking
+DEFAULT_SESSIONS = [[
+    {'method': 'POST', 'path': '/telegram_auth', 'json': {'telegram_id': '{telegram_id}', 'first_name': 'Load', 'last_name': 'Test'}, 'think_ms': 300},
+    {'method': 'GET', 'path': '/api/mining/status', 'think_ms': 1000},
+    {'method': 'GET', 'path': '/api/mining/status', 'think_ms': 1000},
+    {'method': 'POST', 'path': '/play/luck', 'think_ms': 500},
+    {'method': 'POST', 'path': '/play/daily', 'think_ms': 500},
+    {'method': 'POST', 'path': '/api/add_game_rewards', 'json': {'game': 'memory', 'score': 120, 'rewards': 15}, 'think_ms': 500},
+    {'method': 'POST', 'path': '/stake', 'json': {'amount': 10}, 'think_ms': 500},
+    {'method': 'GET', 'path': '/api/mining/status', 'think_ms': 1000},
+    {'method': 'POST', 'path': '/unstake', 'json': {'amount': 5}, 'think_ms': 500},
+    {'method': 'POST', 'path': '/claim-rewards', 'think_ms': 0},
+]]
+
+# Cu BALANCE_MODE=ledger (moștenit de server) soldul include creditele încă necompactate
+LEDGER_PENDING = ("(SELECT COALESCE(SUM(l.{column}), 0) FROM balance_ledger l WHERE l.user_id = u.id AND NOT l.compacted)"
+                  if os.environ.get('BALANCE_MODE') == 'ledger' else '0')
+BALANCE_QUERY = text(f"""
+    SELECT u.telegram_id,
+           COALESCE(u.broscute_points, 0) + COALESCE(u.staked_amount, 0) + {LEDGER_PENDING.format(column='amount')} AS holdings,
+           COALESCE(u.total_earned, 0) + {LEDGER_PENDING.format(column='earned')} AS total_earned,
+           (SELECT COALESCE(SUM(h.broscute_earned), 0) FROM game_history h WHERE h.user_id = u.id) AS history_sum
+    FROM web_users u
+    WHERE u.telegram_id IN :telegram_ids
+""").bindparams(bindparam('telegram_ids', expanding=True))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help='default: SQLite în directorul temporar')
+    parser.add_argument('--url', default=None, help='server deja pornit (nu se mai pornește gunicorn)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--vus', type=int, default=20, help='utilizatori virtuali concurenți')
+    parser.add_argument('--duration', type=float, default=30, help='secunde')
+    parser.add_argument('--user-pool', type=int, default=50,
+                        help='utilizatori Telegram distincți; sub --vus forțează scrieri concurente pe aceleași rânduri')
+    parser.add_argument('--think-scale', type=float, default=1.0, help='0 = fără pauze între pași')
+    parser.add_argument('--sessions', default=None, help='fișier JSON cu sesiuni înregistrate')
+    parser.add_argument('--admin-token', default=os.environ.get('ADMIN_TOKEN'), help='pentru /metrics pe un server extern')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', default=None, help='scrie raportul JSON aici')
+    return parser.parse_args()
+
+
+def substitute(value, telegram_id):
+    if value == '{telegram_id}':
+        return telegram_id
+    if isinstance(value, dict):
+        return {key: substitute(item, telegram_id) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, telegram_id) for item in value]
+    return value
+
+
+def percentile(samples, q):
+    """Nearest-rank percentile of a sorted list"""
+    return samples[max(0, math.ceil(q / 100 * len(samples)) - 1)]
+
+
+class Server:
+    """gunicorn started from gunicorn.conf.py against the load-test database"""
+
+    def __init__(self, args, database_url):
+        self.url = f"http://127.0.0.1:{args.port}"
+        self.metrics_dir = tempfile.mkdtemp(prefix='mariocoin-metrics-')
+        self.env = dict(
+            os.environ,
+            DATABASE_URL=database_url,
+            PORT=str(args.port),
+            WEB_CONCURRENCY=str(args.workers),
+            GUNICORN_THREADS=str(args.threads),
+            PROMETHEUS_MULTIPROC_DIR=self.metrics_dir,
+            METRICS_PUBLIC='1',
+            LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+        )
+        self.process = None
+
+    def migrate(self):
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'flask_app', 'db-upgrade'],
+                       cwd=ROOT, env=self.env, check=True, stdout=subprocess.DEVNULL)
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'flask_app:app'],
+                                        cwd=ROOT, env=self.env)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(f"{self.url}/ping", timeout=1).ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        sys.exit('gunicorn did not answer /ping within 30s')
+
+    def stop(self):
+        # SIGTERM: workerii golesc buffer-ul de istoric (worker_exit) înainte de verificarea finală
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=60)
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+
+class PoolSampler(threading.Thread):
+    """Scrape /metrics every second and keep pool and in-flight peaks"""
+
+    def __init__(self, url, headers):
+        super().__init__(daemon=True)
+        self.url = url
+        self.headers = headers
+        self.stop_event = threading.Event()
+        self.samples = []
+
+    @staticmethod
+    def parse(payload):
+        values = defaultdict(float)
+        for line in payload.splitlines():
+            if line.startswith('#') or not line:
+                continue
+            name, _, value = line.rpartition(' ')
+            metric = name.split('{', 1)[0]
+            if metric in ('db_pool_size', 'db_pool_checked_out', 'db_pool_overflow', 'http_requests_in_flight',
+                          'db_pool_checkout_wait_seconds_sum', 'db_pool_checkout_wait_seconds_count'):
+                values[metric] += float(value)
+        return values
+
+    def run(self):
+        while not self.stop_event.wait(1):
+            try:
+                response = requests.get(f"{self.url}/metrics", headers=self.headers, timeout=2)
+                if response.ok:
+                    self.samples.append(self.parse(response.text))
+            except requests.RequestException:
+                pass
+
+    def report(self):
+        if not self.samples:
+            return {'available': False}
+        first, last = self.samples[0], self.samples[-1]
+        waits = last['db_pool_checkout_wait_seconds_count'] - first['db_pool_checkout_wait_seconds_count']
+        wait_sum = last['db_pool_checkout_wait_seconds_sum'] - first['db_pool_checkout_wait_seconds_sum']
+        return {
+            'available': True,
+            'pool_size': max(sample['db_pool_size'] for sample in self.samples),
+            'max_checked_out': max(sample['db_pool_checked_out'] for sample in self.samples),
+            'max_overflow': max(sample['db_pool_overflow'] for sample in self.samples),
+            'max_in_flight': max(sample['http_requests_in_flight'] for sample in self.samples),
+            'mean_checkout_wait_ms': round(wait_sum / waits * 1000, 3) if waits else 0.0,
+        }
+
+
+def virtual_user(base_url, sessions, telegram_ids, deadline, think_scale, seed, results, lock):
+    rng = random.Random(seed)
+    local = defaultdict(list)
+    errors = defaultdict(int)
+    while time.monotonic() < deadline:
+        telegram_id = rng.choice(telegram_ids)
+        client = requests.Session()
+        for step in rng.choice(sessions):
+            if time.monotonic() >= deadline:
+                break
+            key = f"{step['method']} {step['path']}"
+            started = time.perf_counter()
+            try:
+                response = client.request(step['method'], base_url + step['path'],
+                                          json=substitute(step.get('json'), telegram_id), timeout=30)
+                status = response.status_code
+            except requests.RequestException:
+                status = 'error'
+            local[key].append((time.perf_counter() - started) * 1000)
+            if status == 'error' or status >= 500:
+                errors[key] += 1
+            time.sleep(step.get('think_ms', 0) / 1000 * think_scale)
+        client.close()
+    with lock:
+        for key, timings in local.items():
+            results['timings'][key].extend(timings)
+        for key, count in errors.items():
+            results['errors'][key] += count
+
+
+def snapshot_balances(engine, telegram_ids):
+    with engine.connect() as connection:
+        return {row.telegram_id: row for row in connection.execute(BALANCE_QUERY, {'telegram_ids': telegram_ids})}
+
+
+def find_lost_updates(before, after):
+    """Users whose balance or total_earned moved differently from their new GameHistory rows"""
+    anomalies = []
+    for telegram_id, end in after.items():
+        start = before.get(telegram_id)
+        if start is None:
+            continue
+        history_delta = end.history_sum - start.history_sum
+        holdings_delta = end.holdings - start.holdings
+        earned_delta = end.total_earned - start.total_earned
+        if holdings_delta != history_delta or earned_delta != history_delta:
+            anomalies.append({'telegram_id': telegram_id, 'history_delta': history_delta,
+                              'holdings_delta': holdings_delta, 'total_earned_delta': earned_delta})
+    return anomalies
+
+
+def main():
+    args = parse_args()
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.gettempdir(), 'mariocoin-load.db')}"
+    sessions = DEFAULT_SESSIONS
+    if args.sessions:
+        with open(args.sessions) as f:
+            sessions = json.load(f)
+    telegram_ids = [TELEGRAM_ID_BASE + i for i in range(args.user_pool)]
+
+    server = None
+    base_url = args.url
+    headers = {'Authorization': f"Bearer {args.admin_token}"} if args.admin_token else {}
+    if base_url is None:
+        server = Server(args, database_url)
+        server.migrate()
+        server.start()
+        base_url = server.url
+
+    # Utilizatorii din pool se creează înainte de test, ca bonusul de înregistrare să nu intre în verificare
+    for telegram_id in telegram_ids:
+        requests.post(f"{base_url}/telegram_auth", json={'telegram_id': telegram_id, 'first_name': 'Load'}, timeout=30)
+    engine = create_engine(database_url)
+    before = snapshot_balances(engine, telegram_ids)
+
+    results = {'timings': defaultdict(list), 'errors': defaultdict(int)}
+    lock = threading.Lock()
+    sampler = PoolSampler(base_url, headers)
+    sampler.start()
+    started = time.monotonic()
+    deadline = started + args.duration
+    users = [
+        threading.Thread(target=virtual_user, args=(base_url, sessions, telegram_ids, deadline,
+                                                    args.think_scale, args.seed + i, results, lock))
+        for i in range(args.vus)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - started
+    sampler.stop_event.set()
+    sampler.join()
+
+    if server is not None:
+        server.stop()
+    anomalies = find_lost_updates(before, snapshot_balances(engine, telegram_ids))
+
+    total = sum(len(timings) for timings in results['timings'].values())
+    report = {
+        'config': {'vus': args.vus, 'duration_s': args.duration, 'workers': args.workers, 'threads': args.threads,
+                   'user_pool': args.user_pool, 'database': engine.dialect.name},
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 1),
+        'steps': {},
+        'pool': sampler.report(),
+        'lost_updates': anomalies,
+    }
+    for key, timings in sorted(results['timings'].items()):
+        timings.sort()
+        report['steps'][key] = {
+            'requests': len(timings),
+            'errors': results['errors'].get(key, 0),
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'p99_ms': round(percentile(timings, 99), 2),
+        }
+
+    print(f"{total} requests in {elapsed:.1f}s = {report['throughput_rps']} req/s "
+          f"({args.vus} VUs, {args.workers} workers x {args.threads} threads)")
+    print(f"{'step':<28} {'n':>7} {'err':>5} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for key, row in report['steps'].items():
+        print(f"{key:<28} {row['requests']:>7} {row['errors']:>5} {row['p50_ms']:>7.1f}ms {row['p95_ms']:>7.1f}ms {row['p99_ms']:>7.1f}ms")
+    print(f"pool: {report['pool']}")
+    print(f"lost updates: {len(anomalies)} of {len(before)} users")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if anomalies:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,19 +15,48 @@ FUNCȚII INCLUSE:
 - Keep-alive system pentru Render gratuit 24/7
 - Webhook integration pentru răspuns instant Telegram
 """
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import os
 import logging
+import logging.handlers
 import sys
-from flask import Flask, jsonify, request, render_template, session, redirect, url_for, flash
+from flask import Flask, Blueprint, jsonify, request, render_template, session, redirect, url_for, flash, current_app, g, Response, stream_with_context
+import click
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import DeclarativeBase
-from datetime import datetime, timedelta
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy.orm import DeclarativeBase, load_only
+from sqlalchemy.orm.attributes import set_committed_value
+from datetime import datetime, timedelta, timezone
 import hashlib
 import hmac
+import re
+import base64
+import csv
+import io
+import zlib
 import urllib.parse
 import requests
+import requests.adapters
 import json
 import random
+import threading
+import heapq
+import contextvars
+import gc
+import copy
+import secrets
+import functools
+import atexit
+import queue
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
 # Force production environment when PORT is set
 if os.environ.get("PORT"):
@@ -35,31 +64,321 @@ if os.environ.get("PORT"):
     os.environ["PYTHONUNBUFFERED"] = "1"
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Thread-urile de request randează mesajul (msg % args) și pun record-ul într-o coadă;
+# formatarea JSON și scrierea pe stdout se fac într-un singur thread (QueueListener). Dacă stdout e lent și coada se umple,
+# record-urile se pierd în loc să blocheze request-ul.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json sau text
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# Sampling per rută pentru logul de request, ex: "/api/mining/status=0.01,/dashboard=0.5"
+LOG_SAMPLE_RATES = {
+    route.strip(): float(rate)
+    for route, _, rate in (item.partition('=') for item in os.environ.get("LOG_SAMPLE_RATES", "/api/mining/status=0.01").split(',') if '=' in item)
+}
+LOG_SAMPLE_DEFAULT = float(os.environ.get("LOG_SAMPLE_DEFAULT", 1))
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra= fields are kept as top-level keys"""
+
+    def format(self, record):
+        payload = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload['exc'] = record.exc_text
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that renders the message in the caller, writes it from the listener and drops records when the queue is full"""
+
+    dropped = 0
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # msg % args și traceback-ul se randează aici: argumentele mutabile (ex. STARTUP_TIMINGS)
+        # ar putea fi modificate până ajunge record-ul în thread-ul listener-ului
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+def _log_output_handler():
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return output
+
+def start_log_listener():
+    """(Re)create the log queue and its listener thread; called at import and after fork"""
+    global _log_listener
+    _log_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _log_listener = logging.handlers.QueueListener(_log_handler.queue, _log_output, respect_handler_level=True)
+    _log_listener.start()
+
+def stop_log_listener():
+    if _log_listener is not None and _log_listener._thread is not None:
+        _log_listener.stop()
+
+def request_log_sampled(route, default=LOG_SAMPLE_DEFAULT):
+    rate = LOG_SAMPLE_RATES.get(route, default)
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+_log_output = _log_output_handler()
+_log_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+_log_listener = None
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler], force=True)
+start_log_listener()
+# Thread-ul listener-ului nu supraviețuiește fork-ului (gunicorn preload): coadă nouă în copil
+os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(stop_log_listener)
 logger = logging.getLogger(__name__)
 
 class Base(DeclarativeBase):
     pass
 
-# Create Flask application
-app = Flask(__name__)
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "mariocoin-deployment-secret")
+# Rutele se înregistrează pe blueprint; aplicația se construiește în create_app()
+bp = Blueprint('main', __name__, cli_group=None)
 
-# Database configuration
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    'pool_pre_ping': True,
-    "pool_recycle": 300,
-}
+# Database extension, bound to the app in create_app() (no connection is opened at import)
+db = SQLAlchemy(model_class=Base)
+
+# Startup timing report (ms): import, config, pool, templates, caches, first_request
+STARTUP_TIMINGS = {}
+WARMUP_POOL_CONNECTIONS = int(os.environ.get("WARMUP_POOL_CONNECTIONS", 2))
+
+# Metrics (Prometheus)
+# Sub gunicorn, PROMETHEUS_MULTIPROC_DIR (setat în gunicorn.conf.py) face ca fiecare worker să
+# scrie valorile în fișiere mmap din acel director; /metrics le agregă pe toate la scrape.
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "0") == "1"  # altfel /metrics cere ADMIN_TOKEN
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'}
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests', ['method', 'endpoint', 'status'])
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['method', 'endpoint'], buckets=LATENCY_BUCKETS)
+HTTP_RESPONSE_SIZE = Histogram('http_response_size_bytes', 'HTTP response body size', ['endpoint'],
+                               buckets=(100, 1000, 5000, 20000, 100000, 500000, 2000000))
+HTTP_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being served', ['endpoint'], multiprocess_mode='livesum')
+DB_QUERIES = Counter('db_queries_total', 'SQL statements executed', ['operation'])
+DB_QUERY_LATENCY = Histogram('db_query_duration_seconds', 'SQL statement latency', ['operation'], buckets=LATENCY_BUCKETS)
+DB_QUERY_ERRORS = Counter('db_query_errors_total', 'SQL statements that raised')
+DB_POOL_WAIT = Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection', buckets=LATENCY_BUCKETS)
+DB_POOL_SIZE = Gauge('db_pool_size', 'Configured pool size', multiprocess_mode='livesum')
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections currently checked out', multiprocess_mode='livesum')
+DB_POOL_OVERFLOW = Gauge('db_pool_overflow', 'Connections open beyond pool_size', multiprocess_mode='livesum')
+GAME_EVENTS = Counter('game_events_total', 'Balance changes recorded with a game_type', ['game_type'])
+GAME_REWARDS = Counter('game_rewards_broscute_total', 'Broscute credited by game_type', ['game_type'])
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records checkout wait time and its size/checked-out/overflow gauges"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started)
+            self._record_state()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._record_state()
+
+    def _record_state(self):
+        DB_POOL_SIZE.set(self.size())
+        DB_POOL_CHECKED_OUT.set(self.checkedout())
+        DB_POOL_OVERFLOW.set(max(self.overflow(), 0))
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _metrics_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _metrics_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    operation = statement.lstrip()[:6].upper()
+    operation = operation if operation in SQL_OPERATIONS else ('WITH' if operation.startswith('WITH') else 'OTHER')
+    DB_QUERIES.labels(operation).inc()
+    DB_QUERY_LATENCY.labels(operation).observe(elapsed)
+    profile = _active_sql_profile.get()
+    if profile is not None:
+        profile.record(statement, parameters, executemany, elapsed, cursor.rowcount)
+
+@event.listens_for(Engine, 'handle_error')
+def _metrics_handle_error(context):
+    DB_QUERY_ERRORS.inc()
+    started = context.connection.info.get('query_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+def record_game_metrics(game_type, amount):
+    GAME_EVENTS.labels(game_type).inc()
+    if amount > 0:
+        GAME_REWARDS.labels(game_type).inc(amount)
+
+def metrics_payload():
+    """Prometheus text exposition, aggregated across workers in multiprocess mode"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+@bp.before_app_request
+def start_request_metrics():
+    endpoint = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    g.metrics = (endpoint, time.perf_counter())
+    HTTP_IN_FLIGHT.labels(endpoint).inc()
+
+@bp.after_app_request
+def record_request_metrics(response):
+    if 'metrics' in g:
+        endpoint, started = g.metrics
+        HTTP_REQUESTS.labels(request.method, endpoint, response.status_code).inc()
+        HTTP_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - started)
+        size = response.calculate_content_length()
+        if size is not None:
+            HTTP_RESPONSE_SIZE.labels(endpoint).observe(size)
+    return response
+
+@bp.teardown_app_request
+def finish_request_metrics(exc):
+    metrics = g.pop('metrics', None)
+    if metrics is not None:
+        HTTP_IN_FLIGHT.labels(metrics[0]).dec()
+
+# SQL profiler
+# Opt-in: SQL_PROFILE=1 profilează toate request-urile, altfel header-ul X-SQL-Profile: 1 împreună
+# cu ADMIN_TOKEN. Rezumatul apare în X-SQL-Profile / Server-Timing, detaliile la
+# /debug/sql-profile/<id> (păstrate în memoria worker-ului care a servit request-ul).
+SQL_PROFILE = os.environ.get("SQL_PROFILE", "0") == "1"
+SQL_PROFILE_SLOW_MS = float(os.environ.get("SQL_PROFILE_SLOW_MS", 50))
+SQL_PROFILE_REPEAT_THRESHOLD = int(os.environ.get("SQL_PROFILE_REPEAT_THRESHOLD", 3))
+SQL_PROFILE_KEEP = int(os.environ.get("SQL_PROFILE_KEEP", 200))
+
+_active_sql_profile = contextvars.ContextVar('sql_profile', default=None)
+
+class SqlProfile:
+    """Statements issued while serving one request"""
+
+    def __init__(self, method, route):
+        self.id = secrets.token_hex(8)
+        self.method = method
+        self.route = route
+        self.created_at = datetime.utcnow()
+        self.statements = []
+
+    @staticmethod
+    def _params_shape(parameters, executemany):
+        if executemany:
+            return {'executemany': len(parameters)}
+        if isinstance(parameters, dict):
+            return sorted(parameters)
+        return len(parameters or ())
+
+    def record(self, statement, parameters, executemany, elapsed, rowcount):
+        self.statements.append({
+            'statement': statement,
+            'params': self._params_shape(parameters, executemany),
+            'duration_ms': round(elapsed * 1000, 3),
+            'rowcount': rowcount
+        })
+
+    def summary(self):
+        counts = {}
+        for entry in self.statements:
+            counts[entry['statement']] = counts.get(entry['statement'], 0) + 1
+        return {
+            'queries': len(self.statements),
+            'total_ms': round(sum(entry['duration_ms'] for entry in self.statements), 3),
+            'repeated': [
+                {'statement': statement, 'count': count}
+                for statement, count in counts.items() if count >= SQL_PROFILE_REPEAT_THRESHOLD
+            ],
+            'slow': [entry for entry in self.statements if entry['duration_ms'] >= SQL_PROFILE_SLOW_MS]
+        }
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'route': self.route,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'summary': self.summary(),
+            'statements': self.statements
+        }
+
+_sql_profiles = OrderedDict()
+_sql_profiles_lock = threading.Lock()
+
+def store_sql_profile(profile):
+    with _sql_profiles_lock:
+        _sql_profiles[profile.id] = profile
+        while len(_sql_profiles) > SQL_PROFILE_KEEP:
+            _sql_profiles.popitem(last=False)
 
-db = SQLAlchemy(app, model_class=Base)
+def get_sql_profile(profile_id):
+    with _sql_profiles_lock:
+        return _sql_profiles.get(profile_id)
+
+@bp.before_app_request
+def start_sql_profile():
+    if SQL_PROFILE or (request.headers.get('X-SQL-Profile') == '1' and admin_authorized()):
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g.sql_profile_token = _active_sql_profile.set(SqlProfile(request.method, route))
+
+@bp.after_app_request
+def finish_sql_profile(response):
+    profile = _active_sql_profile.get()
+    if profile is None:
+        return response
+    summary = profile.summary()
+    store_sql_profile(profile)
+    response.headers['X-SQL-Profile'] = (
+        f"id={profile.id}; queries={summary['queries']}; total_ms={summary['total_ms']}; "
+        f"repeated={len(summary['repeated'])}; slow={len(summary['slow'])}"
+    )
+    response.headers['X-SQL-Profile-Url'] = url_for('main.sql_profile_detail', profile_id=profile.id)
+    response.headers.add('Server-Timing', f'db;dur={summary["total_ms"]};desc="{summary["queries"]} queries"')
+    if summary['repeated'] or summary['slow']:
+        logger.warning("SQL profile %s %s: %s queries, %s repeated, %s slow (%s)", profile.method, profile.route,
+                       summary['queries'], len(summary['repeated']), len(summary['slow']), profile.id)
+    return response
+
+@bp.teardown_app_request
+def reset_sql_profile(exc):
+    token = g.pop('sql_profile_token', None)
+    if token is not None:
+        _active_sql_profile.reset(token)
 
 # Telegram Bot Token for authentication
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+# Secret trimis de Telegram în X-Telegram-Bot-Api-Secret-Token (setWebhook secret_token)
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+
+# Public links used in bot replies
+WEBAPP_URL = os.environ.get("WEBAPP_URL", os.environ.get("RENDER_EXTERNAL_URL", "")).rstrip('/')
+GOOGLE_FORM_URL = os.environ.get("GOOGLE_FORM_URL", "")
 
 # MARIO Token Configuration pentru GitHub Deployment
 MARIO_TOKEN_CONTRACT = "EmCyM99NzMErfSoQhx6hgPo7qNTdeF2eDmdqiEy8pump"
@@ -97,6 +416,9 @@ class WebUser(db.Model):
     last_daily_game = db.Column(db.DateTime, nullable=True)
     last_luck_game = db.Column(db.DateTime, nullable=True)
     
+    # Mining (separat de jocul zilnic, ca /play/daily să nu deschidă o sesiune de mining)
+    mining_started_at = db.Column(db.DateTime, nullable=True)
+    
     # Referral system
     referral_code = db.Column(db.String(20), unique=True, nullable=True)
     referred_by = db.Column(db.Integer, db.ForeignKey('web_users.id'), nullable=True)
@@ -115,6 +437,52 @@ class GameHistory(db.Model):
     broscute_earned = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+db.Index('ix_game_history_user_id_created_at', GameHistory.user_id, GameHistory.created_at)
+db.Index('ix_game_history_created_at', GameHistory.created_at)
+db.Index('ix_web_users_broscute_points_positive', WebUser.broscute_points.desc(),
+         postgresql_where=WebUser.broscute_points > 0, sqlite_where=WebUser.broscute_points > 0)
+db.Index('ix_web_users_mining_started_at', WebUser.mining_started_at,
+         postgresql_where=WebUser.mining_started_at.isnot(None), sqlite_where=WebUser.mining_started_at.isnot(None))
+db.Index('ix_web_users_referred_by', WebUser.referred_by,
+         postgresql_where=WebUser.referred_by.isnot(None), sqlite_where=WebUser.referred_by.isnot(None))
+db.Index('ix_web_users_updated_at', WebUser.updated_at)
+
+class AnalyticsSnapshot(db.Model):
+    __tablename__ = 'analytics_snapshot'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    total_users = db.Column(db.Integer, default=0)
+    total_broscute = db.Column(db.BigInteger, default=0)
+    total_mario = db.Column(db.BigInteger, default=0)
+    active_users = db.Column(db.Integer, default=0)
+    recent_activity = db.Column(db.Integer, default=0)
+    
+    # Freshness: updated_at = ultima deltă aplicată, reconciled_at = ultima recalculare completă
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    reconciled_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BroadcastJob(db.Model):
+    __tablename__ = 'broadcast_jobs'
+    
+    name = db.Column(db.String(100), primary_key=True)
+    message = db.Column(db.Text, nullable=False)
+    last_user_id = db.Column(db.Integer, default=0, nullable=False)  # checkpoint
+    sent = db.Column(db.Integer, default=0, nullable=False)
+    failed = db.Column(db.Integer, default=0, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class StakingEpoch(db.Model):
+    __tablename__ = 'staking_epochs'
+    
+    epoch = db.Column(db.Integer, primary_key=True)
+    stakers = db.Column(db.Integer, default=0)
+    total_staked = db.Column(db.BigInteger, default=0)
+    total_accrued = db.Column(db.BigInteger, default=0)
+    total_liability = db.Column(db.BigInteger, default=0)
+    settled_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # Helper functions
 def calculate_staking_rewards(user):
     """Calculate total staking rewards for user"""
@@ -137,26 +505,2163 @@ def can_play_luck_game(user):
         return True
     return (datetime.utcnow() - user.last_luck_game).total_seconds() >= 300  # 5 minutes
 
-# Create database tables
-with app.app_context():
+# SQL counterparts of the checks above, used as guards in conditional UPDATEs
+def daily_game_available(now):
+    return db.or_(WebUser.last_daily_game.is_(None), WebUser.last_daily_game <= now - timedelta(days=1))
+
+def luck_game_available(now):
+    return db.or_(WebUser.last_luck_game.is_(None), WebUser.last_luck_game <= now - timedelta(seconds=300))
+
+def mining_session_matured(now):
+    return db.and_(WebUser.mining_started_at.isnot(None), WebUser.mining_started_at <= now - timedelta(seconds=86400))
+
+def staking_rewards_accrued(now, dialect):
+    """calculate_staking_rewards as a SQL expression (same float math, whole days, truncated)"""
+    if dialect == 'postgresql':
+        days = db.func.floor(db.extract('epoch', db.literal(now) - WebUser.staking_start_date) / 86400)
+        accrued = db.cast(db.func.floor(WebUser.staked_amount * db.literal(0.01, db.Float) * days), db.Integer)
+    else:
+        seconds = (db.cast(db.func.strftime('%s', db.literal(now)), db.Integer)
+                   - db.cast(db.func.strftime('%s', WebUser.staking_start_date), db.Integer))
+        accrued = db.cast(WebUser.staked_amount * db.literal(0.01, db.Float) * (seconds // 86400), db.Integer)
+    return db.case(
+        (db.and_(WebUser.staking_start_date.isnot(None), WebUser.staked_amount > 0), accrued), else_=0
+    )
+
+# Leaderboard rank index
+# Arbore ordonat (treap cu dimensiuni pe subarbori), ~300 B per utilizator cu sold pozitiv.
+# Cheia este (-broscute_points, user_id), deci rangul 1 este cel mai bogat utilizator.
+# Sub gunicorn cu preload_app se construiește o singură dată, în master (build_shared_caches),
+# și e moștenit copy-on-write de workeri; fără preload fiecare worker îl construiește în fundal.
+# Apoi scrierile proprii îl actualizează direct, iar cele din alți workeri sunt preluate la
+# LEADERBOARD_SYNC_SECONDS din rândurile cu updated_at recent (index pe updated_at), fără
+# scanarea web_users. Rebuild complet periodic doar opt-in.
+LEADERBOARD_SYNC_SECONDS = float(os.environ.get("LEADERBOARD_SYNC_SECONDS", 10))
+LEADERBOARD_SYNC_OVERLAP_SECONDS = 5  # tranzacții comise după momentul în care și-au setat updated_at
+LEADERBOARD_RESYNC_SECONDS = int(os.environ.get("LEADERBOARD_RESYNC_SECONDS", 0))  # 0 = dezactivat
+
+class _RankNode:
+    __slots__ = ('key', 'priority', 'size', 'left', 'right')
+
+    def __init__(self, key, priority=None):
+        self.key = key
+        self.priority = random.random() if priority is None else priority
+        self.size = 1
+        self.left = None
+        self.right = None
+
+def _rank_size(node):
+    return node.size if node else 0
+
+def _rank_update(node):
+    node.size = 1 + _rank_size(node.left) + _rank_size(node.right)
+    return node
+
+def _rank_split(node, key):
+    """Split into (keys < key, keys >= key)"""
+    if node is None:
+        return None, None
+    if node.key < key:
+        left, right = _rank_split(node.right, key)
+        node.right = left
+        return _rank_update(node), right
+    left, right = _rank_split(node.left, key)
+    node.left = right
+    return left, _rank_update(node)
+
+def _rank_merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _rank_merge(left.right, right)
+        return _rank_update(left)
+    right.left = _rank_merge(left, right.left)
+    return _rank_update(right)
+
+class LeaderboardIndex:
+    """Incrementally maintained rank index over broscute_points > 0"""
+
+    def __init__(self, sync_seconds=LEADERBOARD_SYNC_SECONDS, resync_seconds=LEADERBOARD_RESYNC_SECONDS):
+        self.sync_seconds = sync_seconds
+        self.resync_seconds = resync_seconds
+        self._root = None
+        self._points = {}
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self._built_at = None
+        self._rebuild_requested = False
+        self._synced_until = None  # updated_at de la care reia următorul sync
+        self._ledger_id = 0
+        self._thread = None
+
+    def __len__(self):
+        return _rank_size(self._root)
+
+    def update(self, user_id, points):
+        """Record the new balance of a user - O(log n)"""
+        points = points or 0
+        with self._lock:
+            old = self._points.get(user_id)
+            if old == points or (old is None and points <= 0):
+                return
+            if old is not None:
+                left, rest = _rank_split(self._root, (-old, user_id))
+                _, right = _rank_split(rest, (-old, user_id + 1))
+                self._root = _rank_merge(left, right)
+                del self._points[user_id]
+            if points > 0:
+                key = (-points, user_id)
+                left, right = _rank_split(self._root, key)
+                self._root = _rank_merge(_rank_merge(left, _RankNode(key)), right)
+                self._points[user_id] = points
+
+    def rank(self, user_id):
+        """Return 1-based rank of user or None if user has no points - O(log n)"""
+        with self._lock:
+            points = self._points.get(user_id)
+            if points is None:
+                return None
+            key = (-points, user_id)
+            node, before = self._root, 0
+            while node is not None:
+                if node.key < key:
+                    before += _rank_size(node.left) + 1
+                    node = node.right
+                elif node.key > key:
+                    node = node.left
+                else:
+                    return before + _rank_size(node.left) + 1
+            return None
+
+    def top(self, limit=20):
+        """Return [(user_id, points)] for the first `limit` ranks - O(log n + limit)"""
+        result, stack = [], []
+        with self._lock:
+            node = self._root
+            while (stack or node is not None) and len(result) < limit:
+                if node is not None:
+                    stack.append(node)
+                    node = node.left
+                else:
+                    node = stack.pop()
+                    result.append((node.key[1], -node.key[0]))
+                    node = node.right
+        return result
+
+    def load(self, rows):
+        """Replace the index with (user_id, points) rows - O(n log n) sort, O(n) build"""
+        keys = sorted((-points, user_id) for user_id, points in rows if points and points > 0)
+        priorities = sorted((random.random() for _ in keys), reverse=True)
+        nodes = [_RankNode(key) for key in keys]
+        # Arbore echilibrat; prioritățile sunt atribuite pe niveluri ca să respecte proprietatea de heap
+        levels = []
+
+        def build(lo, hi, depth):
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(node)
+            node.left = build(lo, mid, depth + 1)
+            node.right = build(mid + 1, hi, depth + 1)
+            return _rank_update(node)
+
+        root = build(0, len(nodes), 0)
+        position = 0
+        for level in levels:
+            for node in level:
+                node.priority = priorities[position]
+                position += 1
+        with self._lock:
+            self._root = root
+            self._points = {user_id: -neg for neg, user_id in keys}
+            self._built_at = time.monotonic()
+
+    def mark_stale(self):
+        """Force a full rebuild on the next sync (after bulk balance changes)"""
+        self._rebuild_requested = True
+
+    def rebuild(self, force=True):
+        """Reload the whole index from web_users (first use, mark_stale, opt-in resync)"""
+        with self._rebuild_lock:
+            if not force and self._built_at is not None:
+                return
+            synced_until = datetime.utcnow()
+            ledger_id = self._max_ledger_id()
+            rows = db.session.query(WebUser.id, WebUser.broscute_points).filter(
+                WebUser.broscute_points > 0
+            ).all()
+            if ledger_mode():
+                balances = dict(rows)
+                for user_id, amount in ledger_pending_totals().items():
+                    balances[user_id] = balances.get(user_id, 0) + amount
+                rows = list(balances.items())
+            self.load(rows)
+            self._rebuild_requested = False
+            self._synced_until, self._ledger_id = synced_until, ledger_id
+            logger.info("Leaderboard index rebuilt with %s users", len(rows))
+
+    def sync(self):
+        """Apply balances changed since the last sync (other workers' writes); return the number of rows read"""
+        with self._rebuild_lock:
+            synced_until = datetime.utcnow()
+            ledger_id = self._max_ledger_id()
+            changed = WebUser.updated_at >= self._synced_until - timedelta(seconds=LEADERBOARD_SYNC_OVERLAP_SECONDS)
+            if ledger_id > self._ledger_id:
+                # Creditele din ledger nu ating updated_at
+                changed = db.or_(changed, WebUser.id.in_(db.select(BalanceLedger.user_id).where(
+                    BalanceLedger.id > self._ledger_id, BalanceLedger.id <= ledger_id
+                )))
+            rows = db.session.execute(
+                db.select(WebUser.id, balance_expression().label('broscute_points')).where(changed)
+            ).all()
+            for user_id, points in rows:
+                self.update(user_id, points)
+            self._synced_until, self._ledger_id = synced_until, ledger_id
+            return len(rows)
+
+    @staticmethod
+    def _max_ledger_id():
+        if not ledger_mode():
+            return 0
+        return db.session.scalar(db.select(db.func.max(BalanceLedger.id))) or 0
+
+    def ensure_fresh(self):
+        """Build the index on first use; later changes arrive through update() and the sync thread"""
+        if self._built_at is None:
+            self.start(current_app._get_current_object())
+            self.rebuild(force=False)
+
+    def start(self, flask_app):
+        """Start the sync thread once per worker; it also builds the index if no request did yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(flask_app,), name='leaderboard-sync', daemon=True)
+            self._thread.start()
+
+    def _run(self, flask_app):
+        while True:
+            with flask_app.app_context():
+                try:
+                    resync_due = self.resync_seconds > 0 and self._built_at is not None and \
+                        time.monotonic() - self._built_at >= self.resync_seconds
+                    if self._built_at is None:
+                        self.rebuild(force=False)
+                    elif self._rebuild_requested or resync_due:
+                        self.rebuild()
+                    else:
+                        self.sync()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("Leaderboard sync error: %s", e)
+                finally:
+                    db.session.remove()
+            time.sleep(self.sync_seconds)
+
+leaderboard_index = LeaderboardIndex()
+
+# Analytics rollups
+# Scrierile adună delte în memoria worker-ului; thread-ul de fundal le aplică pe rândul unic
+# analytics_snapshot la fiecare ANALYTICS_FLUSH_SECONDS (niciodată din request), iar reconcilierea
+# periodică recalculează totul exact (inclusiv fereastra glisantă de 7 zile).
+ANALYTICS_FLUSH_SECONDS = int(os.environ.get("ANALYTICS_FLUSH_SECONDS", 5))
+ANALYTICS_RECONCILE_SECONDS = int(os.environ.get("ANALYTICS_RECONCILE_SECONDS", 900))
+ANALYTICS_SNAPSHOT_ID = 1
+
+class AnalyticsRollup:
+    """Per-worker accumulator of analytics counter deltas"""
+
+    FIELDS = ('total_users', 'total_broscute', 'total_mario', 'active_users', 'recent_activity')
+
+    def __init__(self):
+        self._pending = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def record(self, **deltas):
+        """Add deltas; the background thread writes them"""
+        with self._lock:
+            for field, delta in deltas.items():
+                self._pending[field] += delta
+
+    def flush(self):
+        """Apply pending deltas to the snapshot row in one UPDATE; put them back if it fails"""
+        with self._lock:
+            pending = {field: delta for field, delta in self._pending.items() if delta}
+            self._pending = dict.fromkeys(self.FIELDS, 0)
+        if not pending:
+            return
+        values = {field: getattr(AnalyticsSnapshot, field) + delta for field, delta in pending.items()}
+        values['updated_at'] = datetime.utcnow()
+        try:
+            db.session.execute(
+                db.update(AnalyticsSnapshot)
+                .where(AnalyticsSnapshot.id == ANALYTICS_SNAPSHOT_ID)
+                .values(**values)
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            with self._lock:
+                for field, delta in pending.items():
+                    self._pending[field] += delta
+            logger.error("Error flushing analytics rollup: %s", e)
+
+analytics_rollup = AnalyticsRollup()
+
+def reconcile_analytics():
+    """Recompute the analytics snapshot from the source tables"""
+    now = datetime.utcnow()
+    values = {
+        'total_users': db.session.query(db.func.count(WebUser.id)).scalar() or 0,
+        'total_broscute': db.session.query(db.func.sum(WebUser.broscute_points)).scalar() or 0,
+        'total_mario': db.session.query(db.func.sum(WebUser.mario_tokens)).scalar() or 0,
+        'active_users': db.session.query(db.func.count(WebUser.id)).filter(WebUser.broscute_points > 0).scalar() or 0,
+        'recent_activity': db.session.query(db.func.count(GameHistory.id)).filter(
+            GameHistory.created_at >= now - timedelta(days=7)
+        ).scalar() or 0,
+        'updated_at': now,
+        'reconciled_at': now,
+    }
+    if ledger_mode():
+        values['total_broscute'] += sum(ledger_pending_totals().values())
+    snapshot = db.session.get(AnalyticsSnapshot, ANALYTICS_SNAPSHOT_ID)
+    if snapshot is None:
+        snapshot = AnalyticsSnapshot(id=ANALYTICS_SNAPSHOT_ID)
+        db.session.add(snapshot)
+    for field, value in values.items():
+        setattr(snapshot, field, value)
+    db.session.commit()
+    logger.info("Analytics snapshot reconciled: %s users", values['total_users'])
+    return snapshot
+
+def claim_analytics_reconcile():
+    """Return True if this worker won the right to run the next reconcile"""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        db.update(AnalyticsSnapshot)
+        .where(AnalyticsSnapshot.id == ANALYTICS_SNAPSHOT_ID)
+        .where(AnalyticsSnapshot.reconciled_at < now - timedelta(seconds=ANALYTICS_RECONCILE_SECONDS))
+        .values(reconciled_at=now)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def _analytics_reconciler_loop(flask_app):
+    reconcile_at = time.monotonic() + ANALYTICS_RECONCILE_SECONDS
+    while True:
+        time.sleep(max(ANALYTICS_FLUSH_SECONDS, 1))
+        with flask_app.app_context():
+            try:
+                analytics_rollup.flush()
+                if ANALYTICS_RECONCILE_SECONDS > 0 and time.monotonic() >= reconcile_at:
+                    reconcile_at = time.monotonic() + ANALYTICS_RECONCILE_SECONDS
+                    if claim_analytics_reconcile():
+                        reconcile_analytics()
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Analytics reconciler error: %s", e)
+            finally:
+                db.session.remove()
+
+_analytics_reconciler_started = False
+_analytics_reconciler_lock = threading.Lock()
+
+def start_analytics_reconciler(flask_app):
+    """Start the thread that flushes the rollup and runs the periodic reconcile, once per worker"""
+    global _analytics_reconciler_started
+    with _analytics_reconciler_lock:
+        if _analytics_reconciler_started:
+            return
+        _analytics_reconciler_started = True
+    threading.Thread(
+        target=_analytics_reconciler_loop, args=(flask_app,),
+        name='analytics-reconciler', daemon=True
+    ).start()
+
+def record_balance_change(user, old_points, activity=0):
+    """Propagate a committed balance change to the leaderboard index and analytics rollup"""
+    user_cache.invalidate(user.id)
+    balance_notifier.notify(user.id)
+    try:
+        leaderboard_index.update(user.id, user.broscute_points)
+        new_points = user.broscute_points or 0
+        old_points = old_points or 0
+        analytics_rollup.record(
+            total_broscute=new_points - old_points,
+            active_users=int(new_points > 0) - int(old_points > 0),
+            recent_activity=activity
+        )
+    except Exception as e:
+        logger.error("Error recording balance change: %s", e)
+
+def record_new_user(user):
+    """Propagate a newly created user to the leaderboard index and analytics rollup"""
+    try:
+        leaderboard_index.update(user.id, user.broscute_points)
+        analytics_rollup.record(
+            total_users=1,
+            total_broscute=user.broscute_points or 0,
+            total_mario=user.mario_tokens or 0,
+            active_users=int((user.broscute_points or 0) > 0)
+        )
+    except Exception as e:
+        logger.error("Error recording new user: %s", e)
+
+# GameHistory write-behind buffer
+# GAME_HISTORY_MODE=sync scrie rândul de istoric în aceeași tranzacție cu creditul (implicit).
+# GAME_HISTORY_MODE=buffered îl pune într-un buffer per worker, golit ca un singur INSERT
+# multi-rând la GAME_HISTORY_BATCH_SIZE rânduri sau la GAME_HISTORY_FLUSH_SECONDS; la o
+# oprire bruscă a worker-ului se pot pierde rândurile din buffer (soldul rămâne corect).
+# Dacă INSERT-ul multi-rând eșuează, rândurile se reîncearcă individual: cele respinse sunt
+# logate și aruncate, iar la o pană de DB se păstrează cel mult GAME_HISTORY_MAX_ATTEMPTS
+# flush-uri și cel mult GAME_HISTORY_MAX_BUFFER rânduri.
+GAME_HISTORY_MODE = os.environ.get("GAME_HISTORY_MODE", "sync")
+GAME_HISTORY_BATCH_SIZE = int(os.environ.get("GAME_HISTORY_BATCH_SIZE", 500))
+GAME_HISTORY_FLUSH_SECONDS = float(os.environ.get("GAME_HISTORY_FLUSH_SECONDS", 2))
+GAME_HISTORY_MAX_BUFFER = int(os.environ.get("GAME_HISTORY_MAX_BUFFER", 50000))
+GAME_HISTORY_MAX_ATTEMPTS = int(os.environ.get("GAME_HISTORY_MAX_ATTEMPTS", 10))
+GAME_TYPE_MAX_LENGTH = GameHistory.game_type.type.length
+GAME_HISTORY_OUTAGE_FAILURES = 3  # eșecuri consecutive fără niciun rând scris = DB indisponibil
+
+class HistoryBuffer:
+    """Per-worker write-behind buffer for GameHistory rows"""
+
+    def __init__(self, batch_size=GAME_HISTORY_BATCH_SIZE, flush_seconds=GAME_HISTORY_FLUSH_SECONDS,
+                 max_rows=GAME_HISTORY_MAX_BUFFER, max_attempts=GAME_HISTORY_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_rows = max_rows
+        self.max_attempts = max_attempts
+        self._rows = []  # (încercări eșuate, rând)
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._app = None
+
+    def start(self, flask_app):
+        """Start the flusher thread once per worker"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = flask_app
+            self._thread = threading.Thread(target=self._run, name='history-flusher', daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, **row):
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self._dropped += 1
+                return
+            self._rows.append((0, row))
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        """Write all buffered rows with one multi-row INSERT; return the number written"""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._rows = self._rows, []
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                logger.error("Dropped %s game history rows: buffer full (%s rows)", dropped, self.max_rows)
+            if not entries:
+                return 0
+            try:
+                db.session.execute(db.insert(GameHistory), [row for _, row in entries])
+                db.session.commit()
+                return len(entries)
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Error flushing %s game history rows, retrying one by one: %s", len(entries), e)
+            return self._flush_rows(entries)
+
+    def _flush_rows(self, entries):
+        """Insert rows one by one; drop rows the database rejects, keep the rest during an outage"""
+        written, failed, errors, error = 0, [], [], None
+        for position, (attempts, row) in enumerate(entries):
+            try:
+                db.session.execute(db.insert(GameHistory).values(**row))
+                db.session.commit()
+                written += 1
+            except Exception as e:
+                db.session.rollback()
+                failed.append((attempts, row))
+                errors.append(e)
+                error = e
+                if written == 0 and len(failed) >= GAME_HISTORY_OUTAGE_FAILURES:
+                    # Niciun rând nu trece: probabil DB indisponibil, nu rânduri invalide
+                    failed += entries[position + 1:]
+                    break
+        retry = []
+        if written:
+            # Alte rânduri au trecut: cele eșuate sunt respinse de DB și nu vor trece nici mai târziu
+            for (_, row), row_error in zip(failed, errors):
+                logger.error("Dropping game history row %s: %s", row, row_error)
+        elif failed:
+            logger.error("Game history writes failing, keeping %s rows: %s", len(failed), error)
+            retry = [(attempts + 1, row) for attempts, row in failed]
+        kept = [(attempts, row) for attempts, row in retry if attempts < self.max_attempts]
+        if len(kept) < len(retry):
+            logger.error("Dropping %s game history rows after %s failed flushes", len(retry) - len(kept), self.max_attempts)
+        with self._lock:
+            self._rows[:0] = kept
+            overflow = len(self._rows) - self.max_rows
+            if overflow > 0:
+                del self._rows[:overflow]
+                self._dropped += overflow
+        return written
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            with self._app.app_context():
+                try:
+                    self.flush()
+                finally:
+                    db.session.remove()
+
+    def close(self):
+        """Stop the flusher and write whatever is still buffered (worker shutdown)"""
+        if self._thread is None or self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join(timeout=self.flush_seconds + 5)
+        with self._app.app_context():
+            written = self.flush()
+            db.session.remove()
+        if written:
+            logger.info("Flushed %s buffered game history rows on shutdown", written)
+
+history_buffer = HistoryBuffer()
+
+def history_buffered():
+    return GAME_HISTORY_MODE == 'buffered'
+
+# Balance ledger
+# BALANCE_MODE=counters (implicit): fiecare schimbare de sold e un UPDATE pe rândul din web_users.
+# BALANCE_MODE=ledger: creditele fără gărzi (ex. /api/add_game_rewards) se adaugă doar în
+# balance_ledger, fără să blocheze rândul utilizatorului; coloanele din web_users devin snapshot-ul,
+# iar soldul = snapshot + suma rândurilor necompactate (index parțial, delta mică). Compactarea
+# (LEDGER_COMPACT_SECONDS, sau `flask --app flask_app ledger-compact`) le adună periodic în
+# web_users. Schimbările care oricum modifică rândul (cooldown-uri, staking, debite) rămân UPDATE-uri,
+# cu rândul lor de ledger deja compactat. La fel creditele în masă (lanțul de referral, mining-ul
+# auto-settled, airdrop-urile în broșcuțe): UPDATE-ul lor scrie și rândurile compactate în aceeași
+# tranzacție (record_compacted_credits), deci jurnalul conține toate mișcările de broșcuțe de
+# după bonusul de înregistrare. Debitele nu intră niciodată necompactate: înainte de UPDATE-ul
+# cu gardă, rândurile necompactate ale utilizatorului sunt marcate și adunate în web_users în
+# aceeași tranzacție, deci garda se face doar pe web_users.broscute_points și vede fiecare credit o dată.
+BALANCE_MODE = os.environ.get("BALANCE_MODE", "counters")  # counters sau ledger
+LEDGER_COMPACT_SECONDS = float(os.environ.get("LEDGER_COMPACT_SECONDS", 30))
+LEDGER_COMPACT_BATCH_SIZE = int(os.environ.get("LEDGER_COMPACT_BATCH_SIZE", 5000))
+
+class BalanceLedger(db.Model):
+    __tablename__ = 'balance_ledger'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('web_users.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    earned = db.Column(db.Integer, nullable=False, default=0)  # partea care intră în total_earned
+    game_type = db.Column(db.String(50), nullable=True)
+    compacted = db.Column(db.Boolean, nullable=False, default=False)  # inclus deja în web_users
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+db.Index('ix_balance_ledger_user_id_pending', BalanceLedger.user_id, BalanceLedger.id,
+         postgresql_where=BalanceLedger.compacted.is_(False), sqlite_where=BalanceLedger.compacted.is_(False))
+
+def ledger_mode():
+    return BALANCE_MODE == 'ledger'
+
+def _ledger_pending(column, user_id=WebUser.id):
+    return db.select(db.func.coalesce(db.func.sum(column), 0)).where(
+        BalanceLedger.user_id == user_id, BalanceLedger.compacted.is_(False)
+    ).scalar_subquery()
+
+def balance_expression(user_id=WebUser.id):
+    """SQL expression of a user's spendable broscute_points (snapshot plus pending ledger credits).
+
+    Correlated on web_users.id by default; RETURNING clauses pass the user id instead,
+    because SQLite renders RETURNING columns without their table name.
+    """
+    if not ledger_mode():
+        return WebUser.broscute_points
+    return WebUser.broscute_points + _ledger_pending(BalanceLedger.amount, user_id)
+
+def total_earned_expression():
+    if not ledger_mode():
+        return WebUser.total_earned
+    return WebUser.total_earned + _ledger_pending(BalanceLedger.earned)
+
+def user_balance(user_id):
+    """(broscute_points, total_earned) of one user read in a single statement, or None"""
+    return db.session.execute(
+        db.select(balance_expression().label('broscute_points'), total_earned_expression().label('total_earned'))
+        .where(WebUser.id == user_id)
+    ).first()
+
+def apply_ledger_balance(user):
+    """Overlay pending ledger credits on a loaded WebUser without marking it dirty"""
+    balance = user_balance(user.id)
+    if balance is not None:
+        set_committed_value(user, 'broscute_points', balance.broscute_points)
+        set_committed_value(user, 'total_earned', balance.total_earned)
+
+def ledger_position(user_id):
+    """Id of the newest pending ledger row of a user (None when everything is compacted)"""
+    return db.session.scalar(db.select(db.func.max(BalanceLedger.id)).where(
+        BalanceLedger.user_id == user_id, BalanceLedger.compacted.is_(False)
+    ))
+
+def ledger_pending_totals(user_ids=None):
+    """{user_id: pending amount} for `user_ids` (all users when None)"""
+    query = (
+        db.select(BalanceLedger.user_id, db.func.sum(BalanceLedger.amount))
+        .where(BalanceLedger.compacted.is_(False)).group_by(BalanceLedger.user_id)
+    )
+    if user_ids is not None:
+        query = query.where(BalanceLedger.user_id.in_(user_ids))
+    return dict(db.session.execute(query).all())
+
+def with_ledger_balances(rows):
+    """Add pending ledger credits to the broscute_points of multi-row RETURNING results"""
+    if not ledger_mode() or not rows:
+        return rows
+    pending = ledger_pending_totals([row.id for row in rows])
+    return [SimpleNamespace(**{**row._asdict(), 'broscute_points': row.broscute_points + pending.get(row.id, 0)})
+            for row in rows]
+
+def append_ledger_credit(user_id, amount, game_type, earned, now):
+    """Record a credit without touching the web_users row; return (id, telegram_id, broscute_points) or None"""
+    inserted = db.session.execute(db.insert(BalanceLedger).from_select(
+        ['user_id', 'amount', 'earned', 'game_type', 'compacted', 'created_at'],
+        db.select(WebUser.id, db.literal(amount), db.literal(amount if earned else 0), db.literal(game_type),
+                  db.false(), db.literal(now)).where(WebUser.id == user_id)
+    ))
+    if inserted.rowcount == 0:
+        return None
+    return db.session.execute(
+        db.select(WebUser.id, WebUser.telegram_id, balance_expression().label('broscute_points'))
+        .where(WebUser.id == user_id)
+    ).first()
+
+def record_compacted_credits(credits, game_type, now):
+    """Journal bulk credits already applied to web_users ([(user_id, amount)]) inside the caller's transaction"""
+    if not ledger_mode() or not credits:
+        return
+    db.session.execute(db.insert(BalanceLedger), [
+        {'user_id': user_id, 'amount': amount, 'earned': amount, 'game_type': game_type,
+         'compacted': True, 'created_at': now}
+        for user_id, amount in credits
+    ])
+
+def compact_ledger_batch(batch_size=LEDGER_COMPACT_BATCH_SIZE):
+    """Fold up to batch_size pending ledger rows into web_users in one transaction; return rows folded"""
+    pending = (
+        db.select(BalanceLedger.id).where(BalanceLedger.compacted.is_(False))
+        .order_by(BalanceLedger.id).limit(batch_size)
+    )
+    try:
+        # Doar rândurile marcate efectiv de acest UPDATE se adună: două compactări simultane nu dublează nimic
+        rows = db.session.execute(
+            db.update(BalanceLedger)
+            .where(BalanceLedger.id.in_(pending), BalanceLedger.compacted.is_(False))
+            .values(compacted=True)
+            .returning(BalanceLedger.user_id, BalanceLedger.amount, BalanceLedger.earned),
+            execution_options={'synchronize_session': False}
+        ).all()
+        totals = {}
+        for user_id, amount, earned in rows:
+            total = totals.setdefault(user_id, [0, 0])
+            total[0] += amount
+            total[1] += earned
+        if totals:
+            users = WebUser.__table__
+            # Ordinea după id evită deadlock-urile între compactări concurente
+            db.session.connection().execute(
+                users.update().where(users.c.id == db.bindparam('user_id')).values(
+                    broscute_points=users.c.broscute_points + db.bindparam('amount'),
+                    total_earned=users.c.total_earned + db.bindparam('earned')
+                ),
+                [{'user_id': user_id, 'amount': amount, 'earned': earned}
+                 for user_id, (amount, earned) in sorted(totals.items())]
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
+
+def compact_user_ledger(user_id):
+    """Fold one user's pending ledger rows into web_users inside the caller's transaction"""
+    # Marcarea blochează rândurile: o compactare concurentă le găsește apoi compacted și le sare
+    rows = db.session.execute(
+        db.update(BalanceLedger)
+        .where(BalanceLedger.user_id == user_id, BalanceLedger.compacted.is_(False))
+        .values(compacted=True)
+        .returning(BalanceLedger.amount, BalanceLedger.earned),
+        execution_options={'synchronize_session': False}
+    ).all()
+    if rows:
+        db.session.execute(
+            db.update(WebUser).where(WebUser.id == user_id).values(
+                broscute_points=WebUser.broscute_points + sum(amount for amount, _ in rows),
+                total_earned=WebUser.total_earned + sum(earned for _, earned in rows)
+            ),
+            execution_options={'synchronize_session': False}
+        )
+    return len(rows)
+
+def compact_ledger(batch_size=LEDGER_COMPACT_BATCH_SIZE):
+    """Fold every pending ledger row into the web_users snapshots; return the number of rows folded"""
+    folded = 0
+    while True:
+        count = compact_ledger_batch(batch_size)
+        folded += count
+        if count < batch_size:
+            return folded
+
+def _ledger_compactor_loop(flask_app):
+    while True:
+        time.sleep(LEDGER_COMPACT_SECONDS)
+        with flask_app.app_context():
+            try:
+                compact_ledger()
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Ledger compaction error: %s", e)
+            finally:
+                db.session.remove()
+
+_ledger_compactor_started = False
+_ledger_compactor_lock = threading.Lock()
+
+def start_ledger_compactor(flask_app):
+    """Start the periodic compaction thread once per worker (concurrent compactions are safe)"""
+    global _ledger_compactor_started
+    with _ledger_compactor_lock:
+        if _ledger_compactor_started or LEDGER_COMPACT_SECONDS <= 0:
+            return
+        _ledger_compactor_started = True
+    threading.Thread(
+        target=_ledger_compactor_loop, args=(flask_app,),
+        name='ledger-compactor', daemon=True
+    ).start()
+
+# Atomic balance mutations
+def apply_balance_change(user_id, amount, game_type=None, where=(), values=None, earned=True, returning=()):
+    """Change broscute_points of one user with a single conditional UPDATE ... RETURNING.
+
+    `where` holds guards (cooldowns, one-time flags, sufficient balance) that are checked
+    atomically with the write and `values` sets extra columns. Credits also bump
+    total_earned unless earned=False. With a `game_type` a GameHistory row is written in
+    the same transaction - in the same statement on PostgreSQL - or handed to the
+    write-behind buffer when GAME_HISTORY_MODE=buffered. Commits and returns the
+    RETURNING row (id, telegram_id, broscute_points, *returning), or None when the user
+    does not exist or a guard did not match. With BALANCE_MODE=ledger an unguarded credit
+    is only appended to balance_ledger and broscute_points is the spendable balance; a
+    debit first folds the user's pending credits, so balance guards use the column alone.
+    """
+    now = datetime.utcnow()
+    if game_type is not None:
+        # game_type vine și de la client (/api/add_game_rewards); un rând prea lung ar fi respins de DB
+        game_type = str(game_type)[:GAME_TYPE_MAX_LENGTH]
+    ledger = ledger_mode()
+    new_values = {'broscute_points': WebUser.broscute_points + amount}
+    if earned:
+        new_values['total_earned'] = WebUser.total_earned + amount
+    new_values.update(values or {})
+    stmt = (
+        db.update(WebUser)
+        .where(WebUser.id == user_id, *where)
+        .values(**new_values)
+        .returning(WebUser.id, WebUser.telegram_id, balance_expression(user_id).label('broscute_points'), *returning)
+    )
+    buffered = game_type is not None and history_buffered()
+    # Doar creditele fără gărzi ocolesc rândul; debitele și schimbările cu gărzi îl blochează oricum
+    appended = ledger and amount >= 0 and not where and not values and not returning
+    try:
+        if ledger and amount < 0:
+            compact_user_ledger(user_id)
+        if appended:
+            row = append_ledger_credit(user_id, amount, game_type, earned, now)
+            if row is not None and game_type is not None and not buffered:
+                db.session.execute(db.insert(GameHistory).values(
+                    user_id=row.id, game_type=game_type, broscute_earned=amount, created_at=now
+                ))
+        elif game_type is not None and not buffered and db.session.get_bind().dialect.name == 'postgresql':
+            # WITH changed AS (UPDATE ... RETURNING), history AS (INSERT ... SELECT FROM changed) SELECT * FROM changed
+            changed = stmt.cte('balance_change')
+            history = db.insert(GameHistory).from_select(
+                ['user_id', 'game_type', 'broscute_earned', 'created_at'],
+                db.select(changed.c.id, db.literal(game_type), db.literal(amount), db.literal(now))
+            ).cte('balance_history')
+            row = db.session.execute(db.select(changed).add_cte(history)).first()
+        else:
+            row = db.session.execute(stmt, execution_options={'synchronize_session': False}).first()
+            if row is not None and game_type is not None and not buffered:
+                db.session.execute(db.insert(GameHistory).values(
+                    user_id=row.id, game_type=game_type, broscute_earned=amount, created_at=now
+                ))
+        if row is not None and ledger and not appended:
+            db.session.execute(db.insert(BalanceLedger).values(
+                user_id=row.id, amount=amount, earned=amount if earned else 0,
+                game_type=game_type, compacted=True, created_at=now
+            ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    if row is not None:
+        if buffered:
+            history_buffer.start(current_app._get_current_object())
+            history_buffer.add(user_id=row.id, game_type=game_type, broscute_earned=amount, created_at=now)
+        record_balance_change(row, row.broscute_points - amount, activity=int(game_type is not None))
+        if game_type is not None:
+            record_game_metrics(game_type, amount)
+    return row
+
+# Game logic shared by the web routes and the bot commands
+def play_daily_for(user_id):
+    """Roll and credit the daily game reward; return (result row or None if on cooldown, reward)"""
+    reward = random.randint(10, 100)
+    now = datetime.utcnow()
+    result = apply_balance_change(
+        user_id, reward, game_type='daily',
+        where=(daily_game_available(now),),
+        values={'last_daily_game': now}
+    )
+    return result, reward
+
+def play_luck_for(user_id):
+    """Roll and credit the luck game reward; return (result row or None if on cooldown, reward)"""
+    reward = random.randint(5, 50)
+    now = datetime.utcnow()
+    result = apply_balance_change(
+        user_id, reward, game_type='luck',
+        where=(luck_game_available(now),),
+        values={'last_luck_game': now}
+    )
+    return result, reward
+
+def claim_staking_for(user_id):
+    """Credit the unclaimed staking rewards computed inside the UPDATE; return (row or None, reward).
+
+    On PostgreSQL this is one statement: the row is locked in a CTE so the reward can be
+    returned from the old staking_rewards, and the history row is inserted from the result.
+    SQLite cannot reference other tables in RETURNING, so there the history INSERT ... SELECT
+    captures the reward first; its write lock keeps the following UPDATE consistent.
+    """
+    now = datetime.utcnow()
+    dialect = db.session.get_bind().dialect.name
+    accrued = staking_rewards_accrued(now, dialect)
+    pending = accrued - WebUser.staking_rewards
+    credit = {
+        'broscute_points': WebUser.broscute_points + pending,
+        'total_earned': WebUser.total_earned + pending,
+        'staking_rewards': accrued
+    }
+    try:
+        if dialect == 'postgresql':
+            old = db.select(WebUser.id, WebUser.staking_rewards).where(WebUser.id == user_id).with_for_update().cte('claim_old')
+            claimed = (
+                db.update(WebUser)
+                .where(WebUser.id == old.c.id, pending > 0)
+                .values(**credit)
+                .returning(WebUser.id, WebUser.telegram_id, balance_expression(user_id).label('broscute_points'),
+                           (WebUser.staking_rewards - old.c.staking_rewards).label('reward'))
+                .cte('claim')
+            )
+            history = db.insert(GameHistory).from_select(
+                ['user_id', 'game_type', 'broscute_earned', 'created_at'],
+                db.select(claimed.c.id, db.literal('staking_rewards'), claimed.c.reward, db.literal(now))
+            ).cte('claim_history')
+            row = db.session.execute(db.select(claimed).add_cte(history)).first()
+            reward = row.reward if row is not None else 0
+        else:
+            reward = db.session.execute(db.insert(GameHistory).from_select(
+                ['user_id', 'game_type', 'broscute_earned', 'created_at'],
+                db.select(WebUser.id, db.literal('staking_rewards'), pending, db.literal(now))
+                .where(WebUser.id == user_id, pending > 0)
+            ).returning(GameHistory.broscute_earned)).scalar()
+            row = None
+            if reward is not None:
+                row = db.session.execute(
+                    db.update(WebUser).where(WebUser.id == user_id).values(**credit)
+                    .returning(WebUser.id, WebUser.telegram_id, balance_expression(user_id).label('broscute_points')),
+                    execution_options={'synchronize_session': False}
+                ).first()
+        if row is not None and ledger_mode():
+            db.session.execute(db.insert(BalanceLedger).values(
+                user_id=row.id, amount=reward, earned=reward, game_type='staking_rewards', compacted=True, created_at=now
+            ))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    if row is None:
+        return None, 0
+    record_balance_change(row, row.broscute_points - reward, activity=1)
+    record_game_metrics('staking_rewards', reward)
+    return row, reward
+
+# Staking settlement
+# Jobul de settlement calculează vectorizat (NumPy, pe chunk-uri) recompensele acumulate de toți
+# stakerii pentru epoca curentă (zi UTC) și scrie totalurile epocii în staking_epochs: datoria
+# de staking (staking_liability) citită de /analytics și de CLI-ul staking-liability. Paginile
+# calculează suma per utilizator din coloanele de staking deja încărcate, fără interogare.
+STAKING_DAILY_RATE = 0.01  # 1% daily, la fel ca în calculate_staking_rewards
+STAKING_SETTLE_CHUNK_SIZE = int(os.environ.get("STAKING_SETTLE_CHUNK_SIZE", 10000))
+
+def current_staking_epoch(now=None):
+    """Epoch number = whole UTC days since 1970-01-01"""
+    now = now or datetime.utcnow()
+    return (now - datetime(1970, 1, 1)).days
+
+def _upsert(model, rows, index_elements):
+    """Bulk INSERT ... ON CONFLICT DO UPDATE for PostgreSQL and SQLite"""
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    stmt = dialect_insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column: stmt.excluded[column] for column in rows[0] if column not in index_elements}
+    )
+    db.session.execute(stmt, rows)
+
+def settle_staking_rewards(now=None, chunk_size=STAKING_SETTLE_CHUNK_SIZE):
+    """Compute the accrued staking rewards of all stakers and record the epoch totals (liability)"""
+    import numpy as np  # importat aici ca să nu încetinească pornirea worker-ilor web
+    
+    now = now or datetime.utcnow()
+    epoch = current_staking_epoch(now)
+    now64 = np.datetime64(now, 'us')
+    day = np.timedelta64(1, 'D')
+    totals = {'stakers': 0, 'total_staked': 0, 'total_accrued': 0, 'total_liability': 0}
+    last_id = 0
+    
+    while True:
+        rows = db.session.query(
+            WebUser.id, WebUser.staked_amount, WebUser.staking_start_date, WebUser.staking_rewards
+        ).filter(
+            WebUser.id > last_id, WebUser.staked_amount > 0, WebUser.staking_start_date.isnot(None)
+        ).order_by(WebUser.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        
+        staked = np.fromiter((row.staked_amount for row in rows), dtype=np.int64, count=len(rows))
+        claimed = np.fromiter((row.staking_rewards or 0 for row in rows), dtype=np.int64, count=len(rows))
+        starts = np.array([row.staking_start_date for row in rows], dtype='datetime64[us]')
+        
+        # Aceeași formulă ca calculate_staking_rewards: int(staked * rate * zile întregi)
+        days = np.maximum((now64 - starts) // day, 0)
+        accrued = np.trunc(staked * STAKING_DAILY_RATE * days).astype(np.int64)
+        
+        totals['stakers'] += len(rows)
+        totals['total_staked'] += int(staked.sum())
+        totals['total_accrued'] += int(accrued.sum())
+        totals['total_liability'] += int(np.maximum(accrued - claimed, 0).sum())
+    
+    _upsert(StakingEpoch, [dict(epoch=epoch, settled_at=now, **totals)], ['epoch'])
+    db.session.commit()
+    logger.info("Staking epoch %s settled: %s stakers, liability %s", epoch, totals['stakers'], totals['total_liability'])
+    return db.session.get(StakingEpoch, epoch)
+
+def pending_staking_rewards(user):
+    """Pending (unclaimed) staking rewards from the loaded staking columns, no query"""
+    return calculate_staking_rewards(user) - user.staking_rewards
+
+def staking_liability():
+    """Outstanding staking liability from the latest settled epoch"""
+    return db.session.query(StakingEpoch).order_by(StakingEpoch.epoch.desc()).first()
+
+# Mining auto-settlement
+# Sesiunile de mining maturizate (mining_started_at mai vechi de 24h) sunt creditate de un singur
+# worker lider, fără să mai depindă de /api/mining/complete. Liderul ține un heap cu momentele
+# de maturizare ale sesiunilor care se termină până la următorul resync (reconstruit din DB) și
+# se trezește exact atunci; creditarea se face în batch-uri: un UPDATE ... RETURNING cu gardă
+# pe maturizare + un INSERT multi-row în game_history, în aceeași tranzacție. Sesiunea se
+# închide (mining_started_at = NULL), deci utilizatorii inactivi nu minează la nesfârșit.
+MINING_REWARD = 5000
+MINING_AUTO_SETTLE = os.environ.get("MINING_AUTO_SETTLE", "0") == "1"
+MINING_SETTLE_BATCH_SIZE = int(os.environ.get("MINING_SETTLE_BATCH_SIZE", 1000))
+MINING_SCHEDULER_RESYNC_SECONDS = int(os.environ.get("MINING_SCHEDULER_RESYNC_SECONDS", 300))
+MINING_NOTIFY = os.environ.get("MINING_NOTIFY", "0") == "1"
+MINING_SCHEDULER_LOCK_ID = 7245411  # pg_try_advisory_lock: un singur lider între workeri și instanțe
+MINING_SCHEDULER_LOCK_FILE = os.environ.get("MINING_SCHEDULER_LOCK_FILE", "/tmp/mariocoin-mining-scheduler.lock")
+
+_mining_notify_pool = None
+_mining_notify_lock = threading.Lock()
+
+def notify_mining_settled(rows):
+    """Queue a Telegram message per settled session (MINING_NOTIFY=1)"""
+    global _mining_notify_pool
+    if not MINING_NOTIFY or not TELEGRAM_BOT_TOKEN or not rows:
+        return
+    with _mining_notify_lock:
+        if _mining_notify_pool is None:
+            _mining_notify_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='mining-notify')
+    for row in rows:
+        _mining_notify_pool.submit(
+            send_telegram_message, row.telegram_id,
+            f"⛏️ Sesiunea de mining s-a încheiat! Ai primit {MINING_REWARD} broșcuțe. Sold: {row.broscute_points}"
+        )
+
+def settle_mining_batch(now, batch_size=MINING_SETTLE_BATCH_SIZE):
+    """Credit up to batch_size matured sessions; return the settled (id, telegram_id, broscute_points) rows"""
+    due = (
+        db.select(WebUser.id)
+        .where(mining_session_matured(now))
+        .order_by(WebUser.mining_started_at)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    try:
+        rows = db.session.execute(
+            db.update(WebUser)
+            .where(WebUser.id.in_(due), mining_session_matured(now))
+            .values(
+                broscute_points=WebUser.broscute_points + MINING_REWARD,
+                total_earned=WebUser.total_earned + MINING_REWARD,
+                mining_started_at=None
+            )
+            .returning(WebUser.id, WebUser.telegram_id, WebUser.broscute_points),
+            execution_options={'synchronize_session': False}
+        ).all()
+        if rows:
+            db.session.execute(db.insert(GameHistory), [
+                {'user_id': row.id, 'game_type': 'mining', 'broscute_earned': MINING_REWARD, 'created_at': now}
+                for row in rows
+            ])
+            record_compacted_credits([(row.id, MINING_REWARD) for row in rows], 'mining', now)
+            rows = with_ledger_balances(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    for row in rows:
+        record_balance_change(row, row.broscute_points - MINING_REWARD, activity=1)
+        record_game_metrics('mining', MINING_REWARD)
+    notify_mining_settled(rows)
+    return rows
+
+def settle_matured_mining(now=None, batch_size=MINING_SETTLE_BATCH_SIZE):
+    """Settle every matured mining session in batches; return how many were credited"""
+    now = now or datetime.utcnow()
+    settled = 0
+    while True:
+        rows = settle_mining_batch(now, batch_size)
+        settled += len(rows)
+        if len(rows) < batch_size:
+            break
+    if settled:
+        logger.info("Auto-settled %s mining sessions", settled)
+    return settled
+
+class MiningScheduler:
+    """Leader-only heap of upcoming mining maturities, rebuilt from the DB every resync"""
+
+    def __init__(self, resync_seconds=MINING_SCHEDULER_RESYNC_SECONDS):
+        self.resync_seconds = resync_seconds
+        self._heap = []
+        self._heap_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._leader_handle = None
+
+    def start(self, flask_app):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(flask_app,), name='mining-scheduler', daemon=True)
+            self._thread.start()
+
+    def schedule(self, started_at):
+        """Add a maturity time (a no-op outside the leader, whose resync finds it anyway)"""
+        if self._leader_handle is not None:
+            with self._heap_lock:
+                heapq.heappush(self._heap, started_at + timedelta(seconds=MINING_SESSION_SECONDS))
+            self._wake.set()
+
+    def _acquire_leadership(self):
+        if db.engine.dialect.name == 'postgresql':
+            # Lock de sesiune: ținut cât trăiește conexiunea dedicată, eliberat automat dacă workerul moare
+            connection = db.engine.connect()
+            try:
+                if connection.execute(db.text("SELECT pg_try_advisory_lock(:key)"), {'key': MINING_SCHEDULER_LOCK_ID}).scalar():
+                    connection.commit()
+                    return connection
+            except Exception:
+                connection.close()
+                raise
+            connection.close()
+            return None
+        import fcntl
+        handle = open(MINING_SCHEDULER_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return handle
+        except OSError:
+            handle.close()
+            return None
+
+    def _check_leadership(self):
+        if hasattr(self._leader_handle, 'execute'):
+            try:
+                self._leader_handle.execute(db.text("SELECT 1"))
+                self._leader_handle.commit()
+            except Exception:
+                logger.warning("Mining scheduler lost its leader connection")
+                self._release_leadership()
+        return self._leader_handle is not None
+
+    def _release_leadership(self):
+        # Conexiunea moartă nu se întoarce în pool: invalidate o închide definitiv
+        handle, self._leader_handle = self._leader_handle, None
+        try:
+            handle.invalidate()
+            handle.close()
+        except Exception as e:
+            logger.warning("Could not close the mining scheduler leader connection: %s", e)
+
+    def rebuild(self, now):
+        """Load the maturity times of sessions ending before the next resync"""
+        window_start = now - timedelta(seconds=MINING_SESSION_SECONDS)
+        started = db.session.scalars(
+            db.select(WebUser.mining_started_at).where(
+                WebUser.mining_started_at > window_start,
+                WebUser.mining_started_at <= window_start + timedelta(seconds=self.resync_seconds)
+            )
+        ).all()
+        heap = [moment + timedelta(seconds=MINING_SESSION_SECONDS) for moment in started]
+        heapq.heapify(heap)
+        with self._heap_lock:
+            self._heap = heap
+
+    def _run(self, flask_app):
+        next_resync = datetime.min
+        while True:
+            with flask_app.app_context():
+                try:
+                    if not self._check_leadership():
+                        self._leader_handle = self._acquire_leadership()
+                    if self._leader_handle is None:
+                        next_resync = datetime.min
+                    else:
+                        now = datetime.utcnow()
+                        due = False
+                        with self._heap_lock:
+                            while self._heap and self._heap[0] <= now:
+                                heapq.heappop(self._heap)
+                                due = True
+                        if now >= next_resync:
+                            settle_matured_mining(now)
+                            self.rebuild(now)
+                            next_resync = now + timedelta(seconds=self.resync_seconds)
+                        elif due:
+                            settle_matured_mining(now)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("Mining scheduler error: %s", e)
+                finally:
+                    db.session.remove()
+            
+            if self._leader_handle is None:
+                timeout = self.resync_seconds
+            else:
+                with self._heap_lock:
+                    wake_at = min(self._heap[0], next_resync) if self._heap else next_resync
+                timeout = (wake_at - datetime.utcnow()).total_seconds()
+            self._wake.wait(max(timeout, 0.5))
+            self._wake.clear()
+
+mining_scheduler = MiningScheduler()
+
+# Referral engine
+# Fiecare utilizator nou primește un cod; un cod valid la înregistrare (/telegram_auth sau
+# /start <cod> în bot) setează referred_by și creditează lanțul de referenți pe nivele
+# (REFERRAL_TIER_REWARDS: nivelul 1 = referentul direct). Costul per înregistrare e constant:
+# lookup pe codul unic, un CTE recursiv limitat la numărul de nivele, un UPDATE și un INSERT
+# multi-row în game_history, toate în tranzacția înregistrării.
+REFERRAL_TIER_REWARDS = [int(amount) for amount in os.environ.get("REFERRAL_TIER_REWARDS", "100,50,25").split(',') if amount.strip()]
+REFERRAL_CODE_LENGTH = 8
+REFERRAL_CODE_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # fără 0/O, 1/I
+REFERRAL_RECOMPUTE_CHUNK_SIZE = int(os.environ.get("REFERRAL_RECOMPUTE_CHUNK_SIZE", 10000))
+REFERRAL_CODE_ATTEMPTS = 5  # coliziuni pe referral_code (unic): se reîncearcă cu coduri noi
+TELEGRAM_BOT_USERNAME = os.environ.get("TELEGRAM_BOT_USERNAME", "")
+
+def generate_referral_code():
+    return ''.join(secrets.choice(REFERRAL_CODE_ALPHABET) for _ in range(REFERRAL_CODE_LENGTH))
+
+def retry_referral_code_conflicts(operation):
+    """Run operation(), which generates fresh codes and commits, again on a referral_code collision"""
+    for attempt in range(REFERRAL_CODE_ATTEMPTS):
+        try:
+            return operation()
+        except IntegrityError as e:
+            db.session.rollback()
+            if 'referral_code' not in str(e.orig) or attempt == REFERRAL_CODE_ATTEMPTS - 1:
+                raise
+            logger.warning("Referral code collision, retrying (attempt %s)", attempt + 1)
+
+def referral_link(code):
+    """Deep link that opens the bot with /start <code>, or None without TELEGRAM_BOT_USERNAME"""
+    return f"https://t.me/{TELEGRAM_BOT_USERNAME}?start={code}" if TELEGRAM_BOT_USERNAME and code else None
+
+def ensure_referral_code(user_id):
+    """Return the user's referral code, assigning one to accounts created before the referral engine"""
+    def assign():
+        code = generate_referral_code()
+        result = db.session.execute(
+            db.update(WebUser)
+            .where(WebUser.id == user_id, WebUser.referral_code.is_(None))
+            .values(referral_code=code)
+        )
+        db.session.commit()
+        return code, result.rowcount
+    
+    code, assigned = retry_referral_code_conflicts(assign)
+    if assigned:
+        user_cache.invalidate(user_id)
+        return code
+    return db.session.query(WebUser.referral_code).filter(WebUser.id == user_id).scalar()
+
+def referral_chain(referrer_id, max_depth):
+    """[(user_id, depth)] for the referrer and its ancestors, via one recursive CTE"""
+    chain = db.select(
+        db.literal(referrer_id).label('id'), db.literal(1).label('depth')
+    ).cte('referral_chain', recursive=True)
+    parent = db.aliased(WebUser)
+    chain = chain.union_all(
+        db.select(parent.referred_by, chain.c.depth + 1)
+        .where(parent.id == chain.c.id, parent.referred_by.isnot(None), chain.c.depth < max_depth)
+    )
+    return db.session.execute(db.select(chain.c.id, chain.c.depth)).all()
+
+def credit_referral_chain(referrer_id, now):
+    """Credit the tiered rewards up the chain inside the caller's transaction; return the changed rows"""
+    if not REFERRAL_TIER_REWARDS:
+        return []
+    rewards = {user_id: REFERRAL_TIER_REWARDS[depth - 1] for user_id, depth in referral_chain(referrer_id, len(REFERRAL_TIER_REWARDS))}
+    reward = db.case(rewards, value=WebUser.id, else_=0)
+    rows = db.session.execute(
+        db.update(WebUser)
+        .where(WebUser.id.in_(list(rewards)))
+        .values(
+            broscute_points=WebUser.broscute_points + reward,
+            total_earned=WebUser.total_earned + reward,
+            referral_rewards=db.func.coalesce(WebUser.referral_rewards, 0) + reward,
+            referral_count=db.func.coalesce(WebUser.referral_count, 0) + db.case((WebUser.id == referrer_id, 1), else_=0)
+        )
+        .returning(WebUser.id, WebUser.telegram_id, WebUser.broscute_points),
+        execution_options={'synchronize_session': False}
+    ).all()
+    if rows:
+        db.session.execute(db.insert(GameHistory), [
+            {'user_id': row.id, 'game_type': 'referral', 'broscute_earned': rewards[row.id], 'created_at': now}
+            for row in rows
+        ])
+        record_compacted_credits([(row.id, rewards[row.id]) for row in rows], 'referral', now)
+    return [(row, rewards[row.id]) for row in with_ledger_balances(rows)]
+
+def register_user(telegram_id, username, first_name, last_name, referral_code=None):
+    """Create a WebUser with the signup bonus, attributing it to `referral_code` when valid"""
+    now = datetime.utcnow()
+    referrer_id = None
+    # Codul vine din input-ul clientului: orice nu e text (număr, listă, obiect) sau e gol se ignoră
+    code = referral_code.strip().upper() if isinstance(referral_code, str) else ''
+    if code:
+        referrer_id = db.session.query(WebUser.id).filter(
+            WebUser.referral_code == code, WebUser.telegram_id != telegram_id
+        ).scalar()
+    
+    def insert():
+        user = WebUser(
+            telegram_id=telegram_id,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+            broscute_points=100,  # Bonus de înregistrare
+            mario_tokens=0,
+            total_earned=100,
+            google_form_completed=True,  # Acces complet
+            referral_code=generate_referral_code(),
+            referred_by=referrer_id
+        )
+        credited = []
+        try:
+            db.session.add(user)
+            db.session.flush()
+            if referrer_id is not None:
+                credited = credit_referral_chain(referrer_id, now)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return user, credited
+    
+    user, credited = retry_referral_code_conflicts(insert)
+    record_new_user(user)
+    for row, reward in credited:
+        record_balance_change(row, row.broscute_points - reward, activity=1)
+        record_game_metrics('referral', reward)
+    if credited:
+        logger.info("Referral signup %s credited %s referrers", telegram_id, len(credited))
+    return user
+
+def recompute_referrals(chunk_size=REFERRAL_RECOMPUTE_CHUNK_SIZE):
+    """Rebuild referral_count and referral_rewards from the tree and history, and backfill codes"""
+    codes_assigned = 0
+    while True:
+        missing = db.session.scalars(
+            db.select(WebUser.id).where(WebUser.referral_code.is_(None)).limit(chunk_size)
+        ).all()
+        if not missing:
+            break
+        
+        def assign():
+            db.session.execute(db.update(WebUser), [{'id': user_id, 'referral_code': generate_referral_code()} for user_id in missing])
+            db.session.commit()
+        
+        retry_referral_code_conflicts(assign)
+        codes_assigned += len(missing)
+    
+    child = db.aliased(WebUser)
+    count = db.select(db.func.count(child.id)).where(child.referred_by == WebUser.id).scalar_subquery()
+    earned = db.select(db.func.coalesce(db.func.sum(GameHistory.broscute_earned), 0)).where(
+        GameHistory.user_id == WebUser.id, GameHistory.game_type == 'referral'
+    ).scalar_subquery()
+    max_id = db.session.query(db.func.max(WebUser.id)).scalar() or 0
+    updated = 0
+    # Pe intervale de id-uri, ca fiecare tranzacție să blocheze puține rânduri
+    for start in range(0, max_id + 1, chunk_size):
+        result = db.session.execute(
+            db.update(WebUser)
+            .where(WebUser.id >= start, WebUser.id < start + chunk_size)
+            .where(db.or_(
+                db.func.coalesce(WebUser.referral_count, -1) != count,
+                db.func.coalesce(WebUser.referral_rewards, -1) != earned
+            ))
+            .values(referral_count=count, referral_rewards=earned),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+        updated += result.rowcount
+    user_cache.clear()
+    return {'codes_assigned': codes_assigned, 'users_updated': updated}
+
+# Bulk airdrops
+# Un fișier (telegram_id, amount, reason) se aplică pe chunk-uri: fiecare chunk intră într-un
+# tabel temporar și e creditat cu un singur UPDATE ... FROM (sume agregate per telegram_id) plus
+# un INSERT ... SELECT în game_history. Fiecare chunk are cheia de idempotență "<cheie>:<nr>",
+# înregistrată în airdrop_batches în aceeași tranzacție: o rulare repetată sare peste chunk-urile
+# deja aplicate, iar două rulări simultane nu pot aplica același chunk de două ori.
+AIRDROP_CHUNK_SIZE = int(os.environ.get("AIRDROP_CHUNK_SIZE", 10000))
+AIRDROP_CURRENCIES = {'broscute': 'broscute_points', 'mario_tokens': 'mario_tokens'}
+
+class AirdropBatch(db.Model):
+    __tablename__ = 'airdrop_batches'
+    
+    key = db.Column(db.String(150), primary_key=True)  # "<airdrop>:<chunk>"
+    airdrop = db.Column(db.String(100), nullable=False, index=True)
+    chunk = db.Column(db.Integer, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 al întregului fișier
+    currency = db.Column(db.String(20), nullable=False)
+    rows = db.Column(db.Integer, default=0)
+    matched_rows = db.Column(db.Integer, default=0)  # rânduri cu telegram_id existent
+    credited_users = db.Column(db.Integer, default=0)
+    total_amount = db.Column(db.BigInteger, default=0)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Cheia trebuie să încapă în airdrop_batches.airdrop; "<cheie>:<nr>" încape atunci în key
+AIRDROP_KEY_MAX_LENGTH = AirdropBatch.airdrop.type.length
+
+# Tabel temporar per conexiune, în afara metadatelor aplicației (nu e creat de migrații)
+airdrop_staging = db.Table(
+    'airdrop_staging', db.MetaData(),
+    db.Column('telegram_id', db.BigInteger, nullable=False),
+    db.Column('amount', db.Integer, nullable=False),
+    db.Column('reason', db.String(50), nullable=False),
+    prefixes=['TEMPORARY']
+)
+
+def parse_airdrop_rows(lines):
+    """Parse CSV lines of telegram_id,amount[,reason] (header optional); raise ValueError listing bad lines"""
+    rows, errors = [], []
+    for number, record in enumerate(csv.reader(lines), start=1):
+        if not record or not ''.join(record).strip():
+            continue
+        if number == 1 and record[0].strip().lower() == 'telegram_id':
+            continue
+        try:
+            telegram_id, amount = int(record[0]), int(record[1])
+            if amount <= 0:
+                raise ValueError('amount must be positive')
+            reason = (record[2].strip() if len(record) > 2 else '') or 'airdrop'
+            rows.append((telegram_id, amount, reason[:50]))
+        except (ValueError, IndexError) as e:
+            errors.append(f"line {number}: {e}")
+            if len(errors) >= 20:
+                break
+    if errors:
+        raise ValueError('; '.join(errors))
+    return rows
+
+def apply_airdrop_chunk(key, airdrop, chunk_number, chunk_size, fingerprint, currency, rows, now):
+    """Stage and credit one chunk in a single transaction; return (AirdropBatch summary, newly active users)"""
+    column = getattr(WebUser, AIRDROP_CURRENCIES[currency])
+    connection = db.session.connection()
+    try:
+        # Markerul de idempotență primul: o rulare concurentă cu aceeași cheie se blochează / eșuează aici
+        batch = AirdropBatch(
+            key=key, airdrop=airdrop, chunk=chunk_number, chunk_size=chunk_size,
+            fingerprint=fingerprint, currency=currency, rows=len(rows), applied_at=now
+        )
+        db.session.add(batch)
+        db.session.flush()
+        
+        airdrop_staging.drop(connection, checkfirst=True)
+        airdrop_staging.create(connection)
+        connection.execute(airdrop_staging.insert(), [
+            {'telegram_id': telegram_id, 'amount': amount, 'reason': reason} for telegram_id, amount, reason in rows
+        ])
+        totals = (
+            db.select(airdrop_staging.c.telegram_id, db.func.sum(airdrop_staging.c.amount).label('amount'))
+            .group_by(airdrop_staging.c.telegram_id)
+            .subquery()
+        )
+        values = {column.key: column + totals.c.amount}
+        if currency == 'broscute':
+            values['total_earned'] = WebUser.total_earned + totals.c.amount
+        credited = connection.execute(
+            db.update(WebUser).where(WebUser.telegram_id == totals.c.telegram_id).values(**values)
+            .returning(WebUser.id, WebUser.telegram_id, WebUser.broscute_points)
+        ).all()
+        batch.credited_users = len(credited)
+        
+        # game_history (și balance_ledger) țin doar broșcuțe; creditele mario_tokens rămân în airdrop_batches
+        if currency == 'broscute':
+            connection.execute(db.insert(GameHistory).from_select(
+                ['user_id', 'game_type', 'broscute_earned', 'created_at'],
+                db.select(WebUser.id, airdrop_staging.c.reason, airdrop_staging.c.amount, db.literal(now))
+                .join(WebUser, WebUser.telegram_id == airdrop_staging.c.telegram_id)
+            ))
+            if ledger_mode():
+                connection.execute(db.insert(BalanceLedger).from_select(
+                    ['user_id', 'amount', 'earned', 'game_type', 'compacted', 'created_at'],
+                    db.select(WebUser.id, airdrop_staging.c.amount, airdrop_staging.c.amount,
+                              airdrop_staging.c.reason, db.true(), db.literal(now))
+                    .join(WebUser, WebUser.telegram_id == airdrop_staging.c.telegram_id)
+                ))
+        batch.matched_rows, batch.total_amount = connection.execute(
+            db.select(db.func.count(), db.func.coalesce(db.func.sum(airdrop_staging.c.amount), 0))
+            .join(WebUser, WebUser.telegram_id == airdrop_staging.c.telegram_id)
+        ).one()
+        airdrop_staging.drop(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    # Utilizatorii trecuți de la sold 0 la pozitiv de acest chunk (active_users din analytics)
+    activated = 0
+    if currency == 'broscute':
+        amounts = defaultdict(int)
+        for telegram_id, amount, _ in rows:
+            amounts[telegram_id] += amount
+        activated = sum(1 for row in with_ledger_balances(credited)
+                        if row.broscute_points > 0 >= row.broscute_points - amounts[row.telegram_id])
+    return batch, activated
+
+def run_airdrop(airdrop, rows, currency='broscute', chunk_size=AIRDROP_CHUNK_SIZE):
+    """Apply `rows` [(telegram_id, amount, reason)] under the idempotency key `airdrop`; safe to re-run"""
+    if currency not in AIRDROP_CURRENCIES:
+        raise ValueError(f"Unknown currency, use one of {sorted(AIRDROP_CURRENCIES)}")
+    if len(airdrop) > AIRDROP_KEY_MAX_LENGTH:
+        raise ValueError(f"Airdrop key must be at most {AIRDROP_KEY_MAX_LENGTH} characters")
+    fingerprint = hashlib.sha256(json.dumps(rows).encode()).hexdigest()
+    previous = db.session.query(AirdropBatch.fingerprint, AirdropBatch.chunk_size, AirdropBatch.currency).filter(
+        AirdropBatch.airdrop == airdrop
+    ).distinct().all()
+    # Aceeași cheie cu alt fișier sau alt chunk_size ar decala chunk-urile și ar dubla creditele
+    if any(row != (fingerprint, chunk_size, currency) for row in previous):
+        raise ValueError(f"Airdrop {airdrop} was already started with a different file, chunk size or currency")
+    applied = set(db.session.scalars(db.select(AirdropBatch.chunk).where(AirdropBatch.airdrop == airdrop)))
+    
+    summary = {'airdrop': airdrop, 'currency': currency, 'rows': len(rows), 'chunks': 0, 'skipped_chunks': 0,
+               'credited_users': 0, 'total_amount': 0, 'unmatched_rows': 0}
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    for chunk_number, offset in enumerate(range(0, len(rows), chunk_size)):
+        summary['chunks'] += 1
+        if chunk_number in applied:
+            summary['skipped_chunks'] += 1
+            continue
+        chunk = rows[offset:offset + chunk_size]
+        batch, activated = apply_airdrop_chunk(f"{airdrop}:{chunk_number}", airdrop, chunk_number, chunk_size,
+                                               fingerprint, currency, chunk, now)
+        summary['credited_users'] += batch.credited_users
+        summary['total_amount'] += batch.total_amount
+        summary['unmatched_rows'] += batch.rows - batch.matched_rows
+        if currency == 'broscute':
+            analytics_rollup.record(total_broscute=batch.total_amount, active_users=activated,
+                                    recent_activity=batch.matched_rows)
+        else:
+            analytics_rollup.record(total_mario=batch.total_amount)
+    
+    # Mulți utilizatori schimbați deodată: cache-urile se reconstruiesc în loc de update-uri individuale
+    user_cache.clear()
+    leaderboard_index.mark_stale()
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    logger.info("Airdrop %s: %s chunks (%s skipped), %s users credited with %s %s", airdrop, summary['chunks'],
+                summary['skipped_chunks'], summary['credited_users'], summary['total_amount'], currency)
+    return summary
+
+# Game history pagination
+# Paginare keyset pe (created_at, id): fiecare pagină e o căutare în indexul
+# (user_id, created_at), indiferent cât de departe a derulat utilizatorul.
+# Rândurile vechi cu created_at NULL nu au o poziție în timp, deci sunt excluse
+# din pagini și din totaluri (altfel comparația pe tuplu le-ar pierde oricum).
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def encode_history_cursor(created_at, row_id):
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Return (created_at, id) or raise ValueError for a malformed cursor"""
     try:
-        db.create_all()
-        logger.info("Database tables created successfully")
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
     except Exception as e:
-        logger.error(f"Database initialization error: {e}")
+        raise ValueError(f"Invalid cursor: {e}")
+
+def fetch_history_page(user_id, cursor=None, limit=HISTORY_PAGE_SIZE, game_type=None, since=None, until=None, with_totals=None):
+    """Return one page of a user's GameHistory, newest first.
+
+    Per-type totals for the whole filtered range are computed server-side on the
+    first page only (with_totals=None), so deeper pages stay a single index seek.
+    """
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    filters = [GameHistory.user_id == user_id, GameHistory.created_at.isnot(None)]
+    if game_type:
+        filters.append(GameHistory.game_type == game_type)
+    if since:
+        filters.append(GameHistory.created_at >= since)
+    if until:
+        filters.append(GameHistory.created_at < until)
+    
+    query = db.session.query(
+        GameHistory.id, GameHistory.game_type, GameHistory.broscute_earned, GameHistory.created_at
+    ).filter(*filters)
+    if cursor:
+        created_at, row_id = decode_history_cursor(cursor)
+        query = query.filter(db.tuple_(GameHistory.created_at, GameHistory.id) < db.tuple_(created_at, row_id))
+    rows = query.order_by(GameHistory.created_at.desc(), GameHistory.id.desc()).limit(limit + 1).all()
+    
+    page = {
+        'items': [{
+            'id': row.id,
+            'game_type': row.game_type,
+            'broscute_earned': row.broscute_earned,
+            'created_at': row.created_at.isoformat() if row.created_at else None
+        } for row in rows[:limit]],
+        'next_cursor': encode_history_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+    }
+    
+    if with_totals is None:
+        with_totals = cursor is None
+    if with_totals:
+        totals = db.session.query(
+            GameHistory.game_type, db.func.count(GameHistory.id), db.func.sum(GameHistory.broscute_earned)
+        ).filter(*filters).group_by(GameHistory.game_type).all()
+        page['totals'] = {kind: {'count': count, 'broscute': int(total or 0)} for kind, count, total in totals}
+    return page
+
+# Authenticated user loading
+# Un singur punct de încărcare pentru utilizatorul din sesiune: proiecție pe coloane
+# per rută, cache per request (flask.g) și cache opțional per worker cu TTL scurt
+# pentru paginile read-only (USER_CACHE_TTL_SECONDS=0 îl dezactivează).
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", 0))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", 10000))
+
+# Column projections used by the routes
+MINING_STATUS_COLUMNS = ('broscute_points', 'mining_started_at')
+STAKING_COLUMNS = ('staked_amount', 'staking_start_date', 'staking_rewards')
+NAME_COLUMNS = ('telegram_id', 'first_name', 'last_name')
+LEDGER_BALANCE_COLUMNS = frozenset(('broscute_points', 'total_earned'))  # completate din ledger în BALANCE_MODE=ledger
+
+class UserCache:
+    """Per-worker LRU of detached user snapshots with a short TTL"""
+
+    def __init__(self, ttl=USER_CACHE_TTL_SECONDS, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires, snapshot = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def put(self, user):
+        snapshot = SimpleNamespace(**{column.key: getattr(user, column.key) for column in WebUser.__table__.columns})
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
 
-@app.route('/', methods=['GET', 'HEAD', 'POST'])
+user_cache = UserCache()
+
+def load_user(user_id, columns=None):
+    """Load one WebUser with only `columns` (None = full row) and the ledger balance overlay, or None"""
+    query = db.session.query(WebUser).filter(WebUser.id == user_id)
+    if columns is not None:
+        query = query.options(load_only(*(getattr(WebUser, column) for column in columns)))
+    user = query.first()
+    if user is not None and ledger_mode() and (columns is None or not LEDGER_BALANCE_COLUMNS.isdisjoint(columns)):
+        apply_ledger_balance(user)
+    return user
+
+def load_current_user(columns=None, cached=False):
+    """Return the logged-in WebUser (or None) loading only `columns` plus the primary key.
+
+    columns=None loads the full row. The result is memoized on flask.g, so later
+    calls in the same request reuse it and fetch only the missing columns.
+    cached=True may return a read-only snapshot from the per-worker TTL cache.
+    """
+    user_id = session.get('user_id')
+    if user_id is None:
+        return None
+    
+    user = g.get('current_user')
+    if user is not None and user.id == user_id:
+        unloaded = sa_inspect(user).unloaded
+        missing = unloaded if columns is None else unloaded.intersection(columns)
+        if missing:
+            db.session.refresh(user, attribute_names=list(missing))
+            if ledger_mode() and not missing.isdisjoint(LEDGER_BALANCE_COLUMNS):
+                apply_ledger_balance(user)
+        return user
+    
+    if cached and user_cache.ttl > 0:
+        snapshot = user_cache.get(user_id)
+        if snapshot is not None:
+            return snapshot
+    
+    user = load_user(user_id, columns)
+    if user is None:
+        return None
+    
+    g.current_user = user
+    if cached and columns is None and user_cache.ttl > 0:
+        user_cache.put(user)
+    return user
+
+def user_required(columns=None, api=False, cached=False):
+    """Route decorator that loads the session user and passes it as the first argument"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if 'user_id' not in session:
+                if api:
+                    return jsonify({'error': 'Not authenticated'}), 401
+                return redirect('/login')
+            
+            user = load_current_user(columns, cached=cached)
+            if user is None:
+                if api:
+                    return jsonify({'error': 'User not found'}), 404
+                return redirect('/logout')
+            
+            return view(user, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Conditional page rendering
+# Paginile care depind doar de rândul utilizatorului primesc ETag/Last-Modified din
+# WebUser.updated_at: un GET condițional se rezolvă din rândul din user_cache (sau un singur
+# SELECT al rândului complet, refolosit și la randare) și un 304, fără randare. HTML-ul randat
+# se păstrează per worker (LRU pe ETag), astfel că o vizită fără cache de browser (WebView-ul
+# Telegram) nu mai trece prin Jinja cât timp rândul nu s-a schimbat.
+PAGE_RENDER_CACHE_SIZE = int(os.environ.get("PAGE_RENDER_CACHE_SIZE", 2000))
+# Același în toți workerii: un deploy nou (template-uri noi) invalidează ETag-urile vechi
+PAGE_BUILD_ID = os.environ.get("RENDER_GIT_COMMIT") or str(int(os.path.getmtime(__file__)))
+
+class PageRenderCache:
+    """Per-worker LRU of rendered page bodies keyed by (endpoint, etag)"""
+
+    def __init__(self, max_entries=PAGE_RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+page_render_cache = PageRenderCache()
+
+def page_validators(user):
+    """(etag, last_modified) for the current endpoint and user row, or (None, None) if unknown"""
+    if user.updated_at is None:
+        return None, None
+    version = f"{PAGE_BUILD_ID}:{request.endpoint}:{user.id}:{user.updated_at.isoformat()}"
+    if ledger_mode():
+        # Creditele din ledger nu ating updated_at: poziția din ledger intră în ETag
+        version += f":{ledger_position(user.id)}"
+    etag = hashlib.sha1(version.encode()).hexdigest()[:20]
+    return etag, user.updated_at.replace(microsecond=0, tzinfo=timezone.utc)
+
+def conditional_user_page(view):
+    """Like user_required(cached=True) for pages rendered only from the user row, with 304 revalidation"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'user_id' not in session:
+            return redirect('/login')
+        
+        # Rândul complet o singură dată: din el vin și validatorii, și datele pentru randare
+        user = load_current_user(cached=True)
+        if user is None:
+            return redirect('/logout')
+        
+        # Mesajele flash se consumă la randare: pagina nu e cacheabilă cât timp există
+        etag, last_modified = page_validators(user) if '_flashes' not in session else (None, None)
+        if etag is None:
+            return view(user, *args, **kwargs)
+        
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            body = page_render_cache.get((request.endpoint, etag))
+            if body is None:
+                body = view(user, *args, **kwargs)
+                page_render_cache.put((request.endpoint, etag), body)
+            response = current_app.make_response(body)
+        
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+# Mining progress events
+# În loc de poll pe /api/mining/status, pagina de mining deschide un EventSource pe
+# /api/mining/events: primește o singură dată începutul/sfârșitul sesiunii și calculează
+# progresul local. Fără hold (implicit, potrivit workerilor sync) răspunsul se închide imediat
+# cu `retry` până la maturizare, deci browserul revine exact când sesiunea se termină și niciun
+# thread nu rămâne ocupat; schimbările de sold NU sunt împinse în acest mod (pagina le vede la
+# următoarea reconectare). Cu MINING_EVENTS_HOLD_SECONDS > 0 (workeri gevent) conexiunea
+# așteaptă și trimite un eveniment la maturizare sau la o schimbare de sold din același worker.
+MINING_SESSION_SECONDS = 86400
+MINING_EVENTS_HOLD_SECONDS = float(os.environ.get("MINING_EVENTS_HOLD_SECONDS", 0))
+MINING_EVENTS_RETRY_MAX_SECONDS = int(os.environ.get("MINING_EVENTS_RETRY_MAX_SECONDS", 3600))
+MINING_STATUS_MAX_AGE = int(os.environ.get("MINING_STATUS_MAX_AGE", 60))
+
+class BalanceNotifier:
+    """Per-worker wake-ups for requests waiting on a user's balance or mining state"""
+
+    def __init__(self):
+        self._waiters = {}
+        self._lock = threading.Lock()
+
+    def wait(self, user_id, timeout):
+        """Block up to `timeout` seconds; True if notify(user_id) was called meanwhile"""
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(user_id, set()).add(event)
+        try:
+            return event.wait(timeout)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(user_id)
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[user_id]
+
+    def notify(self, user_id):
+        with self._lock:
+            for event in self._waiters.get(user_id, ()):
+                event.set()
+
+balance_notifier = BalanceNotifier()
+
+def mining_state(user, now):
+    """Mining session snapshot sent to the client once; progress is computed client-side"""
+    started_at = user.mining_started_at
+    ends_at = started_at + timedelta(seconds=MINING_SESSION_SECONDS) if started_at else None
+    remaining = max(0, int((ends_at - now).total_seconds())) if ends_at else 0
+    return {
+        'started_at': started_at.isoformat() if started_at else None,
+        'ends_at': ends_at.isoformat() if ends_at else None,
+        'duration': MINING_SESSION_SECONDS,
+        'server_time': now.isoformat(),
+        'can_start': started_at is None,
+        'is_mining': remaining > 0,
+        'can_claim': started_at is not None and remaining == 0,
+        'remaining_time': remaining,
+        'current_balance': user.broscute_points
+    }
+
+def sse_event(name, data, retry=None):
+    lines = [f"retry: {int(retry * 1000)}"] if retry is not None else []
+    lines += [f"event: {name}", f"data: {json.dumps(data)}"]
+    return '\n'.join(lines) + '\n\n'
+
+# Idempotency keys
+# Clienții WebApp pot trimite header-ul Idempotency-Key pe POST-urile care modifică soldul. Prima
+# cerere rezervă cheia (rând în idempotency_keys, unic pe user + cheie), rulează ruta și salvează
+# răspunsul JSON; o reîncercare cu aceeași cheie primește răspunsul salvat fără să atingă
+# web_users: din LRU-ul workerului, altfel dintr-un SELECT pe cheia primară. Erorile 5xx nu se
+# salvează (clientul poate reîncerca), iar o reîncercare cât timp prima cerere rulează primește 409.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 86400))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_PENDING_SECONDS = int(os.environ.get("IDEMPOTENCY_PENDING_SECONDS", 60))  # rezervare abandonată (worker oprit)
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    
+    user_id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(IDEMPOTENCY_KEY_MAX_LENGTH), primary_key=True)
+    endpoint = db.Column(db.String(100), nullable=False)
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 al endpoint-ului + body
+    status_code = db.Column(db.Integer)  # NULL cât timp prima cerere rulează
+    body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class IdempotencyCache:
+    """Per-worker LRU of completed (fingerprint, status_code, body) responses with a TTL"""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL_SECONDS, max_entries=IDEMPOTENCY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires, stored = entry
+            if expires < time.monotonic():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return stored
+
+    def put(self, cache_key, stored, age=0):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic() + self.ttl - age, stored)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+idempotency_cache = IdempotencyCache()
+
+def idempotent_replay(stored):
+    fingerprint, status_code, body = stored
+    response = current_app.response_class(body, status=status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def reserve_idempotency_key(user_id, key, fingerprint, now):
+    """Insert the pending row for `key`; return the existing IdempotencyKey row if it is taken"""
+    for _ in range(2):
+        try:
+            db.session.add(IdempotencyKey(user_id=user_id, key=key, endpoint=request.endpoint,
+                                          fingerprint=fingerprint, created_at=now))
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        existing = db.session.get(IdempotencyKey, (user_id, key))
+        if existing is None:
+            continue
+        expired = existing.created_at < now - timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+        abandoned = existing.status_code is None and existing.created_at < now - timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS)
+        if not (expired or abandoned):
+            return existing
+        # Cheie expirată sau rezervare rămasă de la un worker oprit: se ia de la capăt
+        db.session.execute(db.delete(IdempotencyKey).where(
+            IdempotencyKey.user_id == user_id, IdempotencyKey.key == key,
+            IdempotencyKey.created_at == existing.created_at
+        ))
+        db.session.commit()
+    return db.session.get(IdempotencyKey, (user_id, key))
+
+def release_idempotency_key(user_id, key):
+    db.session.rollback()
+    db.session.execute(db.delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+    ))
+    db.session.commit()
+
+def idempotent(view):
+    """Replay the stored JSON response of a POST repeated with the same Idempotency-Key header"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        user_id = session.get('user_id')
+        if not key or user_id is None:
+            return view(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'error': f'Idempotency-Key prea lung (max {IDEMPOTENCY_KEY_MAX_LENGTH} caractere)'}), 400
+        
+        fingerprint = hashlib.sha256(request.endpoint.encode() + b'\0' + request.get_data()).hexdigest()
+        cache_key = (user_id, key)
+        stored = idempotency_cache.get(cache_key)
+        if stored is None:
+            now = datetime.utcnow()
+            existing = reserve_idempotency_key(user_id, key, fingerprint, now)
+            if existing is not None:
+                if existing.fingerprint != fingerprint:
+                    return jsonify({'error': 'Idempotency-Key folosit deja pentru altă cerere'}), 422
+                if existing.status_code is None:
+                    return jsonify({'error': 'Cererea cu acest Idempotency-Key este încă în curs'}), 409
+                stored = (existing.fingerprint, existing.status_code, existing.body)
+                idempotency_cache.put(cache_key, stored, age=(now - existing.created_at).total_seconds())
+        if stored is not None:
+            if stored[0] != fingerprint:
+                return jsonify({'error': 'Idempotency-Key folosit deja pentru altă cerere'}), 422
+            return idempotent_replay(stored)
+        
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            release_idempotency_key(user_id, key)
+            raise
+        if response.status_code >= 500 or not response.is_json:
+            release_idempotency_key(user_id, key)
+            return response
+        
+        stored = (fingerprint, response.status_code, response.get_data(as_text=True))
+        try:
+            db.session.execute(db.update(IdempotencyKey).where(
+                IdempotencyKey.user_id == user_id, IdempotencyKey.key == key
+            ).values(status_code=stored[1], body=stored[2]))
+            db.session.commit()
+        except Exception as e:
+            # Răspunsul a fost deja produs: se trimite, doar reîncercările nu vor mai fi deduplicate
+            db.session.rollback()
+            logger.error("Error storing idempotent response: %s", e)
+            return response
+        idempotency_cache.put(cache_key, stored)
+        return response
+    return wrapper
+
+def purge_idempotency_keys(now=None):
+    """Delete keys older than IDEMPOTENCY_TTL_SECONDS; return the number of rows removed"""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+    result = db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))
+    db.session.commit()
+    return result.rowcount
+
+# Schema migrations
+# Rulate o singură dată per deploy (`flask --app flask_app db-upgrade`, pasul de release /
+# pre-deploy), nu la importul modulului în fiecare worker gunicorn. Pe PostgreSQL indexurile
+# se construiesc CONCURRENTLY ca tabelele live să nu fie blocate la scriere.
+MIGRATION_LOCK_ID = 7245410  # cheia pg_advisory_lock care serializează deploy-uri concurente
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def create_index(connection, name, table, columns, where=None):
+    """CREATE INDEX [CONCURRENTLY] IF NOT EXISTS, replacing an invalid leftover from an interrupted build"""
+    if connection.dialect.name == 'postgresql':
+        invalid = connection.execute(db.text(
+            "SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {'name': name}).first()
+        if invalid:
+            connection.execute(db.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        sql = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"
+    else:
+        sql = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+    if where:
+        sql += f" WHERE {where}"
+    connection.execute(db.text(sql))
+
+def drop_index(connection, name):
+    """DROP INDEX [CONCURRENTLY] IF EXISTS"""
+    concurrently = ' CONCURRENTLY' if connection.dialect.name == 'postgresql' else ''
+    connection.execute(db.text(f"DROP INDEX{concurrently} IF EXISTS {name}"))
+
+def add_column(connection, table, column, ddl):
+    """ALTER TABLE ADD COLUMN unless the column already exists (fresh databases get it from migration 1)"""
+    if column not in {existing['name'] for existing in db.inspect(connection).get_columns(table)}:
+        connection.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+MIGRATIONS = [
+    (1, 'baseline tables', lambda connection: db.metadata.create_all(bind=connection)),
+    (2, 'game_history (user_id, created_at)', lambda connection: create_index(
+        connection, 'ix_game_history_user_id_created_at', 'game_history', 'user_id, created_at')),
+    (3, 'game_history (created_at)', lambda connection: create_index(
+        connection, 'ix_game_history_created_at', 'game_history', 'created_at')),
+    (4, 'web_users (broscute_points DESC) WHERE broscute_points > 0', lambda connection: create_index(
+        connection, 'ix_web_users_broscute_points_positive', 'web_users', 'broscute_points DESC',
+        where='broscute_points > 0')),
+    (5, 'web_users (last_daily_game) WHERE last_daily_game IS NOT NULL', lambda connection: create_index(
+        connection, 'ix_web_users_last_daily_game', 'web_users', 'last_daily_game',
+        where='last_daily_game IS NOT NULL')),
+    (6, 'web_users (referred_by) WHERE referred_by IS NOT NULL', lambda connection: create_index(
+        connection, 'ix_web_users_referred_by', 'web_users', 'referred_by',
+        where='referred_by IS NOT NULL')),
+    (7, 'airdrop_batches', lambda connection: AirdropBatch.__table__.create(bind=connection, checkfirst=True)),
+    (8, 'idempotency_keys', lambda connection: IdempotencyKey.__table__.create(bind=connection, checkfirst=True)),
+    (9, 'balance_ledger', lambda connection: BalanceLedger.__table__.create(bind=connection, checkfirst=True)),
+    (10, 'web_users (updated_at)', lambda connection: create_index(
+        connection, 'ix_web_users_updated_at', 'web_users', 'updated_at')),
+    # Settlement-ul per utilizator nu mai e citit de nimic: rămân doar totalurile din staking_epochs
+    (11, 'drop staking_settlements', lambda connection: connection.execute(db.text("DROP TABLE IF EXISTS staking_settlements"))),
+    # Sesiunile de mining nu mai folosesc last_daily_game. Coloana nouă pornește goală: un
+    # last_daily_game existent nu spune dacă a fost un start de mining sau un joc zilnic,
+    # deci sesiunile pornite înainte de deploy trebuie repornite din /api/mining/start.
+    (12, 'web_users.mining_started_at', lambda connection: add_column(
+        connection, 'web_users', 'mining_started_at', 'TIMESTAMP NULL')),
+    (13, 'web_users (mining_started_at) WHERE mining_started_at IS NOT NULL', lambda connection: create_index(
+        connection, 'ix_web_users_mining_started_at', 'web_users', 'mining_started_at',
+        where='mining_started_at IS NOT NULL')),
+    (14, 'drop web_users (last_daily_game) index', lambda connection: drop_index(
+        connection, 'ix_web_users_last_daily_game')),
+]
+
+# Indexurile de care au nevoie interogările aplicației: (interogare, tabel, coloane în ordine)
+QUERY_INDEX_REQUIREMENTS = [
+    ('session user load / balance UPDATE by id', 'web_users', ('id',)),
+    ('bot and /telegram_auth lookup by telegram_id', 'web_users', ('telegram_id',)),
+    ('leaderboard index rebuild, analytics active users (broscute_points > 0)', 'web_users', ('broscute_points',)),
+    ('leaderboard sync (updated_at >= ...)', 'web_users', ('updated_at',)),
+    ('/istoric per-user history ordered by created_at', 'game_history', ('user_id', 'created_at')),
+    ('analytics 7-day activity (created_at >= ...)', 'game_history', ('created_at',)),
+    ('mining auto-settlement (matured / upcoming mining_started_at)', 'web_users', ('mining_started_at',)),
+    ('referral recompute (children by referred_by)', 'web_users', ('referred_by',)),
+    ('referral signup lookup by code', 'web_users', ('referral_code',)),
+    ('Idempotency-Key lookup by user and key', 'idempotency_keys', ('user_id', 'key')),
+    ('idempotency-purge (created_at < ...)', 'idempotency_keys', ('created_at',)),
+    ('ledger balance (pending rows by user_id)', 'balance_ledger', ('user_id',)),
+]
+
+def run_migrations():
+    """Apply pending migrations; safe to run concurrently from several deploys"""
+    applied_now = []
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        if postgres:
+            connection.execute(db.text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_ID})
+        try:
+            SchemaMigration.__table__.create(connection, checkfirst=True)
+            applied = set(connection.execute(db.select(SchemaMigration.version)).scalars())
+            for version, name, migrate in MIGRATIONS:
+                if version in applied:
+                    continue
+                started = time.perf_counter()
+                migrate(connection)
+                connection.execute(db.insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.utcnow()))
+                logger.info("Applied migration %s (%s) in %.2fs", version, name, time.perf_counter() - started)
+                applied_now.append(version)
+        finally:
+            if postgres:
+                connection.execute(db.text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_ID})
+    return applied_now
+
+def check_indexes():
+    """Return (pending migration versions, [(query, table, columns)] without a supporting index)"""
+    inspector = db.inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    applied = set()
+    if SchemaMigration.__tablename__ in tables:
+        applied = set(db.session.execute(db.select(SchemaMigration.version)).scalars())
+    pending = [version for version, _, _ in MIGRATIONS if version not in applied]
+    
+    missing = []
+    for query, table, columns in QUERY_INDEX_REQUIREMENTS:
+        if table not in tables:
+            missing.append((query, table, columns))
+            continue
+        candidates = [tuple(index['column_names']) for index in inspector.get_indexes(table)]
+        candidates += [tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table)]
+        candidates.append(tuple(inspector.get_pk_constraint(table)['constrained_columns']))
+        if not any(candidate[:len(columns)] == columns for candidate in candidates):
+            missing.append((query, table, columns))
+    return pending, missing
+
+@bp.route('/', methods=['GET', 'HEAD', 'POST'])
 def root():
     """
     Root endpoint - PRIMARY health check for deployment
     Guaranteed HTTP 200 response for Autoscale health checks
     """
     try:
-        # Log the request for debugging
-        remote_addr = getattr(request, 'remote_addr', 'unknown') or 'unknown'
-        logger.info(f"Request: {request.method} {request.path} from {remote_addr}")
-        logger.info(f"User-Agent: {request.headers.get('User-Agent', 'Unknown')}")
-        
         # Detect health check vs browser requests
         user_agent = request.headers.get('User-Agent', '').lower()
         is_health_check = any(agent in user_agent for agent in [
@@ -172,10 +2677,10 @@ def root():
         
     except Exception as e:
         # Even on error, return HTTP 200 for deployment health checks
-        logger.error(f"Error in root endpoint: {e}")
+        logger.error("Error in root endpoint: %s", e)
         return "OK", 200
 
-@app.route('/health', methods=['GET', 'HEAD'])
+@bp.route('/health', methods=['GET', 'HEAD'])
 def health():
     """Health check endpoint"""
     return jsonify({
@@ -184,12 +2689,12 @@ def health():
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
-@app.route('/ping', methods=['GET', 'HEAD'])
+@bp.route('/ping', methods=['GET', 'HEAD'])
 def ping():
     """Simple ping endpoint"""
     return "OK", 200
 
-@app.route('/status', methods=['GET', 'HEAD'])
+@bp.route('/status', methods=['GET', 'HEAD'])
 def status():
     """Status endpoint with environment info"""
     return jsonify({
@@ -198,32 +2703,50 @@ def status():
         'environment': os.environ.get("FLASK_ENV", "development"),
         'port': os.environ.get("PORT", "5000"),
         'python_version': sys.version.split()[0],
+        'startup_ms': STARTUP_TIMINGS,
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
-@app.route('/readiness', methods=['GET', 'HEAD'])
+@bp.route('/readiness', methods=['GET', 'HEAD'])
 def readiness():
-    """Kubernetes-style readiness probe"""
-    return jsonify({'ready': True, 'timestamp': datetime.utcnow().isoformat()}), 200
+    """Kubernetes-style readiness probe (cached background DB check)"""
+    db_health.start(current_app._get_current_object())
+    return jsonify(dict(db_health.state, timestamp=datetime.utcnow().isoformat())), 200
 
-@app.route('/liveness', methods=['GET', 'HEAD'])
+@bp.route('/liveness', methods=['GET', 'HEAD'])
 def liveness():
     """Kubernetes-style liveness probe"""
     return jsonify({'alive': True, 'timestamp': datetime.utcnow().isoformat()}), 200
 
-@app.route('/dashboard')
+@bp.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    if not METRICS_PUBLIC and not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    return Response(metrics_payload(), mimetype=CONTENT_TYPE_LATEST)
+
+@bp.route('/debug/sql-profile/<profile_id>')
+def sql_profile_detail(profile_id):
+    """Statements recorded for one profiled request (same worker only)"""
+    if not SQL_PROFILE and not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    profile = get_sql_profile(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return jsonify(profile.to_dict())
+
+@bp.route('/dashboard')
 def dashboard():
     """Main web dashboard for MarioCoinAMG"""
     try:
         if 'user_id' not in session:
             return redirect('/login')
         
-        user = WebUser.query.get(session['user_id'])
+        user = load_current_user(cached=True)
         if not user:
             return redirect('/logout')
         
-        # Calculate pending staking rewards
-        pending_rewards = calculate_staking_rewards(user) - user.staking_rewards
+        pending_rewards = pending_staking_rewards(user)
         
         return render_template('dashboard.html', 
                              user=user, 
@@ -237,20 +2760,20 @@ def dashboard():
                              jupiter_url=JUPITER_SWAP_URL,
                              phantom_url=PHANTOM_URL)
     except Exception as e:
-        logger.error(f"Error in dashboard: {e}")
+        logger.error("Error in dashboard: %s", e)
         # Fallback for template issues
         return jsonify({
             'status': 'dashboard_error',
             'message': 'Dashboard temporarily unavailable',
             'redirect': '/login'
         }), 200
-@app.route('/login')
+@bp.route('/login')
 def login():
     """Login page"""
     try:
         return render_template('login.html')
     except Exception as e:
-        logger.error(f"Error in login: {e}")
+        logger.error("Error in login: %s", e)
         # Fallback simple login
         return '''
         <!DOCTYPE html>
@@ -264,8 +2787,8 @@ def login():
         </html>
         '''
 
-@app.route('/quick-login')
-@app.route('/quick_login')
+@bp.route('/quick-login')
+@bp.route('/quick_login')
 def quick_login():
     """Quick login for testing"""
     try:
@@ -282,26 +2805,28 @@ def quick_login():
             )
             db.session.add(test_user)
             db.session.commit()
+            record_new_user(test_user)
         else:
             # Update existing test user with real name
             test_user.first_name = 'Utilizator'
             test_user.last_name = 'Real'
             test_user.username = 'utilizator_real'
             db.session.commit()
+            user_cache.invalidate(test_user.id)
         
         session['user_id'] = test_user.id
         return redirect('/dashboard')
     except Exception as e:
-        logger.error(f"Error in quick_login: {e}")
+        logger.error("Error in quick_login: %s", e)
         return "Login error - check logs", 500
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Logout user"""
     session.clear()
     return redirect('/login')
 
-@app.route('/telegram_auth', methods=['POST'])
+@bp.route('/telegram_auth', methods=['POST'])
 def telegram_auth():
     """Handle Telegram WebApp authentication"""
     try:
@@ -319,28 +2844,23 @@ def telegram_auth():
         user = WebUser.query.filter_by(telegram_id=telegram_id).first()
         
         if not user:
-            user = WebUser(
-                telegram_id=telegram_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                broscute_points=100,  # Bonus de înregistrare
-                mario_tokens=0,
-                total_earned=100,
-                google_form_completed=True  # Acces complet
-            )
-            db.session.add(user)
-            db.session.commit()
+            # Codul de referral vine din link (?ref=) sau din start_param-ul WebApp-ului Telegram
+            referral_code = next((
+                value for value in (data.get('referral_code'), data.get('start_param'), data.get('ref'))
+                if isinstance(value, str) and value.strip()
+            ), None)
+            user = register_user(telegram_id, username, first_name, last_name, referral_code=referral_code)
             
-            logger.info(f"Created new Telegram user: {first_name} {last_name} (ID: {telegram_id})")
+            logger.info("Created new Telegram user: %s %s (ID: %s)", first_name, last_name, telegram_id)
         else:
             # Actualizează numele dacă s-a schimbat
             user.first_name = first_name
             user.last_name = last_name
             user.username = username
             db.session.commit()
+            user_cache.invalidate(user.id)
             
-            logger.info(f"Updated existing Telegram user: {first_name} {last_name} (ID: {telegram_id})")
+            logger.info("Updated existing Telegram user: %s %s (ID: %s)", first_name, last_name, telegram_id)
         
         # Setează sesiunea
         session['user_id'] = user.id
@@ -357,10 +2877,10 @@ def telegram_auth():
         })
         
     except Exception as e:
-        logger.error(f"Error in Telegram auth: {e}")
+        logger.error("Error in Telegram auth: %s", e)
         return jsonify({'success': False, 'error': 'Eroare la autentificare'}), 500
 
-@app.route('/update_user_name', methods=['POST'])
+@bp.route('/update_user_name', methods=['POST'])
 def update_user_name():
     """Update user's real name from Telegram"""
     try:
@@ -369,7 +2889,7 @@ def update_user_name():
         if 'user_id' not in session:
             return jsonify({'success': False, 'error': 'Not authenticated'}), 401
         
-        user = WebUser.query.get(session['user_id'])
+        user = load_current_user(NAME_COLUMNS)
         if not user:
             return jsonify({'success': False, 'error': 'User not found'}), 404
         
@@ -383,8 +2903,9 @@ def update_user_name():
             user.last_name = last_name
             
         db.session.commit()
+        user_cache.invalidate(user.id)
         
-        logger.info(f"Updated user name: {first_name} {last_name} (ID: {user.telegram_id})")
+        logger.info("Updated user name: %s %s (ID: %s)", first_name, last_name, user.telegram_id)
         
         return jsonify({
             'success': True,
@@ -396,334 +2917,291 @@ def update_user_name():
         })
         
     except Exception as e:
-        logger.error(f"Error updating user name: {e}")
+        logger.error("Error updating user name: %s", e)
         return jsonify({'success': False, 'error': 'Eroare la actualizare'}), 500
 
-@app.route('/update_name')
-def update_name_page():
+@bp.route('/update_name')
+@user_required(NAME_COLUMNS)
+def update_name_page(user):
     """Page to update user's real name"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('update_name.html', user=user)
 
-@app.route('/token_conversion')
-def token_conversion():
+@bp.route('/token_conversion')
+@conditional_user_page
+def token_conversion(user):
     """Token conversion information page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('token_conversion.html', user=user)
 
 # DEZACTIVAT PENTRU SECURITATE - endpoint vulnerabil eliminat
-# @app.route('/test-user') - BLOCAT: genera utilizatori ficțivi neautorizați
+# @bp.route('/test-user') - BLOCAT: genera utilizatori ficțivi neautorizați
 
-@app.route('/play/daily', methods=['POST'])
+@bp.route('/play/daily', methods=['POST'])
+@idempotent
 def play_daily_game():
     """Play daily game"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    try:
+        # Cooldown check, credit and history in one statement
+        result, reward = play_daily_for(session['user_id'])
+    except Exception as e:
+        logger.error("Error playing daily game: %s", e)
+        return jsonify({'error': 'Failed to play daily game'}), 500
     
-    if not can_play_daily_game(user):
+    if result is None:
+        if load_current_user(('last_daily_game',)) is None:
+            return jsonify({'error': 'User not found'}), 404
         return jsonify({'error': 'Daily game on cooldown'}), 400
     
-    # Game logic
-    reward = random.randint(10, 100)
-    
-    # Update user
-    user.broscute_points += reward
-    user.total_earned += reward
-    user.last_daily_game = datetime.utcnow()
-    
-    db.session.commit()
-    
-    logger.info(f"User {user.telegram_id} played daily game and won {reward} broșcuțe")
+    logger.info("User %s played daily game and won %s broșcuțe", result.telegram_id, reward)
     
     return jsonify({
         'success': True,
         'reward': reward,
-        'new_balance': user.broscute_points,
+        'new_balance': result.broscute_points,
         'message': f'Felicitări! Ai câștigat {reward} broșcuțe!'
     })
 
-@app.route('/play/luck', methods=['POST'])
+@bp.route('/play/luck', methods=['POST'])
+@idempotent
 def play_luck_game():
     """Play luck game"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    try:
+        result, reward = play_luck_for(session['user_id'])
+    except Exception as e:
+        logger.error("Error playing luck game: %s", e)
+        return jsonify({'error': 'Failed to play luck game'}), 500
     
-    if not can_play_luck_game(user):
+    if result is None:
+        if load_current_user(('last_luck_game',)) is None:
+            return jsonify({'error': 'User not found'}), 404
         return jsonify({'error': 'Luck game on cooldown'}), 400
     
-    # Game logic
-    reward = random.randint(5, 50)
-    
-    # Update user
-    user.broscute_points += reward
-    user.total_earned += reward
-    user.last_luck_game = datetime.utcnow()
-    
-    db.session.commit()
-    
-    logger.info(f"User {user.telegram_id} played luck game and won {reward} broșcuțe")
+    logger.info("User %s played luck game and won %s broșcuțe", result.telegram_id, reward)
     
     return jsonify({
         'success': True,
         'reward': reward,
-        'new_balance': user.broscute_points,
+        'new_balance': result.broscute_points,
         'message': f'Noroc! Ai câștigat {reward} broșcuțe!'
     })
 
-@app.route('/mining')
-def mining_page():
+@bp.route('/mining')
+@conditional_user_page
+def mining_page(user):
     """Mining application page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('mining.html', user=user)
 
-@app.route('/games')
-def games_page():
+@bp.route('/games')
+@conditional_user_page
+def games_page(user):
     """Games page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('games.html', user=user)
 
-@app.route('/analytics')
-def analytics_page():
+@bp.route('/analytics')
+@user_required(cached=True)
+def analytics_page(user):
     """Analytics dashboard page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
-    return render_template('analytics.html', user=user)
-    # Calculate analytics data
+    # Read the precomputed snapshot (one primary-key lookup) and the top 10 from the rank index
     try:
-        # Total users count
-        total_users = db.session.query(WebUser).count()
-        
-        # Total broșcuțe in circulation
-        total_broscute = db.session.query(db.func.sum(WebUser.broscute_points)).scalar() or 0
-        
-        # Total MARIO tokens distributed
-        total_mario = db.session.query(db.func.sum(WebUser.mario_tokens)).scalar() or 0
-        
-        # Active users (users with any points)
-        active_users = db.session.query(WebUser).filter(WebUser.broscute_points > 0).count()
-        
-        # Recent activity (last 7 days)
-        recent_activity = db.session.query(GameHistory).filter(
-            GameHistory.created_at >= datetime.utcnow() - timedelta(days=7)
-        ).count()
-        
-        # Top 10 users by broscute_points
-        top_users = db.session.query(WebUser).filter(WebUser.broscute_points > 0).order_by(WebUser.broscute_points.desc()).limit(10).all()
+        start_analytics_reconciler(current_app._get_current_object())
+        snapshot = db.session.get(AnalyticsSnapshot, ANALYTICS_SNAPSHOT_ID)
+        if snapshot is None:
+            snapshot = reconcile_analytics()
         
         analytics_data = {
-            'total_users': total_users,
-            'total_broscute': total_broscute,
-            'total_mario': total_mario,
-            'active_users': active_users,
-            'recent_activity': recent_activity,
-            'conversion_rate': round((active_users / total_users * 100) if total_users > 0 else 0, 1)
+            'total_users': snapshot.total_users,
+            'total_broscute': snapshot.total_broscute,
+            'total_mario': snapshot.total_mario,
+            'active_users': snapshot.active_users,
+            'recent_activity': snapshot.recent_activity,
+            'conversion_rate': round((snapshot.active_users / snapshot.total_users * 100) if snapshot.total_users > 0 else 0, 1),
+            'updated_at': snapshot.updated_at.isoformat() if snapshot.updated_at else None,
+            'reconciled_at': snapshot.reconciled_at.isoformat() if snapshot.reconciled_at else None
         }
+        liability = staking_liability()
+        analytics_data['staking_liability'] = liability.total_liability if liability else None
+        analytics_data['staking_epoch'] = liability.epoch if liability else None
+        
+        leaderboard_index.ensure_fresh()
+        top_ids = [user_id for user_id, _ in leaderboard_index.top(10)]
+        users_by_id = {u.id: u for u in WebUser.query.filter(WebUser.id.in_(top_ids)).all()} if top_ids else {}
+        top_users = [users_by_id[user_id] for user_id in top_ids if user_id in users_by_id]
         
     except Exception as e:
-        logger.error(f"Error calculating analytics: {e}")
+        logger.error("Error calculating analytics: %s", e)
         analytics_data = {
             'total_users': 0,
             'total_broscute': 0,
             'total_mario': 0,
             'active_users': 0,
             'recent_activity': 0,
-            'conversion_rate': 0
+            'conversion_rate': 0,
+            'updated_at': None,
+            'reconciled_at': None,
+            'staking_liability': None,
+            'staking_epoch': None
         }
         top_users = []
     
     return render_template('analytics.html', user=user, analytics=analytics_data, top_users=top_users)
 
-@app.route('/staking')
-def staking_page():
+@bp.route('/staking')
+@user_required(cached=True)
+def staking_page(user):
     """Staking page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
-    # Calculate pending staking rewards
-    pending_rewards = calculate_staking_rewards(user) - user.staking_rewards
-    
-    return render_template('staking.html', user=user, pending_rewards=pending_rewards)
+    return render_template('staking.html', user=user, pending_rewards=pending_staking_rewards(user))
 
-@app.route('/history')
-def history_page():
+@bp.route('/history')
+@user_required(cached=True)
+def history_page(user):
     """Transaction history page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('history.html', user=user)
 
-@app.route('/leaderboard')
-def leaderboard_page():
-    """Leaderboard page"""
+@bp.route('/api/history', methods=['GET'])
+def history_api():
+    """Keyset-paginated game history for the logged-in user"""
     if 'user_id' not in session:
-        return redirect('/login')
+        return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
+    try:
+        since = request.args.get('from')
+        until = request.args.get('to')
+        page = fetch_history_page(
+            session['user_id'],
+            cursor=request.args.get('cursor'),
+            limit=request.args.get('limit', HISTORY_PAGE_SIZE),
+            game_type=request.args.get('game_type'),
+            since=datetime.fromisoformat(since) if since else None,
+            until=datetime.fromisoformat(until) if until else None
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Error fetching history: %s", e)
+        return jsonify({'error': 'Failed to fetch history'}), 500
     
-    # Get top users for leaderboard
+    page['success'] = True
+    return jsonify(page)
+
+@bp.route('/leaderboard')
+@user_required(cached=True)
+def leaderboard_page(user):
+    """Leaderboard page"""
+    # Get top users for leaderboard from the rank index
     try:
-        top_users = db.session.query(WebUser).filter(
-            WebUser.broscute_points > 0
-        ).order_by(WebUser.broscute_points.desc()).limit(20).all()
+        leaderboard_index.ensure_fresh()
+        top_ids = [user_id for user_id, _ in leaderboard_index.top(20)]
+        users_by_id = {u.id: u for u in WebUser.query.filter(WebUser.id.in_(top_ids)).all()} if top_ids else {}
+        top_users = [users_by_id[user_id] for user_id in top_ids if user_id in users_by_id]
+        user_rank = leaderboard_index.rank(user.id)
+        ranked_users = len(leaderboard_index)
         
-        logger.info(f"Leaderboard query returned {len(top_users)} users")
+        logger.info("Leaderboard index returned %s users", len(top_users))
         
     except Exception as e:
-        logger.error(f"Error fetching leaderboard: {e}")
+        logger.error("Error fetching leaderboard: %s", e)
         top_users = []
+        user_rank = None
+        ranked_users = 0
     
-    return render_template('leaderboard.html', user=user, top_users=top_users)
+    return render_template('leaderboard.html', user=user, top_users=top_users,
+                           user_rank=user_rank, ranked_users=ranked_users)
 
-@app.route('/referral')
-def referral_page():
+@bp.route('/referral')
+@conditional_user_page
+def referral_page(user):
     """Referral page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
-    return render_template('referral.html', user=user)
+    referral_code = user.referral_code or ensure_referral_code(user.id)
+    return render_template('referral.html', user=user, referral_code=referral_code, referral_link=referral_link(referral_code))
 
-@app.route('/memory-game')
-@app.route('/memory_game')
-def memory_game_page():
+@bp.route('/memory-game')
+@bp.route('/memory_game')
+@conditional_user_page
+def memory_game_page(user):
     """Memory game page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('memory_game.html', user=user)
 
-@app.route('/token-conversion')
-def token_conversion_page():
+@bp.route('/token-conversion')
+@conditional_user_page
+def token_conversion_page(user):
     """Token conversion page"""
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return redirect('/logout')
-    
     return render_template('token_conversion.html', user=user)
 
-@app.route('/complete-form', methods=['POST'])
+@bp.route('/complete-form', methods=['POST'])
 def complete_google_form():
     """Mark Google Form as completed"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    if user.google_form_completed:
-        return jsonify({'error': 'Google Form already completed'}), 400
-    
-    # Mark form as completed
-    user.google_form_completed = True
-    user.google_form_date = datetime.utcnow()
-    
     # Give bonus points for completing form
     form_bonus = 500
-    user.broscute_points += form_bonus
-    user.total_earned += form_bonus
+    now = datetime.utcnow()
     
-    db.session.commit()
+    try:
+        result = apply_balance_change(
+            session['user_id'], form_bonus, game_type='google_form',
+            where=(db.or_(WebUser.google_form_completed.is_(None), WebUser.google_form_completed == False),),
+            values={'google_form_completed': True, 'google_form_date': now}
+        )
+    except Exception as e:
+        logger.error("Error completing Google Form: %s", e)
+        return jsonify({'error': 'Failed to complete form'}), 500
+    
+    if result is None:
+        if load_current_user(('google_form_completed',)) is None:
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify({'error': 'Google Form already completed'}), 400
     
-    logger.info(f"User {user.telegram_id} completed Google Form and received {form_bonus} bonus")
+    logger.info("User %s completed Google Form and received %s bonus", result.telegram_id, form_bonus)
     
     return jsonify({
         'success': True,
         'bonus': form_bonus,
-        'new_balance': user.broscute_points,
+        'new_balance': result.broscute_points,
         'message': f'Formularul a fost completat! Ai primit {form_bonus} broșcuțe bonus!'
     })
 
-@app.route('/validate/distribution', methods=['POST'])
+@bp.route('/validate/distribution', methods=['POST'])
 def validate_distribution():
     """Validate distribution completion"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    if user.distribution_completed:
-        return jsonify({'error': 'Distribution already completed'}), 400
-    
     # Distribution bonus
     bonus = 300  # 300 broșcuțe bonus for distribution
+    now = datetime.utcnow()
     
-    user.distribution_completed = True
-    user.distribution_date = datetime.utcnow()
-    user.broscute_points += bonus
-    user.total_earned += bonus
+    try:
+        result = apply_balance_change(
+            session['user_id'], bonus, game_type='distribution',
+            where=(db.or_(WebUser.distribution_completed.is_(None), WebUser.distribution_completed == False),),
+            values={'distribution_completed': True, 'distribution_date': now}
+        )
+    except Exception as e:
+        logger.error("Error validating distribution: %s", e)
+        return jsonify({'error': 'Failed to validate distribution'}), 500
     
-    db.session.commit()
+    if result is None:
+        if load_current_user(('distribution_completed',)) is None:
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify({'error': 'Distribution already completed'}), 400
     
-    logger.info(f"User {user.telegram_id} completed distribution and received {bonus} broșcuțe")
+    logger.info("User %s completed distribution and received %s broșcuțe", result.telegram_id, bonus)
     
     return jsonify({
         'success': True,
         'message': f'Excelent! Ai primit {bonus} broșcuțe pentru distribuire!',
-        'new_balance': user.broscute_points,
+        'new_balance': result.broscute_points,
         'bonus': bonus
     })
 
-@app.route('/api/add_game_rewards', methods=['POST'])
+@bp.route('/api/add_game_rewards', methods=['POST'])
+@idempotent
 def add_game_rewards():
     """API endpoint to add game rewards to user account"""
     if 'user_id' not in session:
@@ -734,61 +3212,43 @@ def add_game_rewards():
     score = data.get('score', 0)
     rewards = data.get('rewards', 0)
     
-    user_id = session['user_id']
-    
     try:
-        user = WebUser.query.get(user_id)
-        if user:
-            user.broscute_points += rewards
-            user.total_earned += rewards
-            
-            # Add game history record
-            game_history = GameHistory(
-                user_id=user_id,
-                game_type=game_type,
-                broscute_earned=rewards
-            )
-            
-            db.session.add(game_history)
-            db.session.commit()
-            
-            logger.info(f"User {user.telegram_id} earned {rewards} broșcuțe from {game_type} game")
+        result = apply_balance_change(session['user_id'], rewards, game_type=game_type)
+        if result:
+            logger.info("User %s earned %s broșcuțe from %s game", result.telegram_id, rewards, game_type)
             
             return jsonify({
                 'success': True,
-                'new_balance': user.broscute_points,
+                'new_balance': result.broscute_points,
                 'rewards_added': rewards
             })
     except Exception as e:
-        logger.error(f"Error adding game rewards: {e}")
+        logger.error("Error adding game rewards: %s", e)
         return jsonify({'error': 'Failed to add rewards'}), 500
     
     return jsonify({'error': 'User not found'}), 404
 
-@app.route('/api/mining/start', methods=['POST'])
-def start_mining():
+@bp.route('/api/mining/start', methods=['POST'])
+@user_required(('telegram_id', 'mining_started_at'), api=True)
+def start_mining(user):
     """Start mining session and save to database"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
         # Check if user can start mining (24h cooldown)
-        if user.last_daily_game and (datetime.utcnow() - user.last_daily_game).total_seconds() < 86400:
-            remaining = 86400 - (datetime.utcnow() - user.last_daily_game).total_seconds()
+        if user.mining_started_at and (datetime.utcnow() - user.mining_started_at).total_seconds() < 86400:
+            remaining = 86400 - (datetime.utcnow() - user.mining_started_at).total_seconds()
             return jsonify({
                 'error': 'Mining cooldown active',
                 'remaining_seconds': int(remaining)
             }), 400
         
         # Update mining start time
-        user.last_daily_game = datetime.utcnow()
+        started_at = datetime.utcnow()
+        user.mining_started_at = started_at
         db.session.commit()
+        balance_notifier.notify(user.id)
+        mining_scheduler.schedule(started_at)
         
-        logger.info(f"User {user.telegram_id} started mining session")
+        logger.info("User %s started mining session", user.telegram_id)
         
         return jsonify({
             'success': True,
@@ -797,104 +3257,58 @@ def start_mining():
         })
         
     except Exception as e:
-        logger.error(f"Error starting mining: {e}")
+        logger.error("Error starting mining: %s", e)
         return jsonify({'error': 'Failed to start mining'}), 500
 
-@app.route('/api/mining/complete', methods=['POST'])
+@bp.route('/api/mining/complete', methods=['POST'])
 def complete_mining():
     """Complete mining session and award points"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
-        # Check if 24 hours have passed since mining started
-        if not user.last_daily_game:
-            return jsonify({'error': 'No active mining session'}), 400
+        # Award mining rewards and reset mining timer for next cycle, only if 24h have passed
+        mining_reward = MINING_REWARD  # 5000 broșcuțe per mining cycle
+        now = datetime.utcnow()
+        result = apply_balance_change(
+            session['user_id'], mining_reward, game_type='mining',
+            where=(mining_session_matured(now),),
+            values={'mining_started_at': now}
+        )
         
-        time_elapsed = (datetime.utcnow() - user.last_daily_game).total_seconds()
-        if time_elapsed < 86400:  # Less than 24 hours
-            remaining = 86400 - time_elapsed
+        if result is None:
+            user = load_current_user(('mining_started_at',))
+            if user is None:
+                return jsonify({'error': 'User not found'}), 404
+            if not user.mining_started_at:
+                return jsonify({'error': 'No active mining session'}), 400
+            remaining = 86400 - (now - user.mining_started_at).total_seconds()
             return jsonify({
                 'error': 'Mining not complete yet',
                 'remaining_seconds': int(remaining)
             }), 400
         
-        # Award mining rewards
-        mining_reward = 5000  # 5000 broșcuțe per mining cycle
-        user.broscute_points += mining_reward
-        user.total_earned += mining_reward
-        
-        # Reset mining timer for next cycle
-        user.last_daily_game = datetime.utcnow()
-        
-        # Add game history
-        game_history = GameHistory(
-            user_id=user.id,
-            game_type='mining',
-            broscute_earned=mining_reward
-        )
-        db.session.add(game_history)
-        
-        db.session.commit()
-        
-        logger.info(f"User {user.telegram_id} completed mining and earned {mining_reward} broșcuțe")
+        logger.info("User %s completed mining and earned %s broșcuțe", result.telegram_id, mining_reward)
         
         return jsonify({
             'success': True,
             'reward': mining_reward,
-            'new_balance': user.broscute_points,
-            'message': f'Mining completat! Ai câștigat {mining_reward} broșcuțe!'
-        })
-        
-    except Exception as e:
-        logger.error(f"Error completing mining: {e}")
-        return jsonify({'error': 'Failed to complete mining'}), 500
-        # Award mining rewards
-        mining_reward = 5000  # 5000 broșcuțe for 24h mining
-        user.broscute_points += mining_reward
-        user.total_earned += mining_reward
-        
-        # Add to game history
-        game_history = GameHistory(
-            user_id=user.id,
-            game_type='mining',
-            broscute_earned=mining_reward
-        )
-        
-        db.session.add(game_history)
-        db.session.commit()
-        
-        logger.info(f"User {user.telegram_id} completed mining and earned {mining_reward} broșcuțe")
-        
-        return jsonify({
-            'success': True,
-            'rewards': mining_reward,
-            'new_balance': user.broscute_points,
+            'new_balance': result.broscute_points,
             'message': f'Mining completat! Ai câștigat {mining_reward} broșcuțe!'
         })
         
     except Exception as e:
-        logger.error(f"Error completing mining: {e}")
+        logger.error("Error completing mining: %s", e)
         return jsonify({'error': 'Failed to complete mining'}), 500
 
-@app.route('/api/mining/status', methods=['GET'])
-def mining_status():
+@bp.route('/api/mining/status', methods=['GET'])
+@user_required(MINING_STATUS_COLUMNS, api=True)
+def mining_status(user):
     """Get current mining status for user"""
-    if 'user_id' not in session:
-        return jsonify({'error': 'Not authenticated'}), 401
-    
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
         current_time = datetime.utcnow()
         
-        if not user.last_daily_game:
+        if not user.mining_started_at:
             # No mining session started
             return jsonify({
                 'can_start': True,
@@ -903,7 +3317,7 @@ def mining_status():
                 'current_balance': user.broscute_points
             })
         
-        time_elapsed = (current_time - user.last_daily_game).total_seconds()
+        time_elapsed = (current_time - user.mining_started_at).total_seconds()
         
         if time_elapsed >= 86400:
             # Mining complete, can claim rewards
@@ -918,7 +3332,7 @@ def mining_status():
             # Mining în progres - calculează progress bar corect
             remaining_time = 86400 - time_elapsed
             progress_percentage = (time_elapsed / 86400) * 100  # REPARAT: Progress bar funcțional
-            return jsonify({
+            response = jsonify({
                 'can_start': False,
                 'is_mining': True,
                 'can_claim': False,
@@ -927,21 +3341,54 @@ def mining_status():
                 'progress_percentage': round(progress_percentage, 1),  # Pentru JavaScript progress bar
                 'current_balance': user.broscute_points
             })
+            # Starea nu se schimbă singură până la maturizare: clientul poate refolosi răspunsul
+            max_age = min(int(remaining_time), MINING_STATUS_MAX_AGE)
+            response.headers['Cache-Control'] = f'private, max-age={max_age}'
+            response.expires = current_time.replace(tzinfo=timezone.utc) + timedelta(seconds=max_age)
+            return response
             
     except Exception as e:
-        logger.error(f"Error getting mining status: {e}")
+        logger.error("Error getting mining status: %s", e)
         return jsonify({'error': 'Failed to get mining status'}), 500
 
-@app.route('/stake', methods=['POST'])
+@bp.route('/api/mining/events', methods=['GET'])
+@user_required(MINING_STATUS_COLUMNS, api=True)
+def mining_events(user):
+    """Server-Sent Events: one status event now; with a hold, one more on maturity or balance change"""
+    state = mining_state(user, datetime.utcnow())
+    user_id = user.id
+    retry = min(state['remaining_time'] or MINING_EVENTS_RETRY_MAX_SECONDS, MINING_EVENTS_RETRY_MAX_SECONDS)
+    # Conexiunea la DB se eliberează înainte de orice așteptare
+    db.session.remove()
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    
+    hold = min(MINING_EVENTS_HOLD_SECONDS, retry)
+    if hold <= 0:
+        return Response(sse_event('status', state, retry=retry), mimetype='text/event-stream', headers=headers)
+    
+    def stream():
+        # Long-poll: după hold browserul se reconectează imediat și așteaptă din nou
+        yield sse_event('status', state, retry=1)
+        changed = balance_notifier.wait(user_id, hold)
+        if changed or (state['is_mining'] and hold >= state['remaining_time']):
+            # Aceeași proiecție și același sold (cu ledger-ul) ca evenimentul inițial
+            fresh_user = load_user(user_id, MINING_STATUS_COLUMNS)
+            fresh = mining_state(fresh_user, datetime.utcnow()) if fresh_user is not None else None
+            db.session.remove()
+            if fresh is None:
+                # Contul a dispărut: la reconectare user_required răspunde 404 și EventSource se oprește
+                return
+            yield sse_event('balance' if changed else 'matured', fresh)
+    
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers=headers)
+
+@bp.route('/stake', methods=['POST'])
+@idempotent
 def stake_broscute():
     """Stake broșcuțe for rewards"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
         data = request.get_json()
         amount = int(data.get('amount', 0))
@@ -949,42 +3396,42 @@ def stake_broscute():
         if amount <= 0:
             return jsonify({'error': 'Suma trebuie să fie mai mare decât 0'}), 400
         
-        if amount > user.broscute_points:
-            return jsonify({'error': 'Nu ai suficiente broșcuțe disponibile'}), 400
-        
-        # Update user's staking info
-        user.broscute_points -= amount
-        user.staked_amount += amount
-        
-        # Set staking start date if first time
-        if not user.staking_start_date:
-            user.staking_start_date = datetime.utcnow()
+        # Move balance into staking; set staking start date if first time
+        result = apply_balance_change(
+            session['user_id'], -amount, earned=False,
+            where=(WebUser.broscute_points >= amount,),
+            values={
+                'staked_amount': WebUser.staked_amount + amount,
+                'staking_start_date': db.func.coalesce(WebUser.staking_start_date, datetime.utcnow())
+            },
+            returning=(WebUser.staked_amount,)
+        )
         
-        db.session.commit()
+        if result is None:
+            if load_current_user(('broscute_points',)) is None:
+                return jsonify({'error': 'User not found'}), 404
+            return jsonify({'error': 'Nu ai suficiente broșcuțe disponibile'}), 400
         
-        logger.info(f"User {user.telegram_id} staked {amount} broșcuțe")
+        logger.info("User %s staked %s broșcuțe", result.telegram_id, amount)
         
         return jsonify({
             'success': True,
             'message': f'Ai pus cu succes {amount} broșcuțe în staking!',
-            'new_balance': user.broscute_points,
-            'staked_amount': user.staked_amount
+            'new_balance': result.broscute_points,
+            'staked_amount': result.staked_amount
         })
         
     except Exception as e:
-        logger.error(f"Error staking broșcuțe: {e}")
+        logger.error("Error staking broșcuțe: %s", e)
         return jsonify({'error': 'Eroare la punerea în staking'}), 500
 
-@app.route('/unstake', methods=['POST'])
+@bp.route('/unstake', methods=['POST'])
+@idempotent
 def unstake_broscute():
     """Unstake broșcuțe"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
         data = request.get_json()
         amount = int(data.get('amount', 0))
@@ -992,69 +3439,601 @@ def unstake_broscute():
         if amount <= 0:
             return jsonify({'error': 'Suma trebuie să fie mai mare decât 0'}), 400
         
-        if amount > user.staked_amount:
-            return jsonify({'error': 'Nu ai suficiente broșcuțe în staking'}), 400
-        
-        # Update user's staking info
-        user.staked_amount -= amount
-        user.broscute_points += amount
-        
-        # Reset staking start date if no more staking
-        if user.staked_amount == 0:
-            user.staking_start_date = None
+        # Move stake back to balance; reset staking start date if no more staking
+        result = apply_balance_change(
+            session['user_id'], amount, earned=False,
+            where=(WebUser.staked_amount >= amount,),
+            values={
+                'staked_amount': WebUser.staked_amount - amount,
+                'staking_start_date': db.case(
+                    (WebUser.staked_amount == amount, None), else_=WebUser.staking_start_date
+                )
+            },
+            returning=(WebUser.staked_amount,)
+        )
         
-        db.session.commit()
+        if result is None:
+            if load_current_user(('staked_amount',)) is None:
+                return jsonify({'error': 'User not found'}), 404
+            return jsonify({'error': 'Nu ai suficiente broșcuțe în staking'}), 400
         
-        logger.info(f"User {user.telegram_id} unstaked {amount} broșcuțe")
+        logger.info("User %s unstaked %s broșcuțe", result.telegram_id, amount)
         
         return jsonify({
             'success': True,
             'message': f'Ai scos cu succes {amount} broșcuțe din staking!',
-            'new_balance': user.broscute_points,
-            'staked_amount': user.staked_amount
+            'new_balance': result.broscute_points,
+            'staked_amount': result.staked_amount
         })
         
     except Exception as e:
-        logger.error(f"Error unstaking broșcuțe: {e}")
+        logger.error("Error unstaking broșcuțe: %s", e)
         return jsonify({'error': 'Eroare la scoaterea din staking'}), 500
 
-@app.route('/claim-rewards', methods=['POST'])
+@bp.route('/claim-rewards', methods=['POST'])
+@idempotent
 def claim_staking_rewards():
     """Claim staking rewards"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user = WebUser.query.get(session['user_id'])
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
     try:
-        pending_rewards = calculate_staking_rewards(user) - user.staking_rewards
-        
-        if pending_rewards <= 0:
-            return jsonify({'error': 'Nu ai recompense de revendicat'}), 400
+        # Recompensa se calculează și se creditează în UPDATE; garda pending > 0 respinge dublurile
+        result, pending_rewards = claim_staking_for(session['user_id'])
+    except Exception as e:
+        logger.error("Error claiming rewards: %s", e)
+        return jsonify({'error': 'Eroare la revendicarea recompenselor'}), 500
+    
+    if result is None:
+        if load_current_user(('staking_rewards',)) is None:
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify({'error': 'Nu ai recompense de revendicat'}), 400
+    
+    logger.info("User %s claimed %s staking rewards", result.telegram_id, pending_rewards)
+    
+    return jsonify({
+        'success': True,
+        'message': f'Ai revendicat cu succes {pending_rewards} broșcuțe din recompense!',
+        'new_balance': result.broscute_points,
+        'rewards_claimed': pending_rewards
+    })
+
+# Telegram bot
+# Webhook-ul doar validează și pune update-ul în coadă, apoi răspunde imediat cu 200.
+# Un pool limitat de thread-uri rulează comenzile pe modelele existente și trimite răspunsul.
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", 4))
+BOT_QUEUE_SIZE = int(os.environ.get("BOT_QUEUE_SIZE", 1000))
+
+# Outbound Telegram sender
+# O singură sesiune HTTP keep-alive per worker, cu limitele Bot API aplicate prin token buckets:
+# global ~30 mesaje/s, 1 mesaj/s per chat privat, 20 mesaje/minut per grup.
+# Bucket-urile sunt per proces: limita globală se împarte la TELEGRAM_SENDER_PROCESSES (implicit
+# workerii gunicorn plus unul pentru comenzile CLI, ex. broadcast), ca suma să nu depășească limita.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org").rstrip('/')
+TELEGRAM_SENDER_PROCESSES = int(os.environ.get("TELEGRAM_SENDER_PROCESSES", int(os.environ.get("WEB_CONCURRENCY", 1)) + 1))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30)) / max(TELEGRAM_SENDER_PROCESSES, 1)
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+TELEGRAM_GROUP_RATE = float(os.environ.get("TELEGRAM_GROUP_RATE", 20 / 60))
+TELEGRAM_SEND_ATTEMPTS = int(os.environ.get("TELEGRAM_SEND_ATTEMPTS", 3))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8))
+BROADCAST_CHUNK_SIZE = int(os.environ.get("BROADCAST_CHUNK_SIZE", 500))
+BROADCAST_RETRY_ROUNDS = int(os.environ.get("BROADCAST_RETRY_ROUNDS", 3))  # reîncercări pentru 429/5xx/rețea
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token (possibly going negative) and return how long to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+class TelegramSender:
+    """Pooled, rate-limited Bot API client"""
+
+    def __init__(self, token=None, base_url=TELEGRAM_API_URL, pool_size=None):
+        self.token = token
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size or max(BOT_WORKERS, BROADCAST_CONCURRENCY)
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+        self._chat_buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                # chat_id negativ = grup/canal
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE if int(chat_id) < 0 else TELEGRAM_CHAT_RATE, capacity=1)
+                self._chat_buckets[chat_id] = bucket
+                if len(self._chat_buckets) > 50000:
+                    self._chat_buckets.popitem(last=False)
+            else:
+                self._chat_buckets.move_to_end(chat_id)
+            return bucket
+
+    def _wait_for_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def call(self, method, payload, chat_id=None):
+        """Call a Bot API method honouring rate limits and retry_after; return the decoded response"""
+        token = self.token or TELEGRAM_BOT_TOKEN
+        if not token:
+            raise RuntimeError('TELEGRAM_BOT_TOKEN not set')
+        url = f"{self.base_url}/bot{token}/{method}"
+        data = {'ok': False, 'description': 'not sent'}
+        for attempt in range(TELEGRAM_SEND_ATTEMPTS):
+            self._wait_for_pause()
+            if chat_id is not None:
+                self._chat_bucket(chat_id).acquire()
+            self.global_bucket.acquire()
+            try:
+                response = self.session.post(url, json=payload, timeout=10)
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("Telegram %s attempt %s failed: %s", method, attempt + 1, e)
+                data = {'ok': False, 'description': str(e)}
+                time.sleep(min(2 ** attempt, 10))
+                continue
+            if response.status_code != 429:
+                return data
+            # Flood control: toate thread-urile așteaptă retry_after
+            retry_after = (data.get('parameters') or {}).get('retry_after', 1)
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning("Telegram flood control on %s, retrying after %ss", method, retry_after)
+        return data
+
+    @staticmethod
+    def retryable(data):
+        """True for a failed call worth retrying later (flood control, Telegram 5xx, network error)"""
+        if data.get('ok'):
+            return False
+        code = data.get('error_code')
+        return code is None or code == 429 or code >= 500
+
+    def send_message(self, chat_id, text, **params):
+        payload = {'chat_id': chat_id, 'text': text, 'disable_web_page_preview': True}
+        payload.update(params)
+        return self.call('sendMessage', payload, chat_id=chat_id)
+
+    def broadcast(self, text, job_name, concurrency=BROADCAST_CONCURRENCY, chunk_size=BROADCAST_CHUNK_SIZE):
+        """Message every WebUser.telegram_id, resuming from the job's checkpoint"""
+        job = db.session.get(BroadcastJob, job_name)
+        if job is None:
+            job = BroadcastJob(name=job_name, message=text)
+            db.session.add(job)
+            db.session.commit()
+        elif job.finished_at is not None:
+            logger.info("Broadcast %s already finished", job_name)
+            return job
         
-        # Add rewards to user account
-        user.broscute_points += pending_rewards
-        user.staking_rewards += pending_rewards
-        user.total_earned += pending_rewards
+        message = job.message
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='broadcast') as pool:
+            while True:
+                rows = db.session.query(WebUser.id, WebUser.telegram_id).filter(
+                    WebUser.id > job.last_user_id
+                ).order_by(WebUser.id).limit(chunk_size).all()
+                db.session.commit()
+                if not rows:
+                    break
+                pending, sent, failed = rows, 0, 0
+                for attempt in range(BROADCAST_RETRY_ROUNDS + 1):
+                    if attempt:
+                        time.sleep(min(2 ** attempt, 30))
+                    results = list(pool.map(lambda row: self.send_message(row.telegram_id, message), pending))
+                    retry = [row for row, data in zip(pending, results) if self.retryable(data)]
+                    sent += sum(1 for data in results if data.get('ok'))
+                    failed += len(pending) - sum(1 for data in results if data.get('ok')) - len(retry)
+                    pending = retry
+                    if not pending:
+                        break
+                # Ce a rămas după ultima rundă (429/5xx/rețea persistente) se numără ca eșuat
+                failed += len(pending)
+                # Checkpoint după fiecare chunk: la reluare se continuă de la ultimul id trimis
+                job.last_user_id = rows[-1].id
+                job.sent += sent
+                job.failed += failed
+                job.updated_at = datetime.utcnow()
+                db.session.commit()
+                logger.info("Broadcast %s: %s sent, %s failed, checkpoint user %s", job_name, job.sent, job.failed, job.last_user_id)
         
+        job.finished_at = datetime.utcnow()
         db.session.commit()
-        
-        logger.info(f"User {user.telegram_id} claimed {pending_rewards} staking rewards")
-        
-        return jsonify({
-            'success': True,
-            'message': f'Ai revendicat cu succes {pending_rewards} broșcuțe din recompense!',
-            'new_balance': user.broscute_points,
-            'rewards_claimed': pending_rewards
-        })
-        
+        return job
+
+telegram_sender = TelegramSender()
+
+def send_telegram_message(chat_id, text):
+    """Send a text message through the Bot API"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN not set, dropping reply to %s", chat_id)
+        return False
+    return telegram_sender.send_message(chat_id, text).get('ok', False)
+
+def _bot_user_id(tg_user):
+    """Return WebUser.id for a Telegram sender or None if not registered"""
+    return db.session.query(WebUser.id).filter(WebUser.telegram_id == tg_user.get('id')).scalar()
+
+def bot_start(tg_user, args):
+    user = WebUser.query.filter_by(telegram_id=tg_user['id']).first()
+    first_name = tg_user.get('first_name', 'Utilizator')
+    if user is None:
+        # /start <cod> din link-ul de referral t.me/<bot>?start=<cod>
+        user = register_user(
+            tg_user['id'], tg_user.get('username', f"user_{tg_user['id']}"),
+            first_name, tg_user.get('last_name', ''), referral_code=args or None
+        )
+        logger.info("Created new Telegram user from bot: %s (ID: %s)", first_name, tg_user['id'])
+        greeting = f"🐸 Bun venit, {first_name}! Ai primit 100 broșcuțe bonus de înregistrare."
+    else:
+        greeting = f"🐸 Bine ai revenit, {first_name}!"
+    lines = [greeting, "Folosește /help pentru lista de comenzi."]
+    if WEBAPP_URL:
+        lines.append(f"Dashboard: {WEBAPP_URL}/dashboard")
+    return "\n".join(lines)
+
+def bot_broscute(tg_user, args):
+    row = db.session.query(
+        balance_expression().label('broscute_points'), WebUser.mario_tokens, WebUser.staked_amount
+    ).filter(WebUser.telegram_id == tg_user.get('id')).first()
+    if row is None:
+        return "Nu ești înregistrat. Folosește /start"
+    return (f"🐸 Broșcuțe: {row.broscute_points}\n"
+            f"🪙 MARIO tokens: {row.mario_tokens}\n"
+            f"🔒 În staking: {row.staked_amount}")
+
+def bot_daily(tg_user, args):
+    user_id = _bot_user_id(tg_user)
+    if user_id is None:
+        return "Nu ești înregistrat. Folosește /start"
+    result, reward = play_daily_for(user_id)
+    if result is None:
+        return "⏳ Jocul zilnic este în cooldown. Revino mâine!"
+    return f"Felicitări! Ai câștigat {reward} broșcuțe! Sold: {result.broscute_points}"
+
+def bot_noroc(tg_user, args):
+    user_id = _bot_user_id(tg_user)
+    if user_id is None:
+        return "Nu ești înregistrat. Folosește /start"
+    result, reward = play_luck_for(user_id)
+    if result is None:
+        return "⏳ Jocul norocului este în cooldown (5 minute)."
+    return f"Noroc! Ai câștigat {reward} broșcuțe! Sold: {result.broscute_points}"
+
+def bot_convert(tg_user, args):
+    lines = ["🔄 Conversia broșcuțe → MARIO se face din pagina de conversie."]
+    if WEBAPP_URL:
+        lines.append(f"{WEBAPP_URL}/token-conversion")
+    lines.append(f"Contract MARIO: {MARIO_TOKEN_CONTRACT}")
+    return "\n".join(lines)
+
+def bot_istoric(tg_user, args):
+    user_id = _bot_user_id(tg_user)
+    if user_id is None:
+        return "Nu ești înregistrat. Folosește /start"
+    page = fetch_history_page(user_id, limit=10, game_type=args or None, with_totals=False)
+    if not page['items']:
+        return "📜 Nu ai încă activitate în istoric."
+    lines = ["📜 Ultimele activități:"]
+    lines += [f"{datetime.fromisoformat(item['created_at']):%d.%m %H:%M} {item['game_type']}: +{item['broscute_earned']}"
+              for item in page['items']]
+    return "\n".join(lines)
+
+def bot_leaderboard(tg_user, args):
+    leaderboard_index.ensure_fresh()
+    top = leaderboard_index.top(10)
+    names = dict(db.session.query(WebUser.id, WebUser.first_name).filter(
+        WebUser.id.in_([user_id for user_id, _ in top])
+    ).all()) if top else {}
+    lines = ["🏆 Top 10 broșcuțe:"]
+    lines += [f"{position}. {names.get(user_id) or 'Anonim'} - {points}"
+              for position, (user_id, points) in enumerate(top, 1)]
+    user_id = _bot_user_id(tg_user)
+    rank = leaderboard_index.rank(user_id) if user_id else None
+    if rank:
+        lines.append(f"Locul tău: #{rank} din {len(leaderboard_index)}")
+    return "\n".join(lines)
+
+def bot_jocuri(tg_user, args):
+    lines = [
+        "🎮 Jocuri disponibile:",
+        "/daily - jocul zilnic (10-100 broșcuțe)",
+        "/noroc - jocul norocului (5-50 broșcuțe, la 5 minute)",
+        "Mining 24h, Memory game și staking în aplicația web"
+    ]
+    if WEBAPP_URL:
+        lines.append(f"{WEBAPP_URL}/games")
+    return "\n".join(lines)
+
+def bot_linkuri(tg_user, args):
+    return (f"🔗 Link-uri MARIO:\n"
+            f"Chart: {MARIO_TOKEN_CHART_URL}\n"
+            f"Jupiter: {JUPITER_SWAP_URL}\n"
+            f"Phantom: {PHANTOM_URL}")
+
+def bot_formular(tg_user, args):
+    completed = db.session.query(WebUser.google_form_completed).filter(
+        WebUser.telegram_id == tg_user.get('id')
+    ).scalar()
+    if completed:
+        return "✅ Ai completat deja formularul."
+    lines = ["📝 Completează formularul și primești 500 broșcuțe bonus!"]
+    if GOOGLE_FORM_URL:
+        lines.append(GOOGLE_FORM_URL)
+    return "\n".join(lines)
+
+def bot_help(tg_user, args):
+    return "\n".join(["🐸 Comenzi MarioCoinAMG:"] + [f"/{name} - {description}" for name, (_, description) in BOT_COMMANDS.items()])
+
+BOT_COMMANDS = {
+    'start': (bot_start, 'înregistrare și bun venit'),
+    'broscute': (bot_broscute, 'soldul tău'),
+    'daily': (bot_daily, 'jocul zilnic'),
+    'noroc': (bot_noroc, 'jocul norocului'),
+    'convert': (bot_convert, 'conversie în MARIO'),
+    'istoric': (bot_istoric, 'ultimele activități'),
+    'leaderboard': (bot_leaderboard, 'clasamentul'),
+    'jocuri': (bot_jocuri, 'lista jocurilor'),
+    'linkuri': (bot_linkuri, 'link-uri token MARIO'),
+    'formular': (bot_formular, 'formularul Google'),
+    'help': (bot_help, 'această listă'),
+}
+
+def handle_update(update):
+    """Run the command handler for one Telegram update; return (chat_id, reply) or None"""
+    message = update.get('message') or update.get('edited_message')
+    if not message or not message.get('text', '').startswith('/'):
+        return None
+    
+    command, _, args = message['text'].strip().partition(' ')
+    command = command[1:].split('@', 1)[0].lower()
+    chat_id = message['chat']['id']
+    tg_user = message.get('from') or {'id': chat_id}
+    
+    entry = BOT_COMMANDS.get(command)
+    if entry is None:
+        return chat_id, "Comandă necunoscută. Folosește /help"
+    return chat_id, entry[0](tg_user, args.strip())
+
+class BotDispatcher:
+    """Bounded queue of webhook updates drained by a fixed pool of worker threads"""
+
+    def __init__(self, workers=BOT_WORKERS, queue_size=BOT_QUEUE_SIZE, sender=send_telegram_message):
+        self.workers = workers
+        self.sender = sender
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self, flask_app):
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, args=(flask_app,), name=f'bot-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, update):
+        """Queue an update without blocking; False when the queue is full"""
+        update_id = update.get('update_id')
+        with self._lock:
+            # Telegram re-livrează update-urile la care n-a primit 200 la timp
+            if update_id is not None:
+                if update_id in self._seen:
+                    return True
+                self._seen[update_id] = True
+                if len(self._seen) > 10000:
+                    self._seen.popitem(last=False)
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._seen.pop(update_id, None)
+            return False
+
+    def process(self, update):
+        """Handle one update and send the reply (used by the workers and bot-replay)"""
+        try:
+            result = handle_update(update)
+            if result is not None:
+                self.sender(*result)
+            return result
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error handling Telegram update %s: %s", update.get('update_id'), e)
+        finally:
+            db.session.remove()
+
+    def _run(self, flask_app):
+        while True:
+            update = self._queue.get()
+            try:
+                with flask_app.app_context():
+                    self.process(update)
+            finally:
+                self._queue.task_done()
+
+bot_dispatcher = BotDispatcher()
+
+@bp.route('/webhook/<token>', methods=['POST'])
+def telegram_webhook(token):
+    """Telegram webhook - validate, queue and acknowledge without touching the DB"""
+    if not TELEGRAM_BOT_TOKEN or not hmac.compare_digest(token.encode(), TELEGRAM_BOT_TOKEN.encode()):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    if TELEGRAM_WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(), TELEGRAM_WEBHOOK_SECRET.encode()
+    ):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    update = request.get_json(silent=True)
+    if not isinstance(update, dict):
+        return jsonify({'error': 'Invalid update'}), 400
+    
+    bot_dispatcher.start(current_app._get_current_object())
+    if not bot_dispatcher.submit(update):
+        # Coada e plină: Telegram va reîncerca update-ul mai târziu
+        logger.warning("Bot queue full, rejecting update %s", update.get('update_id'))
+        return jsonify({'error': 'Busy'}), 503
+    
+    return jsonify({'ok': True}), 200
+
+# Admin access and streaming export
+# ADMIN_TOKEN activează endpoint-urile /admin/* (header Authorization: Bearer <token>).
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 5000))
+EXPORT_TABLES = {'users': WebUser, 'history': GameHistory}
+
+def admin_authorized():
+    """True when the request carries the configured ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        return False
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else request.headers.get('X-Admin-Token', '')
+    return hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def iter_export_chunks(model, since_id=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield lists of row dicts with id > since_id, one short transaction per chunk"""
+    table = model.__table__
+    last_id = since_id
+    while True:
+        result = db.session.execute(
+            db.select(table).where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size),
+            execution_options={'stream_results': True, 'yield_per': 1000}
+        )
+        rows = [{key: _export_value(value) for key, value in row._mapping.items()} for row in result]
+        # Închide tranzacția după fiecare chunk ca exportul să nu țină snapshot-uri lungi
+        db.session.commit()
+        if not rows:
+            return
+        last_id = rows[-1]['id']
+        yield rows
+
+def export_stream(table_name, fmt='ndjson', since_id=0, compress=False, on_chunk=None):
+    """Yield the encoded export of `table_name` as bytes, optionally gzip-compressed.
+
+    on_chunk(last_id) is called after each chunk has been yielded (checkpointing).
+    With on_chunk and compress every chunk is a complete gzip member, so the output
+    can be cut at any checkpoint and continued with a new member.
+    """
+    model = EXPORT_TABLES[table_name]
+    columns = [column.key for column in model.__table__.columns]
+    member_per_chunk = compress and on_chunk is not None
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress and not member_per_chunk else None
+    
+    def encode(text):
+        nonlocal compressor
+        data = text.encode('utf-8')
+        if not compress:
+            return data
+        if compressor is None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data)
+    
+    if fmt == 'csv' and since_id == 0:
+        yield encode(','.join(columns) + '\r\n')
+    for rows in iter_export_chunks(model, since_id):
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([row[column] for column in columns] for row in rows)
+            chunk = encode(buffer.getvalue())
+        else:
+            chunk = encode(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+        if member_per_chunk:
+            # Închide membrul gzip înainte de checkpoint: zlib nu mai ține nimic în buffer
+            chunk += compressor.flush()
+            compressor = None
+        if chunk:
+            yield chunk
+        if on_chunk:
+            on_chunk(rows[-1]['id'])
+    if compressor:
+        yield compressor.flush()
+
+@bp.route('/admin/export/<table_name>', methods=['GET'])
+def admin_export(table_name):
+    """Stream web_users or game_history as NDJSON/CSV (optionally gzip), resumable with since_id"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if table_name not in EXPORT_TABLES:
+        return jsonify({'error': f'Unknown table, use one of {sorted(EXPORT_TABLES)}'}), 400
+    
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Format must be ndjson or csv'}), 400
+    compress = request.args.get('gzip', '0') in ('1', 'true')
+    try:
+        since_id = int(request.args.get('since_id', 0))
+    except ValueError:
+        return jsonify({'error': 'since_id must be an integer'}), 400
+    
+    logger.info("Admin export of %s as %s since id %s", table_name, fmt, since_id)
+    if compress:
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    headers = {'Content-Disposition': f'attachment; filename={table_name}.{fmt}' + ('.gz' if compress else '')}
+    return Response(stream_with_context(export_stream(table_name, fmt, since_id, compress)),
+                    mimetype=mimetype, headers=headers)
+
+@bp.route('/admin/airdrop', methods=['POST'])
+def admin_airdrop():
+    """Credit a CSV of telegram_id,amount[,reason] (body or `file` upload) under an idempotency key"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    airdrop = request.args.get('key', '').strip()
+    if not airdrop:
+        return jsonify({'error': 'key is required (idempotency key for this airdrop)'}), 400
+    if len(airdrop) > AIRDROP_KEY_MAX_LENGTH:
+        return jsonify({'error': f'key must be at most {AIRDROP_KEY_MAX_LENGTH} characters'}), 400
+    currency = request.args.get('currency', 'broscute')
+    if currency not in AIRDROP_CURRENCIES:
+        return jsonify({'error': f'Unknown currency, use one of {sorted(AIRDROP_CURRENCIES)}'}), 400
+    
+    upload = request.files.get('file')
+    content = upload.read().decode('utf-8-sig') if upload else request.get_data(as_text=True)
+    try:
+        rows = parse_airdrop_rows(io.StringIO(content))
+        summary = run_airdrop(airdrop, rows, currency=currency)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Error claiming rewards: {e}")
-        return jsonify({'error': 'Eroare la revendicarea recompenselor'}), 500
+        logger.error("Error applying airdrop %s: %s", airdrop, e)
+        return jsonify({'error': 'Airdrop failed; re-run with the same key to resume'}), 500
+    return jsonify(summary)
 
-@app.route('/test')
+@bp.route('/test')
 def test():
     """Test endpoint for debugging"""
     return jsonify({
@@ -1066,7 +4045,7 @@ def test():
     }), 200
 
 # Error handlers that always return HTTP 200
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     """404 handler that returns 200 for health checks"""
     return jsonify({
@@ -1076,10 +4055,10 @@ def not_found(error):
         'timestamp': datetime.utcnow().isoformat()
     }), 200
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def server_error(error):
     """500 handler that returns 200 for health checks"""
-    logger.error(f"Server error 500: {error}")
+    logger.error("Server error 500: %s", error)
     return jsonify({
         'status': 'error',
         'message': 'Server error but application is responsive',
@@ -1088,21 +4067,384 @@ def server_error(error):
     }), 200
 
 # Before request handler for logging (with error handling)
-@app.before_request
+@bp.before_app_request
 def log_request():
     try:
-        remote_addr = request.remote_addr or 'unknown'
-        logger.info(f"Request: {request.method} {request.path} from {remote_addr}")
+        # Ruta (nu path-ul) ca cheie de sampling: /webhook/<token> nu ajunge în log cu token-ul
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        if logger.isEnabledFor(logging.INFO) and request_log_sampled(route):
+            logger.info("Request: %s %s from %s", request.method, route, request.remote_addr or 'unknown',
+                        extra={'route': route, 'method': request.method})
     except Exception as e:
         # Continue even if logging fails
         pass
 
+@bp.cli.command('analytics-reconcile')
+def analytics_reconcile_command():
+    """Recompute the analytics snapshot (run from cron or after bulk imports)"""
+    snapshot = reconcile_analytics()
+    print(json.dumps({
+        'total_users': snapshot.total_users,
+        'total_broscute': snapshot.total_broscute,
+        'active_users': snapshot.active_users,
+        'recent_activity': snapshot.recent_activity,
+        'reconciled_at': snapshot.reconciled_at.isoformat()
+    }))
+
+@bp.cli.command('bot-replay')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def bot_replay_command(path):
+    """Run recorded webhook updates (JSON list or one update per line) and print the replies without sending them"""
+    with open(path, encoding='utf-8') as fh:
+        content = fh.read().strip()
+    updates = json.loads(content) if content.startswith('[') else [json.loads(line) for line in content.splitlines() if line.strip()]
+    replies = []
+    replayer = BotDispatcher(sender=lambda chat_id, text: replies.append({'chat_id': chat_id, 'text': text}))
+    for update in updates:
+        replayer.process(update)
+    for reply in replies:
+        print(json.dumps(reply, ensure_ascii=False))
+
+@bp.cli.command('broadcast')
+@click.argument('message')
+@click.option('--job', 'job_name', required=True, help='Checkpoint name; re-run with the same name to resume')
+def broadcast_command(message, job_name):
+    """Send MESSAGE to every user at the maximum allowed rate"""
+    job = telegram_sender.broadcast(message, job_name)
+    print(json.dumps({'job': job.name, 'sent': job.sent, 'failed': job.failed, 'last_user_id': job.last_user_id}))
+
+def staking_epoch_report(summary):
+    return {
+        'epoch': summary.epoch,
+        'stakers': summary.stakers,
+        'total_staked': summary.total_staked,
+        'total_accrued': summary.total_accrued,
+        'total_liability': summary.total_liability,
+        'settled_at': summary.settled_at.isoformat() if summary.settled_at else None
+    }
+
+@bp.cli.command('staking-settle')
+def staking_settle_command():
+    """Settle staking rewards for the current epoch and print the liability report"""
+    print(json.dumps(staking_epoch_report(settle_staking_rewards())))
+
+@bp.cli.command('staking-liability')
+def staking_liability_command():
+    """Print the outstanding staking liability of the latest settled epoch"""
+    summary = staking_liability()
+    if summary is None:
+        raise click.ClickException("No staking epoch settled yet; run staking-settle first")
+    print(json.dumps(staking_epoch_report(summary)))
+
+@bp.cli.command('mining-settle')
+def mining_settle_command():
+    """Credit every matured mining session now (cron alternative to MINING_AUTO_SETTLE)"""
+    print(json.dumps({'settled': settle_matured_mining()}))
+
+@bp.cli.command('referral-recompute')
+def referral_recompute_command():
+    """Rebuild referral counts and rewards for the whole tree and backfill missing codes"""
+    print(json.dumps(recompute_referrals()))
+
+@bp.cli.command('idempotency-purge')
+def idempotency_purge_command():
+    """Delete Idempotency-Key responses older than IDEMPOTENCY_TTL_SECONDS (run from cron)"""
+    print(json.dumps({'purged': purge_idempotency_keys()}))
+
+@bp.cli.command('ledger-compact')
+def ledger_compact_command():
+    """Fold pending balance_ledger rows into web_users (BALANCE_MODE=ledger; cron alternative)"""
+    print(json.dumps({'folded': compact_ledger()}))
+
+@bp.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations (run once per deploy)"""
+    applied = run_migrations()
+    print(f"Applied migrations: {applied}" if applied else "Schema up to date")
+
+@bp.cli.command('db-check-indexes')
+def db_check_indexes_command():
+    """Report pending migrations and app queries without a supporting index"""
+    pending, missing = check_indexes()
+    for version in pending:
+        print(f"PENDING migration {version}")
+    for query, table, columns in missing:
+        print(f"MISSING index on {table} ({', '.join(columns)}) for: {query}")
+    if pending or missing:
+        sys.exit(1)
+    print("All query indexes present")
+
+@bp.cli.command('export')
+@click.argument('table_name', type=click.Choice(sorted(EXPORT_TABLES)))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip-compress the output')
+@click.option('--since-id', type=int, default=None, help='Export rows with id > SINCE_ID')
+@click.option('--output', type=click.Path(dir_okay=False), required=True)
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help='File holding the last exported id and output size; an existing checkpoint resumes the export')
+def export_command(table_name, fmt, compress, since_id, output, checkpoint):
+    """Stream TABLE_NAME to a file with flat memory use"""
+    resume = since_id is None and checkpoint and os.path.exists(checkpoint)
+    size = None
+    if resume:
+        with open(checkpoint) as fh:
+            parts = fh.read().split()
+        since_id = int(parts[0]) if parts else 0
+        size = int(parts[1]) if len(parts) > 1 else None
+    since_id = since_id or 0
+    
+    with open(output, 'ab' if resume else 'wb') as out:
+        if size is not None:
+            # Taie ce s-a scris după ultimul checkpoint (chunk parțial la o întrerupere)
+            if out.seek(0, os.SEEK_END) < size:
+                raise click.ClickException(f"{output} is shorter than the checkpointed {size} bytes")
+            out.truncate(size)
+        
+        def save_checkpoint(last_id):
+            out.flush()
+            if checkpoint:
+                with open(checkpoint, 'w') as fh:
+                    fh.write(f"{last_id} {out.tell()}")
+        
+        for chunk in export_stream(table_name, fmt, since_id, compress, on_chunk=save_checkpoint):
+            out.write(chunk)
+    print(f"Exported {table_name} since id {since_id} to {output}")
+
+@bp.cli.command('airdrop')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--key', required=True, help='Idempotency key; re-running with the same key skips applied chunks')
+@click.option('--currency', type=click.Choice(sorted(AIRDROP_CURRENCIES)), default='broscute')
+@click.option('--chunk-size', type=int, default=AIRDROP_CHUNK_SIZE)
+def airdrop_command(path, key, currency, chunk_size):
+    """Credit the telegram_id,amount[,reason] rows of PATH"""
+    try:
+        with open(path, encoding='utf-8-sig') as fh:
+            rows = parse_airdrop_rows(fh)
+        summary = run_airdrop(key, rows, currency=currency, chunk_size=chunk_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    print(json.dumps(summary))
+
+# WSGI probe fast path
+# Probele de uptime/keep-alive sunt servite înainte de Flask: fără sesiune, fără hook-uri,
+# fără acces la DB; logate doar dacă LOG_SAMPLE_RATES le dă o rată. /readiness citește
+# rezultatul unei verificări DB făcute în fundal.
+PROBE_FAST_PATH = os.environ.get("PROBE_FAST_PATH", "1") == "1"
+READINESS_CHECK_SECONDS = float(os.environ.get("READINESS_CHECK_SECONDS", 10))
+HEALTH_CHECK_AGENTS = re.compile(r'python-requests|curl|wget|bot|monitor|ping|health|check|autoscale|deployment')
+
+class DbHealthMonitor:
+    """Background SELECT 1 every READINESS_CHECK_SECONDS plus pool statistics, read lock-free by probes"""
+
+    def __init__(self, interval=READINESS_CHECK_SECONDS):
+        self.interval = interval
+        self.state = {'ready': False, 'checked_at': None, 'error': 'not checked yet'}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, flask_app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(flask_app,), name='db-health', daemon=True)
+            self._thread.start()
+
+    def check(self):
+        started = time.perf_counter()
+        state = {'checked_at': datetime.utcnow().isoformat()}
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(db.text("SELECT 1"))
+            state.update(ready=True, latency_ms=round((time.perf_counter() - started) * 1000, 2))
+        except Exception as e:
+            state.update(ready=False, error=str(e))
+        pool = db.engine.pool
+        state['pool'] = {
+            'size': getattr(pool, 'size', lambda: None)(),
+            'checked_out': getattr(pool, 'checkedout', lambda: None)(),
+            'overflow': getattr(pool, 'overflow', lambda: None)()
+        }
+        self.state = state  # înlocuire atomică, probele nu iau lock
+        return state
+
+    def _run(self, flask_app):
+        while True:
+            with flask_app.app_context():
+                self.check()
+            time.sleep(self.interval)
+
+db_health = DbHealthMonitor()
+
+class ProbeMiddleware:
+    """Answer health/probe paths before Flask dispatch"""
+
+    def __init__(self, wsgi_app, flask_app):
+        self.wsgi_app = wsgi_app
+        self.flask_app = flask_app
+        self.handlers = {
+            '/': self.root,
+            '/health': self.health,
+            '/ping': self.ping,
+            '/status': self.status,
+            '/readiness': self.readiness,
+            '/liveness': self.liveness,
+        }
+
+    def __call__(self, environ, start_response):
+        handler = self.handlers.get(environ.get('PATH_INFO'))
+        if handler is None:
+            return self.wsgi_app(environ, start_response)
+        if LOG_SAMPLE_RATES and request_log_sampled(environ['PATH_INFO'], default=0):
+            logger.info("Probe: %s %s from %s", environ.get('REQUEST_METHOD'), environ['PATH_INFO'], environ.get('REMOTE_ADDR', 'unknown'),
+                        extra={'route': environ['PATH_INFO'], 'method': environ.get('REQUEST_METHOD')})
+        status, headers, body = handler(environ)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        return [b''] if environ.get('REQUEST_METHOD') == 'HEAD' else [body]
+
+    @staticmethod
+    def _json(payload):
+        return '200 OK', [('Content-Type', 'application/json')], json.dumps(payload).encode()
+
+    @staticmethod
+    def _text(text):
+        return '200 OK', [('Content-Type', 'text/html; charset=utf-8')], text.encode()
+
+    def root(self, environ):
+        # Health check vs browser: la fel ca root() din Flask
+        user_agent = environ.get('HTTP_USER_AGENT', '').lower()
+        is_health_check = HEALTH_CHECK_AGENTS.search(user_agent) is not None and 'mozilla' not in user_agent
+        if is_health_check or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self._text('OK')
+        return '302 FOUND', [('Location', '/dashboard'), ('Content-Type', 'text/html; charset=utf-8')], b''
+
+    def health(self, environ):
+        return self._json({'status': 'healthy', 'app': 'MarioCoinAMG', 'timestamp': datetime.utcnow().isoformat()})
+
+    def ping(self, environ):
+        return self._text('OK')
+
+    def status(self, environ):
+        return self._json({
+            'status': 'running',
+            'app': 'MarioCoinAMG',
+            'environment': os.environ.get("FLASK_ENV", "development"),
+            'port': os.environ.get("PORT", "5000"),
+            'python_version': sys.version.split()[0],
+            'startup_ms': STARTUP_TIMINGS,
+            'timestamp': datetime.utcnow().isoformat()
+        })
+
+    def readiness(self, environ):
+        db_health.start(self.flask_app)
+        state = db_health.state
+        return self._json(dict(state, timestamp=datetime.utcnow().isoformat()))
+
+    def liveness(self, environ):
+        return self._json({'alive': True, 'timestamp': datetime.utcnow().isoformat()})
+
+# Application factory and warm-up
+def create_app(config=None):
+    """Build the Flask application without any database I/O (gunicorn preload_app-safe)"""
+    started = time.perf_counter()
+    flask_app = Flask(__name__)
+    flask_app.secret_key = os.environ.get("FLASK_SECRET_KEY", "mariocoin-deployment-secret")
+    
+    # Database configuration
+    flask_app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        'pool_pre_ping': True,
+        "pool_recycle": 300,
+    }
+    if config:
+        flask_app.config.update(config)
+    if not (flask_app.config["SQLALCHEMY_DATABASE_URI"] or '').startswith('sqlite'):
+        # SQLite păstrează pool-ul ales de Flask-SQLAlchemy (StaticPool pentru :memory:)
+        flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"].setdefault('poolclass', MeteredQueuePool)
+    
+    db.init_app(flask_app)
+    flask_app.register_blueprint(bp)
+    if PROBE_FAST_PATH:
+        flask_app.wsgi_app = ProbeMiddleware(flask_app.wsgi_app, flask_app)
+    STARTUP_TIMINGS['config'] = round((time.perf_counter() - started) * 1000, 1)
+    return flask_app
+
+def _timed(phase, func, *args):
+    started = time.perf_counter()
+    try:
+        func(*args)
+    except Exception as e:
+        logger.error("Warm-up phase %s failed: %s", phase, e)
+    STARTUP_TIMINGS[phase] = round((time.perf_counter() - started) * 1000, 1)
+
+def _prime_pool():
+    """Open (and return to the pool) a few connections so first requests do not pay the connect"""
+    size = min(WARMUP_POOL_CONNECTIONS, getattr(db.engine.pool, 'size', lambda: 1)())
+    connections = []
+    try:
+        for _ in range(size):
+            connection = db.engine.connect()
+            connection.execute(db.text("SELECT 1"))
+            connections.append(connection)
+    finally:
+        for connection in connections:
+            connection.close()
+
+def _compile_templates(flask_app):
+    for name in flask_app.jinja_env.list_templates():
+        flask_app.jinja_env.get_template(name)
+
+def _fill_caches(flask_app):
+    db_health.start(flask_app)
+    # Indexul se construiește în thread-ul de sync, nu în warm-up (scanare completă a web_users)
+    leaderboard_index.start(flask_app)
+    start_analytics_reconciler(flask_app)
+    if MINING_AUTO_SETTLE:
+        mining_scheduler.start(flask_app)
+    if history_buffered():
+        history_buffer.start(flask_app)
+    if ledger_mode():
+        start_ledger_compactor(flask_app)
+
+def build_shared_caches(flask_app):
+    """Build the fork-shared caches once in the gunicorn master (preload_app), before any worker exists"""
+    with flask_app.app_context():
+        _timed('leaderboard', leaderboard_index.rebuild)
+        db.session.remove()
+        # Fără conexiuni moștenite: fiecare worker își deschide propriul pool
+        db.engine.dispose()
+    # GC-ul nu mai parcurge obiectele existente, deci nu le murdărește paginile după fork
+    gc.freeze()
+
+def warm_up(flask_app):
+    """Prime the pool, compile templates and fill caches before the worker takes traffic.
+
+    Called per worker after fork (gunicorn.conf.py post_worker_init), never in the master.
+    """
+    with flask_app.app_context():
+        _timed('pool', _prime_pool)
+        _timed('templates', _compile_templates, flask_app)
+        _timed('caches', _fill_caches, flask_app)
+        db.session.remove()
+    logger.info("Worker warm-up done: %s", STARTUP_TIMINGS)
+
+@bp.before_app_request
+def record_first_request():
+    if 'first_request' not in STARTUP_TIMINGS:
+        STARTUP_TIMINGS['first_request'] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+        logger.info("Startup timings (ms): %s", STARTUP_TIMINGS)
+
+app = create_app()
+STARTUP_TIMINGS['import'] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
 if __name__ == '__main__':
     try:
-        # Create database tables
+        # Apply pending schema migrations (local runs; deploys run db-upgrade once)
         with app.app_context():
-            db.create_all()
-            logger.info("Database tables created successfully")
+            run_migrations()
+            logger.info("Database schema up to date")
+        warm_up(app)
         
         # Get port from environment (Render sets this automatically)
         PORT = int(os.environ.get("PORT", 5000))
@@ -1115,10 +4457,10 @@ if __name__ == '__main__':
         logger.info("MARIOCOINAMG RENDER DEPLOYMENT - BOT COMPLET 100%")
         logger.info("UTILIZATOR: mariobotamg | GITHUB: maeioAMG")
         logger.info("=" * 70)
-        logger.info(f"Port: {PORT}")
-        logger.info(f"Host: 0.0.0.0 (all interfaces)")
-        logger.info(f"Environment: production")
-        logger.info(f"Debug mode: False")
+        logger.info("Port: %s", PORT)
+        logger.info("Host: 0.0.0.0 (all interfaces)")
+        logger.info("Environment: production")
+        logger.info("Debug mode: False")
         logger.info("BOT FEATURES INCLUSE:")
         logger.info("  ✅ Toate 11 comenzile: /start, /broscute, /daily, /noroc, /convert")
         logger.info("  ✅ /istoric, /leaderboard, /jocuri, /linkuri, /formular, /help")
@@ -1141,5 +4483,5 @@ if __name__ == '__main__':
         )
         
     except Exception as e:
-        logger.error(f"Failed to start MARIOCOINAMG application: {e}")
+        logger.error("Failed to start MARIOCOINAMG application: %s", e)
         sys.exit(1)
@@ -0,0 +1,51 @@
+"""
+Gunicorn configuration pentru MarioCoinAMG (Render)
+
+Aplicația se încarcă o singură dată în master (preload_app): importul nu face I/O pe baza de
+date, deci nu se moștenesc conexiuni după fork. Fiecare worker își încălzește apoi pool-ul,
+template-urile și cache-urile înainte să primească trafic.
+"""
+import glob
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# Metricile Prometheus se agregă între workeri prin fișiere în acest director; trebuie setat
+# înainte de importul aplicației și golit la fiecare pornire a master-ului.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/mariocoin-metrics")
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+for stale in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+    os.remove(stale)
+
+
+def when_ready(server):
+    # Indexul de leaderboard se construiește o dată aici și e moștenit de workeri la fork
+    if preload_app:
+        from flask_app import app, build_shared_caches
+        build_shared_caches(app)
+
+
+def post_fork(server, worker):
+    # Defensiv: dacă ceva a deschis conexiuni în master, worker-ul nu le refolosește
+    from flask_app import db, app
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    from flask_app import app, warm_up
+    warm_up(app)
+
+
+def worker_exit(server, worker):
+    from flask_app import history_buffer
+    history_buffer.close()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# flask_app citește DATABASE_URL la import: baza de test trebuie setată înainte
+_DB_DIR = tempfile.mkdtemp(prefix='mariocoin-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask_app  # noqa: E402
+
+with flask_app.app.app_context():
+    flask_app.run_migrations()
+
+@pytest.fixture
+def app(monkeypatch):
+    """The module app on a clean database, with fresh per-worker caches"""
+    monkeypatch.setattr(flask_app, 'user_cache', flask_app.UserCache())
+    monkeypatch.setattr(flask_app, 'idempotency_cache', flask_app.IdempotencyCache())
+    monkeypatch.setattr(flask_app, 'analytics_rollup', flask_app.AnalyticsRollup())
+    monkeypatch.setattr(flask_app, 'leaderboard_index', flask_app.LeaderboardIndex())
+    monkeypatch.setattr(flask_app, 'page_render_cache', flask_app.PageRenderCache())
+    with flask_app.app.app_context():
+        yield flask_app.app
+        flask_app.db.session.rollback()
+        for table in reversed(flask_app.db.metadata.sorted_tables):
+            if table.name != flask_app.SchemaMigration.__tablename__:
+                flask_app.db.session.execute(table.delete())
+        flask_app.db.session.commit()
+        flask_app.db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def make_user(app):
+    """Insert a WebUser with explicit balances; returns it"""
+    counter = iter(range(1, 10 ** 6))
+    
+    def make(**fields):
+        fields.setdefault('telegram_id', str(900000 + next(counter)))
+        fields.setdefault('broscute_points', 0)
+        fields.setdefault('total_earned', 0)
+        fields.setdefault('mario_tokens', 0)
+        fields.setdefault('staked_amount', 0)
+        user = flask_app.WebUser(**fields)
+        flask_app.db.session.add(user)
+        flask_app.db.session.commit()
+        return user
+    return make
@@ -0,0 +1,51 @@
+import pytest
+
+import flask_app
+from flask_app import WebUser, GameHistory, AirdropBatch, db
+
+def balances():
+    return dict(db.session.execute(db.select(WebUser.telegram_id, WebUser.broscute_points)).all())
+
+def test_rerun_skips_applied_chunks(app, make_user):
+    make_user(telegram_id=1)
+    make_user(telegram_id=2, broscute_points=10)
+    rows = [(1, 100, 'airdrop'), (2, 50, 'airdrop'), (1, 5, 'bonus'), (3, 70, 'airdrop')]
+    
+    first = flask_app.run_airdrop('launch', rows, chunk_size=2)
+    second = flask_app.run_airdrop('launch', rows, chunk_size=2)
+    
+    assert first['chunks'] == 2 and first['skipped_chunks'] == 0
+    assert first['total_amount'] == 155
+    assert first['unmatched_rows'] == 1
+    assert second['skipped_chunks'] == 2 and second['total_amount'] == 0
+    assert balances() == {1: 105, 2: 60}
+    assert db.session.scalar(db.select(db.func.count()).select_from(GameHistory)) == 3
+    assert db.session.scalar(db.select(db.func.count()).select_from(AirdropBatch)) == 2
+
+def test_same_key_with_another_file_is_rejected(app, make_user):
+    make_user(telegram_id=1)
+    flask_app.run_airdrop('launch', [(1, 100, 'airdrop')])
+    
+    with pytest.raises(ValueError):
+        flask_app.run_airdrop('launch', [(1, 200, 'airdrop')])
+    assert balances() == {1: 100}
+
+def test_analytics_counts_matched_rows_and_new_active_users(app, make_user):
+    make_user(telegram_id=1)
+    make_user(telegram_id=2, broscute_points=10)
+    
+    flask_app.run_airdrop('launch', [(1, 100, 'airdrop'), (1, 5, 'bonus'), (2, 50, 'airdrop'), (3, 70, 'airdrop')])
+    
+    pending = flask_app.analytics_rollup._pending
+    assert pending['total_broscute'] == 155
+    assert pending['recent_activity'] == 3
+    assert pending['active_users'] == 1
+
+def test_mario_tokens_do_not_touch_broscute(app, make_user):
+    make_user(telegram_id=1)
+    
+    summary = flask_app.run_airdrop('tokens', [(1, 7, 'airdrop')], currency='mario_tokens')
+    
+    assert summary['credited_users'] == 1
+    assert db.session.execute(db.select(WebUser.broscute_points, WebUser.mario_tokens)).one() == (0, 7)
+    assert flask_app.analytics_rollup._pending['active_users'] == 0
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import flask_app
+from flask_app import WebUser, GameHistory, db
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+
+def reload(user):
+    return db.session.execute(
+        db.select(WebUser.broscute_points, WebUser.staked_amount, WebUser.staking_rewards).where(WebUser.id == user.id)
+    ).one()
+
+def test_guard_rejects_without_writing(app, make_user):
+    user = make_user(broscute_points=10)
+    
+    assert flask_app.apply_balance_change(user.id, -20, where=(WebUser.broscute_points >= 20,), earned=False) is None
+    assert flask_app.apply_balance_change(user.id + 1000, 5, game_type='memory') is None
+    assert reload(user).broscute_points == 10
+    assert db.session.scalar(db.select(db.func.count()).select_from(GameHistory)) == 0
+
+def test_stake_and_unstake_move_balance_atomically(client, make_user):
+    user = make_user(broscute_points=100)
+    login(client, user)
+    
+    assert client.post('/stake', json={'amount': 150}).status_code == 400
+    assert client.post('/stake', json={'amount': 60}).status_code == 200
+    assert tuple(reload(user))[:2] == (40, 60)
+    assert client.post('/unstake', json={'amount': 100}).status_code == 400
+    assert client.post('/unstake', json={'amount': 60}).status_code == 200
+    assert tuple(reload(user))[:2] == (100, 0)
+    assert db.session.get(WebUser, user.id).staking_start_date is None
+
+def test_daily_game_cooldown_is_checked_in_the_update(app, make_user):
+    user = make_user()
+    
+    first, reward = flask_app.play_daily_for(user.id)
+    second, _ = flask_app.play_daily_for(user.id)
+    
+    assert first.broscute_points == reward
+    assert second is None
+    assert reload(user).broscute_points == reward
+
+def test_staking_claim_is_computed_in_the_update_and_paid_once(app, make_user):
+    user = make_user(staked_amount=1000, staking_start_date=datetime.utcnow() - timedelta(days=3, hours=1))
+    
+    row, reward = flask_app.claim_staking_for(user.id)
+    again, nothing = flask_app.claim_staking_for(user.id)
+    
+    assert reward == flask_app.calculate_staking_rewards(db.session.get(WebUser, user.id)) == 30
+    assert row.broscute_points == 30
+    assert (again, nothing) == (None, 0)
+    assert tuple(reload(user)) == (30, 1000, 30)
+    assert db.session.scalars(db.select(GameHistory.broscute_earned).where(GameHistory.game_type == 'staking_rewards')).all() == [30]
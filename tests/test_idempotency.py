@@ -0,0 +1,84 @@
+import hashlib
+from datetime import datetime, timedelta
+
+import flask_app
+from flask_app import WebUser, GameHistory, IdempotencyKey, db
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+
+def balance(user_id):
+    return db.session.scalar(db.select(WebUser.broscute_points).where(WebUser.id == user_id))
+
+def test_repeated_post_replays_the_stored_response(client, make_user):
+    user = make_user()
+    login(client, user)
+    headers = {'Idempotency-Key': 'abc-1'}
+    body = {'game': 'memory', 'rewards': 50}
+    
+    first = client.post('/api/add_game_rewards', json=body, headers=headers)
+    second = client.post('/api/add_game_rewards', json=body, headers=headers)
+    
+    assert first.status_code == second.status_code == 200
+    assert second.get_json() == first.get_json()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    assert balance(user.id) == 50
+    assert db.session.scalar(db.select(db.func.count()).select_from(GameHistory)) == 1
+
+def test_replay_survives_a_cold_worker_cache(client, make_user, monkeypatch):
+    user = make_user()
+    login(client, user)
+    headers = {'Idempotency-Key': 'abc-2'}
+    first = client.post('/api/add_game_rewards', json={'game': 'memory', 'rewards': 20}, headers=headers)
+    
+    monkeypatch.setattr(flask_app, 'idempotency_cache', flask_app.IdempotencyCache())
+    second = client.post('/api/add_game_rewards', json={'game': 'memory', 'rewards': 20}, headers=headers)
+    
+    assert second.get_json() == first.get_json()
+    assert balance(user.id) == 20
+
+def test_same_key_with_another_body_is_rejected(client, make_user):
+    user = make_user()
+    login(client, user)
+    headers = {'Idempotency-Key': 'abc-3'}
+    client.post('/api/add_game_rewards', json={'game': 'memory', 'rewards': 20}, headers=headers)
+    
+    response = client.post('/api/add_game_rewards', json={'game': 'memory', 'rewards': 90}, headers=headers)
+    
+    assert response.status_code == 422
+    assert balance(user.id) == 20
+
+def test_pending_key_returns_409_until_abandoned(client, make_user):
+    user = make_user()
+    user_id = user.id
+    login(client, user)
+    body = b'{"game": "memory", "rewards": 20}'
+    # Rezervarea lăsată de o cerere care încă rulează (status_code NULL)
+    db.session.execute(db.insert(IdempotencyKey).values(
+        user_id=user_id, key='abc-4', endpoint='main.add_game_rewards', created_at=datetime.utcnow(),
+        fingerprint=hashlib.sha256(b'main.add_game_rewards\0' + body).hexdigest()
+    ))
+    db.session.commit()
+    post = lambda: client.post('/api/add_game_rewards', data=body, content_type='application/json',
+                               headers={'Idempotency-Key': 'abc-4'})
+    
+    assert post().status_code == 409
+    # Cererile din test client împart sesiunea fixture-ului; în producție teardown-ul o închide
+    db.session.remove()
+    db.session.execute(db.update(IdempotencyKey).values(
+        created_at=datetime.utcnow() - timedelta(seconds=flask_app.IDEMPOTENCY_PENDING_SECONDS + 1)))
+    db.session.commit()
+    assert post().status_code == 200
+    assert balance(user_id) == 20
+
+def test_purge_removes_expired_keys(client, make_user):
+    user = make_user()
+    login(client, user)
+    client.post('/api/add_game_rewards', json={'game': 'memory', 'rewards': 5}, headers={'Idempotency-Key': 'old'})
+    
+    later = datetime.utcnow() + timedelta(seconds=flask_app.IDEMPOTENCY_TTL_SECONDS + 1)
+    
+    assert flask_app.purge_idempotency_keys(later) == 1
+    assert db.session.scalar(db.select(db.func.count()).select_from(IdempotencyKey)) == 0
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import flask_app
+from flask_app import WebUser, BalanceLedger, db
+
+@pytest.fixture
+def ledger(app, monkeypatch):
+    monkeypatch.setattr(flask_app, 'BALANCE_MODE', 'ledger')
+
+def snapshot(user_id):
+    return db.session.execute(db.select(WebUser.broscute_points, WebUser.total_earned).where(WebUser.id == user_id)).one()
+
+def journal(user_id, compacted=None):
+    query = db.select(db.func.coalesce(db.func.sum(BalanceLedger.amount), 0)).where(BalanceLedger.user_id == user_id)
+    if compacted is not None:
+        query = query.where(BalanceLedger.compacted.is_(compacted))
+    return db.session.scalar(query)
+
+def test_unguarded_credit_is_pending_until_compaction(ledger, make_user):
+    user = make_user(broscute_points=10, total_earned=10)
+    
+    row = flask_app.apply_balance_change(user.id, 40, game_type='memory')
+    
+    assert row.broscute_points == 50
+    assert tuple(snapshot(user.id)) == (10, 10)
+    assert tuple(flask_app.user_balance(user.id)) == (50, 50)
+    assert flask_app.compact_ledger() == 1
+    assert tuple(snapshot(user.id)) == (50, 50)
+    assert journal(user.id, compacted=False) == 0
+    assert flask_app.compact_ledger() == 0
+
+def test_debit_folds_pending_credits_before_the_guard(ledger, make_user):
+    user = make_user(broscute_points=0)
+    flask_app.apply_balance_change(user.id, 30, game_type='memory')
+    
+    row = flask_app.apply_balance_change(user.id, -20, where=(WebUser.broscute_points >= 20,), earned=False)
+    
+    assert row.broscute_points == 10
+    assert snapshot(user.id).broscute_points == 10
+    assert journal(user.id, compacted=False) == 0
+    assert flask_app.apply_balance_change(user.id, -20, where=(WebUser.broscute_points >= 20,), earned=False) is None
+
+def test_bulk_credits_are_journaled(ledger, make_user):
+    now = datetime.utcnow()
+    referrer = make_user(telegram_id=1, referral_code='ROOT01')
+    miner = make_user(telegram_id=2, mining_started_at=now - timedelta(days=2))
+    
+    flask_app.register_user(3, 'nou', 'Nou', '', referral_code='ROOT01')
+    flask_app.settle_matured_mining(now)
+    flask_app.run_airdrop('launch', [(1, 70, 'airdrop'), (2, 30, 'airdrop'), (2, 5, 'bonus')])
+    
+    for user_id in (referrer.id, miner.id):
+        assert journal(user_id, compacted=False) == 0
+        assert journal(user_id) == snapshot(user_id).broscute_points
+    assert snapshot(referrer.id).broscute_points == 100 + 70
+    assert snapshot(miner.id).broscute_points == flask_app.MINING_REWARD + 35
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import flask_app
+from flask_app import WebUser, GameHistory, db
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session['user_id'] = user.id
+
+def test_auto_settle_credits_matured_sessions_once(app, make_user):
+    now = datetime.utcnow()
+    matured = make_user(mining_started_at=now - timedelta(days=1, seconds=1))
+    running = make_user(mining_started_at=now - timedelta(hours=1))
+    
+    assert flask_app.settle_matured_mining(now, batch_size=1) == 1
+    assert flask_app.settle_matured_mining(now) == 0
+    
+    rows = dict(db.session.execute(db.select(WebUser.id, WebUser.broscute_points)).all())
+    assert rows == {matured.id: flask_app.MINING_REWARD, running.id: 0}
+    assert db.session.get(WebUser, matured.id).mining_started_at is None
+    assert db.session.scalar(db.select(db.func.count()).where(GameHistory.game_type == 'mining')) == 1
+
+def test_daily_game_does_not_open_a_mining_session(client, make_user):
+    user = make_user()
+    login(client, user)
+    
+    assert client.post('/play/daily').status_code == 200
+    db.session.execute(db.update(WebUser).values(last_daily_game=datetime.utcnow() - timedelta(days=2)))
+    db.session.commit()
+    
+    assert flask_app.settle_matured_mining() == 0
+    assert client.get('/api/mining/status').get_json()['can_start'] is True
+
+def test_started_session_is_settled_and_cannot_be_claimed_again(client, make_user):
+    user = make_user()
+    login(client, user)
+    
+    assert client.post('/api/mining/start').status_code == 200
+    assert client.post('/api/mining/start').status_code == 400
+    db.session.execute(db.update(WebUser).values(mining_started_at=datetime.utcnow() - timedelta(days=1, seconds=1)))
+    db.session.commit()
+    
+    assert flask_app.settle_matured_mining() == 1
+    assert client.post('/api/mining/complete').status_code == 400
+    assert db.session.get(WebUser, user.id).broscute_points == flask_app.MINING_REWARD
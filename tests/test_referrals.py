@@ -0,0 +1,48 @@
+import pytest
+
+import flask_app
+from flask_app import WebUser, GameHistory, db
+
+def test_signup_credits_every_tier_of_the_chain(app, make_user):
+    root = make_user(referral_code='ROOT01')
+    middle = make_user(referral_code='MID001', referred_by=root.id)
+    direct = make_user(referral_code='DIR001', referred_by=middle.id)
+    
+    user = flask_app.register_user('555', 'nou', 'Nou', '', referral_code=' dir001 ')
+    
+    assert user.referred_by == direct.id
+    balances = dict(db.session.execute(db.select(WebUser.id, WebUser.broscute_points)).all())
+    assert balances[direct.id] == 100
+    assert balances[middle.id] == 50
+    assert balances[root.id] == 25
+    assert balances[user.id] == 100
+    assert db.session.get(WebUser, direct.id).referral_count == 1
+    assert db.session.get(WebUser, middle.id).referral_count == 0
+    history = db.session.scalars(db.select(GameHistory.broscute_earned).where(GameHistory.game_type == 'referral')).all()
+    assert sorted(history) == [25, 50, 100]
+
+def test_unknown_or_own_code_registers_without_referrer(app, make_user):
+    make_user(telegram_id='555', referral_code='SELF01')
+    user = flask_app.register_user('556', 'nou', 'Nou', '', referral_code='NOPE00')
+    assert user.referred_by is None
+
+@pytest.mark.parametrize('start_param', [12345, ['ROOT01'], {'code': 'ROOT01'}, '   ', True])
+def test_telegram_auth_ignores_non_text_start_param(client, make_user, start_param):
+    referrer = make_user(referral_code='ROOT01')
+    
+    response = client.post('/telegram_auth', json={'telegram_id': '555', 'first_name': 'Nou', 'start_param': start_param})
+    
+    assert response.status_code == 200
+    user = db.session.execute(db.select(WebUser).where(WebUser.telegram_id == '555')).scalar_one()
+    assert user.referred_by is None
+    assert user.broscute_points == 100
+    assert db.session.get(WebUser, referrer.id).broscute_points == 0
+
+def test_telegram_auth_falls_back_to_the_first_text_code(client, make_user):
+    referrer = make_user(referral_code='ROOT01')
+    
+    response = client.post('/telegram_auth', json={'telegram_id': '555', 'referral_code': 7, 'start_param': 'root01'})
+    
+    assert response.status_code == 200
+    user = db.session.execute(db.select(WebUser).where(WebUser.telegram_id == '555')).scalar_one()
+    assert user.referred_by == referrer.id